@@ -0,0 +1,131 @@
+import calendar
+import datetime
+from logging import getLogger
+import psycopg
+
+from demographic_transform import age_band, demographic_transformer, next_band_change
+import rollups
+from write_batch import write_batch
+
+logger = getLogger(__name__)
+
+# The age band comes from the birth date and the day of the run, so customers move from one band
+# to the next without their Demographics changing, unseen by the incremental customer load.
+# etlmeta_birthdate indexes every customer by the next day its band changes: a run only looks at
+# the customers whose day has come, and re-keys their snapshot of the run month.
+BIRTH_DATE_STAGE_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS stage_birthdate (
+    customerid INTEGER NOT NULL,
+    birthdate DATE NOT NULL,
+    nextbandchange DATE NULL
+)"""
+RECORD_BIRTH_DATES_SQL = """
+INSERT INTO etlmeta_birthdate (customerid, birthdate, nextbandchange)
+SELECT DISTINCT ON (customerid) customerid, birthdate, nextbandchange FROM stage_birthdate
+ON CONFLICT (customerid) DO UPDATE
+SET birthdate = EXCLUDED.birthdate,
+    nextbandchange = EXCLUDED.nextbandchange"""
+DUE_SQL = "SELECT customerid, birthdate FROM etlmeta_birthdate WHERE nextbandchange <= %s"
+AGE_BAND_STAGE_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS stage_ageband (
+    customerid INTEGER NOT NULL,
+    ageband VARCHAR(20) NOT NULL,
+    nextbandchange DATE NULL
+)"""
+DEMOGRAPHIC_COLUMNS = ("maritalstatus", "yearlyincomelevel", "numbercarsowned", "education", "occupation", "ishomeowner")
+# The demographic of the run month's snapshot, with the new age band. Added to the dimension first.
+NEW_DEMOGRAPHICS_SQL = f"""
+INSERT INTO dimdemographic (ageband, {", ".join(DEMOGRAPHIC_COLUMNS)})
+SELECT s.ageband, {", ".join("d." + column for column in DEMOGRAPHIC_COLUMNS)}
+FROM stage_ageband AS s
+    JOIN dimcustomer AS c ON c.customerid = s.customerid
+    JOIN factcustomermonthlysnapshot AS f ON f.customerkey = c.customerkey AND f.snapshotdatekey = %s
+    JOIN dimdemographic AS d ON d.demographickey = f.demographickey
+EXCEPT
+SELECT ageband, {", ".join(DEMOGRAPHIC_COLUMNS)} FROM dimdemographic
+ON CONFLICT DO NOTHING"""
+REKEY_SQL = f"""
+UPDATE factcustomermonthlysnapshot AS f
+SET demographickey = n.demographickey
+FROM stage_ageband AS s
+    JOIN dimcustomer AS c ON c.customerid = s.customerid,
+    dimdemographic AS d,
+    dimdemographic AS n
+WHERE f.snapshotdatekey = %s
+    AND f.customerkey = c.customerkey
+    AND d.demographickey = f.demographickey
+    AND n.ageband = s.ageband
+    AND {" AND ".join(f"n.{column} IS NOT DISTINCT FROM d.{column}" for column in DEMOGRAPHIC_COLUMNS)}
+    AND f.demographickey <> n.demographickey"""
+ADVANCE_SQL = """
+UPDATE etlmeta_birthdate AS b
+SET nextbandchange = s.nextbandchange
+FROM stage_ageband AS s
+WHERE b.customerid = s.customerid"""
+
+
+def record_birth_dates(pg_cur: psycopg.Cursor, birth_dates, today: datetime.date) -> int:
+    # Index (CustomerID, birth date) pairs, as seen by the customer loaders.
+    pg_cur.execute(BIRTH_DATE_STAGE_SQL)
+    staged = 0
+    with pg_cur.copy("COPY stage_birthdate (customerid, birthdate, nextbandchange) FROM STDIN") as copy:
+        for customer_id, birth_date in birth_dates:
+            copy.write_row((customer_id, birth_date, next_band_change(birth_date, today)))
+            staged += 1
+    if staged > 0:
+        pg_cur.execute(RECORD_BIRTH_DATES_SQL)
+    pg_cur.execute("TRUNCATE stage_birthdate")
+    return staged
+
+
+def rekey_age_bands(pg_conn: psycopg.Connection, run_date: datetime.date, today: datetime.date | None = None) -> int:
+    # Move the customers whose age band changed by today to the demographic with their new band,
+    # in their snapshot of the month of run_date, then index them by their next change.
+    # Earlier months keep the band the customer had then. Bands are as of the same day as the
+    # demographic transform's.
+    today = today or demographic_transformer.today
+    month_key = run_date.year * 10000 + run_date.month * 100 + calendar.monthrange(run_date.year, run_date.month)[1]
+    with pg_conn.cursor() as pg_cur:
+        pg_cur.execute(DUE_SQL, (today,))
+        due = pg_cur.fetchall()
+        if len(due) == 0:
+            logger.info("No customer changed age band")
+            return 0
+
+        pg_cur.execute(AGE_BAND_STAGE_SQL)
+        pg_cur.execute("TRUNCATE stage_ageband")
+        with pg_cur.copy("COPY stage_ageband (customerid, ageband, nextbandchange) FROM STDIN") as copy:
+            for customer_id, birth_date in due:
+                copy.write_row((customer_id, age_band(birth_date, today), next_band_change(birth_date, today)))
+
+        with write_batch(pg_cur, "age band rekey") as batch:
+            batch.execute(NEW_DEMOGRAPHICS_SQL, (month_key,))
+            rekey = batch.execute(REKEY_SQL, (month_key,))
+            batch.execute(ADVANCE_SQL)
+        rekeyed = rekey.rowcount
+        if rekeyed > 0:
+            rollups.mark_month(pg_cur, month_key)
+        pg_conn.commit()
+
+    logger.info("%s customers changed age band, re-keyed %s snapshots of %s", len(due), rekeyed, month_key)
+    return rekeyed
+
+
+if __name__ == "__main__":
+    # python etl/age_bands.py: index the birth date of every customer of the source, e.g. for a
+    # warehouse loaded before the index existed.
+    import logging
+
+    from connection import connect_pg, connect_source
+    from demographic_transform import parse_birth_date
+    from load_customer_demographic import CUSTOMER_DEMOGRAPHIC_SQL
+    from streaming import stream_rows
+
+    logging.basicConfig(level=logging.INFO)
+    with connect_source() as source_conn, connect_pg() as pg_conn:
+        with source_conn.cursor() as ms_cur, pg_conn.cursor() as pg_cur:
+            ms_cur.execute(CUSTOMER_DEMOGRAPHIC_SQL)
+            birth_dates = [(row[0], parse_birth_date(row[5])) for row in stream_rows(ms_cur) if row[5]]
+            indexed = record_birth_dates(pg_cur, birth_dates, demographic_transformer.today)
+        pg_conn.commit()
+    logger.info("Indexed the birth date of %s customers", indexed)
@@ -0,0 +1,228 @@
+import calendar
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import date
+from logging import getLogger
+import psycopg
+
+from config import ETL_BACKFILL_WORKERS
+from connection import ConnectionPool, SourceCursor
+from instrumentation import StageMetrics
+import partitions
+from rfm import RFMScorer, create_scorer
+import rollups
+from segments import load_segment_map
+
+logger = getLogger(__name__)
+
+# Recompute whole snapshot months from the source, e.g. after fixing the source or the scoring
+# rules, without a full reload. Months are independent once the dimensions are loaded, so they
+# are spread over workers, and each replaces its old version in one transaction.
+#
+# A month has a snapshot for every individual customer with an order on or before it, scored on
+# its orders of the month, (1, 1, 1) without any, like the fact load builds it.
+MONTH_CUSTOMERS_SQL = """
+SELECT c.CustomerID
+FROM Person.Person AS p
+    JOIN Sales.Customer AS c ON p.BusinessEntityID = c.PersonID
+WHERE p.PersonType = 'IN' AND EXISTS (
+    SELECT 1
+    FROM Sales.SalesOrderHeader AS header
+    WHERE header.CustomerID = c.CustomerID AND header.Status != 6 AND header.OrderDate < %s
+)"""
+# The month aggregates of BULK_ORDER_AGGREGATE_SQL, for every order of the month.
+MONTH_ORDER_AGGREGATE_SQL = """
+SELECT
+    header.CustomerID,
+    OrderYear = DATEPART(year, header.OrderDate),
+    OrderMonth = DATEPART(month, header.OrderDate),
+    MonthCount = COUNT(header.SalesOrderID),
+    MonthTotal = ISNULL(SUM(header.SubTotal), 0),
+    LatestOrderDate = MAX(header.OrderDate),
+    LatestModifiedDate = MAX(header.ModifiedDate)
+FROM Sales.SalesOrderHeader AS header
+WHERE header.Status != 6 AND header.OrderDate >= %s AND header.OrderDate < %s
+GROUP BY header.CustomerID,
+    DATEPART(year, header.OrderDate),
+    DATEPART(month, header.OrderDate)"""
+SCORE_STAGE_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS stage_backfillscore (
+    customerid INTEGER NOT NULL,
+    recency_score SMALLINT NOT NULL,
+    frequency_score SMALLINT NOT NULL,
+    monetary_score SMALLINT NOT NULL
+)"""
+SNAPSHOT_STAGE_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS stage_backfillsnapshot (
+    customerkey BIGINT NOT NULL,
+    snapshotdatekey INTEGER NOT NULL,
+    demographickey BIGINT NULL,
+    geographickey BIGINT NULL,
+    segmentkey BIGINT NULL,
+    recency_score SMALLINT NOT NULL,
+    frequency_score SMALLINT NOT NULL,
+    monetary_score SMALLINT NOT NULL
+)"""
+SNAPSHOT_COLUMNS = "customerkey, snapshotdatekey, demographickey, geographickey, segmentkey, recency_score, frequency_score, monetary_score"
+# The new snapshot of the month: the customer's latest version, the dimension keys of its current
+# snapshot of the month, else of its nearest one (the latest before, else the earliest after),
+# and the segment of its scores. Customers without any snapshot yet are left to the next load.
+BUILD_SNAPSHOT_SQL = f"""
+INSERT INTO stage_backfillsnapshot ({SNAPSHOT_COLUMNS})
+SELECT latest.customerkey, %(month)s, nearest.demographickey, nearest.geographickey, m.segmentkey,
+    s.recency_score, s.frequency_score, s.monetary_score
+FROM stage_backfillscore AS s
+    CROSS JOIN LATERAL (
+        SELECT c.customerkey FROM dimcustomer AS c
+        WHERE c.customerid = s.customerid
+        ORDER BY c.customerkey DESC LIMIT 1
+    ) AS latest
+    CROSS JOIN LATERAL (
+        SELECT f.demographickey, f.geographickey
+        FROM dimcustomer AS c
+            JOIN factcustomermonthlysnapshot AS f ON f.customerkey = c.customerkey
+        WHERE c.customerid = s.customerid
+        ORDER BY f.snapshotdatekey > %(month)s, abs(f.snapshotdatekey - %(month)s), f.customerkey DESC
+        LIMIT 1
+    ) AS nearest
+    LEFT JOIN stage_segmentmap AS m
+        ON m.recency_score = s.recency_score
+        AND m.frequency_score = s.frequency_score
+        AND m.monetary_score = s.monetary_score"""
+MONTH_TIME_SQL = """
+INSERT INTO dimtime (timekey, "Day", "Month", "Year")
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (timekey) DO NOTHING"""
+
+
+def _month_end(month: date) -> date:
+    return date(month.year, month.month, calendar.monthrange(month.year, month.month)[1])
+
+
+def _score_month(ms_cur: SourceCursor, scorer: RFMScorer, month: date) -> list[tuple]:
+    # (CustomerID, recency, frequency, monetary) of every customer of the month's snapshot.
+    start = partitions.month_start(month)
+    end = partitions.next_month(month)
+    ms_cur.execute(MONTH_CUSTOMERS_SQL, (end,))
+    customers = [row[0] for row in ms_cur.fetchall()]
+    ms_cur.execute(MONTH_ORDER_AGGREGATE_SQL, (start, end))
+    scores = {row[0]: row[4:7] for row in scorer.score_rows(ms_cur.fetchall())}
+    return [(customer_id, *scores.get(customer_id, (1, 1, 1))) for customer_id in customers]
+
+
+def _stage_month(pg_cur: psycopg.Cursor, month_end: date, month_key: int, scores: list[tuple]) -> int:
+    # Build the month's new snapshot in stage_backfillsnapshot, return its number of rows.
+    pg_cur.execute(MONTH_TIME_SQL, (month_key, month_end.day, month_end.month, month_end.year))
+    pg_cur.execute(SCORE_STAGE_SQL)
+    pg_cur.execute(SNAPSHOT_STAGE_SQL)
+    pg_cur.execute("TRUNCATE stage_backfillscore, stage_backfillsnapshot")
+    with pg_cur.copy(
+        "COPY stage_backfillscore (customerid, recency_score, frequency_score, monetary_score) FROM STDIN"
+    ) as copy:
+        for row in scores:
+            copy.write_row(row)
+    pg_cur.execute(BUILD_SNAPSHOT_SQL, {"month": month_key})
+    return pg_cur.rowcount
+
+
+def _replace_month(pg_cur: psycopg.Cursor, pg_conn: psycopg.Connection, month_end: date, month_key: int, partitioned: bool):
+    # Swap the month's snapshot for stage_backfillsnapshot. Readers see either version, never a mix.
+    if not partitioned:
+        pg_cur.execute(f"DELETE FROM {partitions.FACT_TABLE} WHERE snapshotdatekey = %s", (month_key,))
+        pg_cur.execute(f"INSERT INTO {partitions.FACT_TABLE} ({SNAPSHOT_COLUMNS}) SELECT {SNAPSHOT_COLUMNS} FROM stage_backfillsnapshot")
+        rollups.mark_month(pg_cur, month_key)
+        pg_conn.commit()
+        return
+
+    # Load the month on the side first, the other months stay readable meanwhile.
+    name = partitions.create_detached(pg_cur, month_end, f"{partitions.partition_name(month_end)}_backfill")
+    pg_cur.execute(f"INSERT INTO {name} ({SNAPSHOT_COLUMNS}) SELECT {SNAPSHOT_COLUMNS} FROM stage_backfillsnapshot")
+    pg_conn.commit()
+    # Detaching takes the fact table exclusively. Taking it first, while holding no other lock
+    # on it, keeps workers swapping their months at the same time from deadlocking.
+    pg_cur.execute(f"LOCK TABLE {partitions.FACT_TABLE} IN ACCESS EXCLUSIVE MODE")
+    partitions.replace_partition(pg_cur, month_end, name)
+    rollups.mark_month(pg_cur, month_key)
+    pg_conn.commit()
+
+
+def _backfill_worker(
+    pool: ConnectionPool,
+    month: date,
+    scorer: RFMScorer,
+    partitioned: bool,
+    metrics: StageMetrics | None = None,
+) -> int:
+    month_end = _month_end(month)
+    month_key = month_end.year * 10000 + month_end.month * 100 + month_end.day
+    with pool.connection() as (mssql_conn, pg_conn):
+        with mssql_conn.cursor() as ms_cur, pg_conn.cursor() as pg_cur:
+            if metrics is not None:
+                ms_cur = metrics.source_cursor(ms_cur)
+                pg_cur = metrics.warehouse_cursor(pg_cur)
+            with metrics.batch(month_key) if metrics is not None else nullcontext():
+                scores = _score_month(ms_cur, scorer, month)
+                # Temporary tables are per connection, and so is the segment map.
+                load_segment_map(pg_cur)
+                staged = _stage_month(pg_cur, month_end, month_key, scores)
+                # Reading the old month is done, let go of the fact table before swapping.
+                pg_conn.commit()
+                _replace_month(pg_cur, pg_conn, month_end, month_key, partitioned)
+
+    logger.info(
+        "Recomputed %s: %s snapshots, %s customers without a snapshot yet left out",
+        month_key,
+        staged,
+        len(scores) - staged,
+    )
+    return staged
+
+
+def backfill(
+    first_month: date,
+    last_month: date,
+    run_date: date,
+    workers: int = ETL_BACKFILL_WORKERS,
+    metrics: StageMetrics | None = None,
+) -> int:
+    # Recompute the snapshot months from first_month to last_month (any day of them), up to the
+    # month of run_date, on workers connections. Each month is committed on its own: an
+    # interrupted backfill leaves every month either old or recomputed, rerun it to finish.
+    # Rollups of the recomputed months are left for rollups.refresh_rollups.
+    first_month = partitions.month_start(first_month)
+    last_month = partitions.month_start(last_month)
+    if first_month > last_month:
+        raise ValueError(f"Backfill range is empty: {first_month:%Y-%m} to {last_month:%Y-%m}")
+    if last_month > partitions.month_start(run_date):
+        raise ValueError(f"Cannot backfill past the run month {run_date:%Y-%m}")
+
+    months = []
+    month = first_month
+    while month <= last_month:
+        months.append(month)
+        month = partitions.next_month(month)
+
+    pool = ConnectionPool(workers)
+    try:
+        with pool.connection() as (mssql_conn, pg_conn):
+            with mssql_conn.cursor() as ms_cur, pg_conn.cursor() as pg_cur:
+                # Every month is scored with the same rules, the quantile edges included. With
+                # ETL_RFM_SCORING=sql, RFMScorer() applies the rules of TRANSACTION_SQL.
+                scorer = create_scorer(ms_cur) or RFMScorer()
+                partitioned = partitions.is_partitioned(pg_cur)
+            pg_conn.commit()
+
+        logger.info("Recomputing %s months from %s on %s workers", len(months), first_month, workers)
+        written = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_backfill_worker, pool, month, scorer, partitioned, metrics)
+                for month in months
+            ]
+            for future in as_completed(futures):
+                written += future.result()
+    finally:
+        pool.close()
+
+    logger.info("Recomputed %s months, %s snapshots", len(months), written)
+    return written
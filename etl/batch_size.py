@@ -0,0 +1,95 @@
+from logging import getLogger
+import threading
+import time
+
+from config import ETL_FACT_BATCH_SIZE, ETL_FACT_BATCH_SIZE_MAX, ETL_FACT_BATCH_SIZE_MIN, ETL_FACT_COMMIT_TARGET
+
+logger = getLogger(__name__)
+
+
+class AdaptiveBatchSize:
+    # Number of customers per fact batch, adjusted after every batch from what it cost.
+    # Hill climbing on the throughput of the whole pipeline (customers per second between two
+    # finished batches): keep moving the size the same way while it does not get slower, turn
+    # back with a smaller step when it does, so the size settles. A commit slower than commit_target (lock contention, WAL pressure)
+    # halves the size at once.
+    # The extraction thread reads size, the loading thread records the batches. Batches already
+    # extracted keep the size they were extracted with, a change shows a few batches later.
+
+    STEP = 1.5
+    MIN_STEP = 1.1
+    # Throughput drops within this fraction are noise, not a reason to turn back.
+    TOLERANCE = 0.05
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = ETL_FACT_BATCH_SIZE,
+        minimum: int = ETL_FACT_BATCH_SIZE_MIN,
+        maximum: int = ETL_FACT_BATCH_SIZE_MAX,
+        commit_target: float = ETL_FACT_COMMIT_TARGET,
+    ):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.commit_target = commit_target
+        self.size = min(max(initial, self.minimum), self.maximum)
+        self.batches = 0
+        self.customers = 0
+        self.smallest = self.size
+        self.largest = self.size
+        self.slow_commits = 0
+        self._growing = True
+        self._step = self.STEP
+        self._previous_throughput = None
+        # The first batch is timed from the creation, pipeline start-up included.
+        self._last_finished = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, customers: int, commit_seconds: float):
+        # One finished batch of customers, committed in commit_seconds.
+        now = time.perf_counter()
+        with self._lock:
+            elapsed = now - self._last_finished
+            self._last_finished = now
+            self.batches += 1
+            self.customers += customers
+            throughput = customers / elapsed if elapsed > 0 else None
+
+            if commit_seconds > self.commit_target:
+                self.slow_commits += 1
+                self._growing = False
+                # Conditions changed, search again from full steps.
+                self._step = self.STEP
+                size = max(self.minimum, self.size // 2)
+                if size != self.size:
+                    logger.info(
+                        "Fact %s: commit took %.2fs, batch size %s -> %s", self.name, commit_seconds, self.size, size
+                    )
+            else:
+                if (
+                    throughput is not None
+                    and self._previous_throughput is not None
+                    and throughput < self._previous_throughput * (1 - self.TOLERANCE)
+                ):
+                    self._growing = not self._growing
+                    self._step = max(self.MIN_STEP, 1 + (self._step - 1) / 2)
+                step = self._step if self._growing else 1 / self._step
+                size = min(self.maximum, max(self.minimum, round(self.size * step)))
+
+            self._previous_throughput = throughput
+            self.size = size
+            self.smallest = min(self.smallest, size)
+            self.largest = max(self.largest, size)
+
+    def log_stats(self):
+        logger.info(
+            "Fact %s: %s batches of %s customers on average, batch size between %s and %s, last %s, %s slow commits",
+            self.name,
+            self.batches,
+            self.customers // self.batches if self.batches > 0 else 0,
+            self.smallest,
+            self.largest,
+            self.size,
+            self.slow_commits,
+        )
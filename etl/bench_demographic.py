@@ -0,0 +1,78 @@
+# Micro-benchmark of the Demographics XML transform: the reference ElementTree parser against
+# demographic_transform.DemographicTransformer, cold (every document new) and warm (every
+# document seen before, as in the fact load). Checks that both produce the same rows.
+#
+#   python etl/bench_demographic.py [documents] [processes]
+import datetime
+import random
+import sys
+import time
+
+from demographic_transform import DemographicTransformer
+from load_customer_demographic import parse_demographic
+
+SURVEY_NAMESPACE = "http://schemas.microsoft.com/sqlserver/2004/07/adventure-works/IndividualSurvey"
+
+
+def individual_survey(rng: random.Random) -> str:
+    # An AdventureWorks-shaped Person.Demographics document.
+    birth_date = datetime.date(1930, 1, 1) + datetime.timedelta(days=rng.randrange(365 * 70))
+    return (
+        f'<IndividualSurvey xmlns="{SURVEY_NAMESPACE}">'
+        f"<TotalPurchaseYTD>{rng.uniform(0, 10000):.4f}</TotalPurchaseYTD>"
+        f"<DateFirstPurchase>{2011 + rng.randrange(4)}-0{1 + rng.randrange(9)}-1{rng.randrange(10)}Z</DateFirstPurchase>"
+        f"<BirthDate>{birth_date.isoformat()}Z</BirthDate>"
+        f"<MaritalStatus>{rng.choice('MS')}</MaritalStatus>"
+        f"<YearlyIncome>{rng.choice(['0-25000', '25001-50000', '50001-75000', '75001-100000', 'greater than 100000'])}</YearlyIncome>"
+        f"<Gender>{rng.choice('MF')}</Gender>"
+        f"<TotalChildren>{rng.randrange(6)}</TotalChildren>"
+        f"<NumberChildrenAtHome>{rng.randrange(4)}</NumberChildrenAtHome>"
+        f"<Education>{rng.choice(['Bachelors ', 'Graduate Degree', 'High School', 'Partial College', 'Partial High School'])}</Education>"
+        f"<Occupation>{rng.choice(['Clerical', 'Management', 'Manual', 'Professional', 'Skilled Manual'])}</Occupation>"
+        f"<HomeOwnerFlag>{rng.randrange(2)}</HomeOwnerFlag>"
+        f"<NumberCarsOwned>{rng.randrange(5)}</NumberCarsOwned>"
+        f"<CommuteDistance>{rng.choice(['0-1 Miles', '1-2 Miles', '2-5 Miles', '5-10 Miles', '10+ Miles'])}</CommuteDistance>"
+        "</IndividualSurvey>"
+    )
+
+
+def _timed(label: str, count: int, function):
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<36} {elapsed:8.3f}s {count / elapsed:12.0f} docs/s")
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    rng = random.Random(42)
+    documents = [individual_survey(rng) for _ in range(count)]
+
+    reference = _timed("ElementTree (parse_demographic)", count, lambda: [parse_demographic(xml) for xml in documents])
+
+    transformer = DemographicTransformer(processes=0)
+    cold = _timed("transformer, cold", count, lambda: [transformer.parse(xml) for xml in documents])
+    warm = _timed("transformer, warm", count, lambda: [transformer.parse(xml) for xml in documents])
+
+    transformer = DemographicTransformer(processes=0)
+    batched = _timed("transformer.parse_many, cold", count, lambda: transformer.parse_many(documents))
+
+    results = [cold, warm, batched]
+    if processes > 0:
+        transformer = DemographicTransformer(processes=processes, pool_threshold=1)
+        # Start the workers on other documents before timing, spawning them is a one-off cost per run.
+        transformer.parse_many([individual_survey(rng) for _ in range(processes * 4)])
+        results.append(
+            _timed(f"parse_many, cold, {processes} processes", count, lambda: transformer.parse_many(documents))
+        )
+        transformer.close()
+
+    assert all(result == reference for result in results), "transformer output differs from parse_demographic"
+    print("All transforms match the reference parser.")
+
+
+
+if __name__ == "__main__":
+    main()
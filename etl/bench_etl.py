@@ -0,0 +1,155 @@
+# End-to-end benchmark of the ETL on a synthetic source (bench_generate.py, ETL_SOURCE=local):
+# an initial load, then an incremental load after changing a fraction of the source, each run
+# as python etl/main.py. Reports every stage from its run history, and compares the run with a
+# stored baseline of the same scale and fraction.
+#
+#   python etl/bench_etl.py --reset [--scale 10] [--modified 0.05] [--save] [--tolerance 0.2]
+#
+# --reset is required: the benchmark empties the warehouse of the .env (keeping its run history).
+# Point POSTGRES_DB at a scratch warehouse. Exits with 1 when a stage regressed.
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from bench_generate import generate, modify
+from connection import connect_pg
+
+ETL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Children first, the fact table references the dimensions.
+WAREHOUSE_TABLES = (
+    "factcustomermonthlysnapshot",
+    "rollup_territorysegment",
+    "rollup_demographicsegment",
+    "dimcustomer",
+    "dimdemographic",
+    "dimgeographic",
+    "dimtime",
+    "dimsegment",
+    "etlmeta_tabletimestamp",
+    "etlmeta_factload",
+    "etlmeta_factloadrange",
+    "etlmeta_rollupmonth",
+    "etlmeta_birthdate",
+)
+
+
+def _empty_warehouse():
+    with connect_pg() as pg_conn:
+        with pg_conn.cursor() as pg_cur:
+            for table in WAREHOUSE_TABLES:
+                pg_cur.execute(f"DELETE FROM {table}")
+        pg_conn.commit()
+
+
+def _run_etl(source: str, label: str) -> list[dict]:
+    # Run the ETL on its own, so the peak RSS of each run is its own, and return its stages.
+    with tempfile.TemporaryDirectory() as directory:
+        history = os.path.join(directory, "run.json")
+        environment = {
+            **os.environ,
+            "ETL_SOURCE": "local",
+            "ETL_LOCAL_SOURCE_PATH": source,
+            "ETL_RUN_HISTORY_JSON": history,
+            # Time the source queries, not the cache.
+            "ETL_EXTRACT_CACHE_DIR": "",
+        }
+        print(f"Running the {label} load...", flush=True)
+        subprocess.run([sys.executable, os.path.join(ETL_DIRECTORY, "main.py")], env=environment, check=True)
+        with open(history) as file:
+            return json.loads(file.readline())["stages"]
+
+
+def _summary(stages: list[dict]) -> dict:
+    # stage -> the figures compared with the baseline
+    return {
+        stage["stage"]: {
+            "wall": stage["wall"],
+            "rows_extracted": stage["rows_extracted"],
+            "rows_written": stage["rows_written"],
+            "rows_per_second": (stage["rows_extracted"] + stage["rows_written"]) / max(stage["wall"], 1e-9),
+            "source_queries": stage["source_queries"],
+            "warehouse_queries": stage["warehouse_queries"],
+            "peak_memory_mb": stage["peak_memory_mb"],
+        }
+        for stage in stages
+    }
+
+
+def _report(label: str, results: dict, baseline: dict | None, tolerance: float) -> list[str]:
+    # Print one line per stage, return the stages slower than the baseline by more than tolerance.
+    print(f"\n{label} load")
+    print(f"{'stage':<22}{'wall s':>9}{'extracted':>11}{'written':>11}{'rows/s':>10}{'src q':>8}{'wh q':>8}{'peak MiB':>10}  vs baseline")
+    regressions = []
+    for stage, figures in results.items():
+        comparison = ""
+        previous = (baseline or {}).get(stage)
+        if previous is not None and previous["wall"] > 0:
+            ratio = figures["wall"] / previous["wall"]
+            comparison = f"{ratio:6.2f}x wall"
+            if ratio > 1 + tolerance:
+                comparison += "  REGRESSION"
+                regressions.append(f"{label}/{stage}")
+        print(
+            f"{stage:<22}{figures['wall']:>9.2f}{figures['rows_extracted']:>11}{figures['rows_written']:>11}"
+            f"{figures['rows_per_second']:>10.0f}{figures['source_queries']:>8}{figures['warehouse_queries']:>8}"
+            f"{figures['peak_memory_mb'] or 0:>10.1f}  {comparison}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end ETL benchmark on a synthetic source")
+    parser.add_argument("--scale", type=float, default=1, help="Source size, 1 is about CompanyX")
+    parser.add_argument("--modified", type=float, default=0.05, help="Fraction of the source changed before the incremental load")
+    parser.add_argument("--data", default="benchmarks", help="Directory of the generated sources")
+    parser.add_argument("--baseline", default="benchmarks/baselines.json")
+    parser.add_argument("--save", action="store_true", help="Store this run as the baseline of its scale and fraction")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown of a stage's wall time reported as a regression")
+    parser.add_argument("--reset", action="store_true", help="Empty the warehouse first (required)")
+    arguments = parser.parse_args()
+    if not arguments.reset:
+        parser.error("the benchmark empties the warehouse, pass --reset to confirm")
+
+    # Generated once per scale, the runs work on a copy of it.
+    os.makedirs(arguments.data, exist_ok=True)
+    generated = os.path.join(arguments.data, f"source-x{arguments.scale:g}.sqlite")
+    if not os.path.exists(generated):
+        print(f"Generating {generated}...", flush=True)
+        generate(generated, arguments.scale)
+    source = os.path.join(arguments.data, "source-run.sqlite")
+    shutil.copyfile(generated, source)
+
+    _empty_warehouse()
+    results = {"initial": _summary(_run_etl(source, "initial"))}
+    print(f"Modified the source: {modify(source, arguments.modified)}")
+    results["incremental"] = _summary(_run_etl(source, "incremental"))
+
+    baselines = {}
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as file:
+            baselines = json.load(file)
+    key = f"x{arguments.scale:g}-{arguments.modified:g}"
+    baseline = baselines.get(key, {})
+
+    regressions = []
+    for phase, stages in results.items():
+        regressions += _report(phase, stages, baseline.get(phase), arguments.tolerance)
+
+    if arguments.save:
+        baselines[key] = results
+        os.makedirs(os.path.dirname(arguments.baseline) or ".", exist_ok=True)
+        with open(arguments.baseline, "w") as file:
+            json.dump(baselines, file, indent=2)
+        print(f"\nSaved as the baseline {key} in {arguments.baseline}")
+
+    if regressions:
+        print(f"\nRegressed by more than {arguments.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
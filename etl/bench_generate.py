@@ -0,0 +1,241 @@
+# Synthetic AdventureWorks-shaped source for the benchmarks, written as a local_source extract
+# (ETL_SOURCE=local). Scale 1 is about the size of CompanyX: 18,484 individual customers and
+# 27,659 of their orders, over the 37 months up to June 2014 like CompanyX, since the runs are
+# pinned to July 2014 (main.RUN_DATE).
+#
+#   python etl/bench_generate.py <path> [scale]
+#       Generate an extract.
+#   python etl/bench_generate.py <path> --modify [fraction]
+#       Change a fraction of it as of now, as between two incremental loads (see modify).
+import datetime
+from logging import getLogger
+import logging
+import os
+import random
+import sqlite3
+import sys
+
+from bench_demographic import individual_survey
+from local_source import create_local
+
+logger = getLogger(__name__)
+
+CUSTOMERS = 18484
+ORDERS_PER_CUSTOMER = (1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 3)
+STORE_CONTACTS = 753
+CITIES = 575
+MONTHS = 37
+# Last order day of CompanyX.
+END_DATE = datetime.date(2014, 6, 30)
+# TerritoryID -> (name, CountryRegionCode), as in AdventureWorks.
+TERRITORIES = {
+    1: ("Northwest", "US"),
+    2: ("Northeast", "US"),
+    3: ("Central", "US"),
+    4: ("Southwest", "US"),
+    5: ("Southeast", "US"),
+    6: ("Canada", "CA"),
+    7: ("France", "FR"),
+    8: ("Germany", "DE"),
+    9: ("Australia", "AU"),
+    10: ("United Kingdom", "GB"),
+}
+COUNTRIES = {
+    "US": "United States",
+    "CA": "Canada",
+    "FR": "France",
+    "DE": "Germany",
+    "AU": "Australia",
+    "GB": "United Kingdom",
+}
+STATES_PER_TERRITORY = 8
+FIRST_NAMES = ("Jon", "Eugene", "Ruben", "Christy", "Elizabeth", "Julio", "Janet", "Marco", "Rob", "Shannon")
+LAST_NAMES = ("Yang", "Huang", "Torres", "Zhu", "Johnson", "Ruiz", "Alvarez", "Mehta", "Verhoff", "Carlson")
+FIRST_CUSTOMER_ID = 11000
+
+
+def _stamp(value: datetime.datetime) -> str:
+    return value.isoformat(sep=" ")
+
+
+def _window(end: datetime.date) -> tuple[datetime.datetime, datetime.datetime]:
+    # The MONTHS months up to the one of end, orders stop at end.
+    month = end.year * 12 + end.month - 1 - (MONTHS - 1)
+    return (datetime.datetime(month // 12, month % 12 + 1, 1), datetime.datetime.combine(end, datetime.time()))
+
+
+def _person(rng: random.Random, entity_id: int, person_type: str, modified: datetime.datetime) -> tuple:
+    return (
+        entity_id,
+        person_type,
+        rng.choice(FIRST_NAMES),
+        rng.choice("ABCDEFGHJKLMNPRSTW") if rng.random() < 0.5 else None,
+        rng.choice(LAST_NAMES),
+        "Jr." if rng.random() < 0.01 else None,
+        rng.randrange(3),
+        individual_survey(rng) if person_type == "IN" else None,
+        _stamp(modified),
+    )
+
+
+def _orders(rng: random.Random, customer_id: int, first: datetime.datetime, last: datetime.datetime, now: datetime.datetime, modified: datetime.datetime | None = None):
+    # (CustomerID, OrderDate, Status, SubTotal, ModifiedDate), modified a week after the order at
+    # most unless modified is given.
+    span = int((last - first).total_seconds())
+    for _ in range(rng.choice(ORDERS_PER_CUSTOMER)):
+        order_date = first + datetime.timedelta(seconds=rng.randrange(span))
+        order_date = order_date.replace(minute=0, second=0)
+        status = 6 if rng.random() < 0.01 else 5
+        yield (
+            customer_id,
+            _stamp(order_date),
+            status,
+            round(rng.uniform(2.29, 3578.27) * rng.choice((1, 1, 1, 2)), 4),
+            _stamp(modified or min(order_date + datetime.timedelta(days=rng.randrange(8)), now)),
+        )
+
+
+def _insert(connection: sqlite3.Connection, table: str, rows, columns: int):
+    connection.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * columns)})", rows)
+
+
+def generate(path: str, scale: float = 1, seed: int = 42, end: datetime.date | None = None):
+    # Write a new extract at path: CUSTOMERS * scale individual customers with their person,
+    # Demographics and home address, a few store contacts (no orders, not individuals), and the
+    # orders of the individuals over the MONTHS months up to end.
+    end = end or END_DATE
+    now = datetime.datetime.combine(end, datetime.time())
+    (first, last) = _window(end)
+    rng = random.Random(seed)
+    customers = max(1, int(CUSTOMERS * scale))
+    cities = max(1, int(CITIES * scale))
+
+    if os.path.exists(path):
+        os.remove(path)
+    connection = create_local(path)
+    with connection:
+        _insert(connection, "Person_CountryRegion", COUNTRIES.items(), 2)
+        _insert(connection, "Sales_SalesTerritory", ((key, name, _stamp(first)) for key, (name, _) in TERRITORIES.items()), 3)
+        states = []
+        for territory_id, (name, country) in TERRITORIES.items():
+            for number in range(STATES_PER_TERRITORY):
+                states.append((len(states) + 1, f"{name} State {number + 1}", country, territory_id, _stamp(first)))
+        _insert(connection, "Person_StateProvince", states, 5)
+        # Cities as (name, StateProvinceID), every address is in one of them.
+        city_states = [(f"City {number + 1}", rng.randrange(len(states)) + 1) for number in range(cities)]
+
+        entity_id = 0
+        for start in range(0, customers + STORE_CONTACTS, 10000):
+            persons, customer_rows, addresses, links, orders = [], [], [], [], []
+            for number in range(start, min(start + 10000, customers + STORE_CONTACTS)):
+                entity_id += 1
+                individual = number < customers
+                persons.append(_person(rng, entity_id, "IN" if individual else "SC", first))
+                customer_id = FIRST_CUSTOMER_ID + number
+                customer_rows.append((customer_id, entity_id))
+                (city, state_id) = rng.choice(city_states)
+                addresses.append((entity_id, city, state_id, _stamp(first)))
+                links.append((entity_id, entity_id, 2, _stamp(first)))
+                if individual:
+                    orders.extend(_orders(rng, customer_id, first, last, now))
+            _insert(connection, "Person_Person", persons, 9)
+            _insert(connection, "Sales_Customer", customer_rows, 2)
+            _insert(connection, "Person_Address", addresses, 4)
+            _insert(connection, "Person_BusinessEntityAddress", links, 4)
+            connection.executemany(
+                "INSERT INTO Sales_SalesOrderHeader (CustomerID, OrderDate, Status, SubTotal, ModifiedDate) VALUES (?, ?, ?, ?, ?)",
+                orders,
+            )
+    logger.info("Generated %s customers over %s cities into %s", customers, cities, path)
+    connection.close()
+
+
+def modify(path: str, fraction: float, seed: int = 43, now: datetime.datetime | None = None) -> dict:
+    # Change about fraction of the extract, everything modified as of now:
+    # - that share of the orders get a new SubTotal
+    # - that share of the customers place a new order in the week after the latest one
+    # - that share of new customers, with their person, address and an order
+    # - that share of the persons get new Demographics, and of the addresses move to another city
+    # Returns the number of rows changed per table.
+    now = now or datetime.datetime.now().replace(microsecond=0)
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    changed = {}
+    with connection:
+        (orders, customers, persons, cities, last_customer, last_entity, latest_order) = connection.execute(
+            """
+SELECT (SELECT COUNT(*) FROM Sales_SalesOrderHeader), (SELECT COUNT(*) FROM Sales_Customer),
+    (SELECT COUNT(*) FROM Person_Person), (SELECT COUNT(*) FROM Person_Address),
+    (SELECT MAX(CustomerID) FROM Sales_Customer), (SELECT MAX(BusinessEntityID) FROM Person_Person),
+    (SELECT MAX(OrderDate) FROM Sales_SalesOrderHeader)"""
+        ).fetchone()
+
+        def count(total: int) -> int:
+            return max(1, int(total * fraction))
+
+        cursor = connection.execute(
+            "UPDATE Sales_SalesOrderHeader SET SubTotal = ROUND(SubTotal * ?, 4), ModifiedDate = ? WHERE SalesOrderID IN (SELECT SalesOrderID FROM Sales_SalesOrderHeader ORDER BY random() LIMIT ?)",
+            (rng.uniform(0.5, 1.5), _stamp(now), count(orders)),
+        )
+        changed["orders updated"] = cursor.rowcount
+
+        (ids,) = zip(*connection.execute(
+            "SELECT c.CustomerID FROM Sales_Customer AS c JOIN Person_Person AS p ON p.BusinessEntityID = c.PersonID WHERE p.PersonType = 'IN' ORDER BY random() LIMIT ?",
+            (count(customers),),
+        ))
+        # Modified now, so the next incremental load sees all of them.
+        order_start = datetime.datetime.fromisoformat(latest_order) + datetime.timedelta(hours=1)
+        order_end = order_start + datetime.timedelta(days=7)
+        new_orders = [row for customer_id in ids for row in _orders(rng, customer_id, order_start, order_end, now, now)]
+
+        (city, state_id) = connection.execute("SELECT City, StateProvinceID FROM Person_Address ORDER BY random() LIMIT 1").fetchone()
+        new_customers = count(customers)
+        persons_rows, customer_rows, addresses, links = [], [], [], []
+        for number in range(new_customers):
+            entity_id = last_entity + number + 1
+            customer_id = last_customer + number + 1
+            persons_rows.append(_person(rng, entity_id, "IN", now))
+            customer_rows.append((customer_id, entity_id))
+            addresses.append((entity_id, city, state_id, _stamp(now)))
+            links.append((entity_id, entity_id, 2, _stamp(now)))
+            new_orders.extend(_orders(rng, customer_id, order_start, order_end, now, now))
+        _insert(connection, "Person_Person", persons_rows, 9)
+        _insert(connection, "Sales_Customer", customer_rows, 2)
+        _insert(connection, "Person_Address", addresses, 4)
+        _insert(connection, "Person_BusinessEntityAddress", links, 4)
+        connection.executemany(
+            "INSERT INTO Sales_SalesOrderHeader (CustomerID, OrderDate, Status, SubTotal, ModifiedDate) VALUES (?, ?, ?, ?, ?)",
+            new_orders,
+        )
+        changed["orders inserted"] = len(new_orders)
+        changed["customers inserted"] = new_customers
+
+        (entity_ids,) = zip(*connection.execute(
+            "SELECT BusinessEntityID FROM Person_Person WHERE PersonType = 'IN' ORDER BY random() LIMIT ?",
+            (count(persons),),
+        ))
+        connection.executemany(
+            "UPDATE Person_Person SET Demographics = ?, ModifiedDate = ? WHERE BusinessEntityID = ?",
+            ((individual_survey(rng), _stamp(now), entity_id) for entity_id in entity_ids),
+        )
+        changed["persons updated"] = len(entity_ids)
+
+        (city, state_id) = connection.execute("SELECT City, StateProvinceID FROM Person_Address ORDER BY random() LIMIT 1").fetchone()
+        cursor = connection.execute(
+            "UPDATE Person_Address SET City = ?, StateProvinceID = ?, ModifiedDate = ? WHERE AddressID IN (SELECT AddressID FROM Person_Address ORDER BY random() LIMIT ?)",
+            (city, state_id, _stamp(now), count(cities)),
+        )
+        changed["addresses updated"] = cursor.rowcount
+    connection.close()
+    logger.info("Modified %s: %s", path, changed)
+    return changed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2:
+        print("Usage: python etl/bench_generate.py <path> [scale] | <path> --modify [fraction]")
+    elif sys.argv[2:3] == ["--modify"]:
+        modify(sys.argv[1], float(sys.argv[3]) if len(sys.argv) > 3 else 0.05)
+    else:
+        generate(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1)
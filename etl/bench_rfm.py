@@ -0,0 +1,104 @@
+# Benchmark of the RFM scoring: the CASE expressions of TRANSACTION_SQL, one month at a time,
+# against rfm.RFMScorer over the whole batch. Checks that both produce the same scores.
+#
+#   python etl/bench_rfm.py [months]
+#       On generated month aggregates, the CASE expressions ported to Python as the reference.
+#   python etl/bench_rfm.py --source [customers]
+#       On the source database: the per-customer TRANSACTION_SQL path against
+#       BULK_ORDER_AGGREGATE_SQL + RFMScorer, for the first customers.
+import calendar
+import datetime
+from decimal import Decimal, ROUND_HALF_UP
+import random
+import sys
+import time
+
+from rfm import RFMScorer
+
+
+def month_aggregate(rng: random.Random, customer_id: int) -> tuple:
+    # A BULK_ORDER_AGGREGATE_SQL row.
+    year = 2011 + rng.randrange(4)
+    month = 1 + rng.randrange(12)
+    latest = datetime.datetime(year, month, 1 + rng.randrange(calendar.monthrange(year, month)[1]), rng.randrange(24))
+    count = rng.choice([1, 1, 1, 2, 2, 3, 4, 5, 7])
+    # Around the monetary edges now and then, cents included.
+    total = Decimal(rng.choice([rng.uniform(1, 5000), rng.choice([299.99, 300, 999.4999, 999.5, 2999.5])])).quantize(Decimal("0.0001")) * count
+    return (customer_id, year, month, count, total, latest, latest + datetime.timedelta(days=1))
+
+
+def sql_score(row) -> tuple:
+    # TRANSACTION_SQL, one row at a time, with T-SQL semantics: integer division truncates,
+    # money / int keeps four decimals, CAST(money AS INT) rounds.
+    (customer_id, year, month, count, total, latest, modified) = row
+    last_day = calendar.monthrange(year, month)[1]
+    weeks = int((last_day - latest.day - 1) / 7)
+    recency = 5 - max(weeks, 0)
+    frequency = 5 if count >= 5 else min(4, count + 1)
+    average = (total / count).quantize(Decimal("0.0001"), rounding=ROUND_HALF_UP)
+    if average < 300:
+        monetary = 1
+    else:
+        monetary = min(2 + int(average.quantize(Decimal("1"), rounding=ROUND_HALF_UP)) // 1000, 5)
+    return (customer_id, year, month, last_day, recency, frequency, monetary, modified)
+
+
+def _timed(label: str, count: int, function):
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<40} {elapsed:8.3f}s {count / elapsed:12.0f} rows/s")
+    return result
+
+
+def bench_generated(count: int):
+    rng = random.Random(42)
+    rows = [month_aggregate(rng, customer_id) for customer_id in range(count)]
+    scorer = RFMScorer()
+
+    reference = _timed("CASE expressions, row by row", count, lambda: [sql_score(row) for row in rows])
+    vectorized = _timed("RFMScorer.score_rows", count, lambda: scorer.score_rows(rows))
+
+    assert vectorized == reference, "RFMScorer differs from the SQL scores"
+    print("RFMScorer matches the SQL scores.")
+
+
+def bench_source(customers: int):
+    from connection import connect_mssql
+    from load_fact import BULK_ORDER_AGGREGATE_SQL, TRANSACTION_SQL
+
+    watermark = datetime.date(1753, 1, 1)
+    with connect_mssql() as mssql_conn:
+        with mssql_conn.cursor() as ms_cur:
+            ms_cur.execute(
+                "SELECT DISTINCT TOP (%s) CustomerID FROM Sales.SalesOrderHeader ORDER BY CustomerID",
+                (customers,),
+            )
+            ids = [row[0] for row in ms_cur.fetchall()]
+
+            def per_customer():
+                rows = []
+                for customer_id in ids:
+                    ms_cur.execute(TRANSACTION_SQL, (watermark, customer_id))
+                    rows.extend(ms_cur.fetchall())
+                return rows
+
+            def vectorized():
+                ms_cur.execute(BULK_ORDER_AGGREGATE_SQL, (watermark, ids[0], ids[-1]))
+                return RFMScorer().score_rows(ms_cur.fetchall())
+
+            reference = _timed("TRANSACTION_SQL, per customer", len(ids), per_customer)
+            scored = _timed("BULK_ORDER_AGGREGATE_SQL + RFMScorer", len(ids), vectorized)
+
+    # TRANSACTION_SQL is ordered by month first, compare per customer and month.
+    assert sorted(scored, key=lambda row: row[:3]) == sorted(
+        (tuple(row) for row in reference), key=lambda row: row[:3]
+    ), "RFMScorer differs from TRANSACTION_SQL"
+    print("RFMScorer matches TRANSACTION_SQL.")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--source"]:
+        bench_source(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+    else:
+        bench_generated(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
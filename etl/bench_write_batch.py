@@ -0,0 +1,92 @@
+# Micro-benchmark of the row-level warehouse writes (write_batch.py): single-row upserts and
+# updates sent one at a time and waiting for each result, as the loaders did, against the same
+# statements in a WriteBatch (pipelined, prepared) and as executemany. Runs in a temporary table
+# shaped like dimtime on the warehouse of .env, nothing is kept. Checks that all three leave the
+# same rows.
+#
+#   python etl/bench_write_batch.py [statements]
+import sys
+import time
+
+from connection import connect_pg
+from write_batch import write_batch
+
+BENCH_TABLE_SQL = """
+CREATE TEMPORARY TABLE bench_dimtime (
+    timekey INTEGER PRIMARY KEY,
+    "Day" SMALLINT NOT NULL,
+    "Month" SMALLINT NOT NULL,
+    "Year" SMALLINT NOT NULL
+)"""
+INSERT_SQL = """
+INSERT INTO bench_dimtime (timekey, "Day", "Month", "Year")
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (timekey) DO NOTHING"""
+UPDATE_SQL = 'UPDATE bench_dimtime SET "Day" = %s WHERE timekey = %s'
+
+
+def _rows(count: int) -> tuple[list[tuple], list[tuple]]:
+    # count / 2 inserts, a tenth of them conflicting, then an update of every inserted row.
+    inserts = [(key, key % 28 + 1, key % 12 + 1, 2000 + key % 15) for key in range(count // 2)]
+    inserts += inserts[: len(inserts) // 10]
+    updates = [(key % 28 + 2, key) for key in range(count - len(inserts))]
+    return inserts, updates
+
+
+def _synchronous(pg_conn, inserts, updates):
+    with pg_conn.cursor() as pg_cur:
+        for row in inserts:
+            pg_cur.execute(INSERT_SQL, row)
+        for row in updates:
+            pg_cur.execute(UPDATE_SQL, row)
+
+
+def _write_batch(pg_conn, inserts, updates):
+    with pg_conn.cursor() as pg_cur, write_batch(pg_cur, "benchmark") as batch:
+        for row in inserts:
+            batch.execute(INSERT_SQL, row)
+        for row in updates:
+            batch.execute(UPDATE_SQL, row)
+
+
+def _executemany(pg_conn, inserts, updates):
+    with pg_conn.cursor() as pg_cur:
+        pg_cur.executemany(INSERT_SQL, inserts)
+        pg_cur.executemany(UPDATE_SQL, updates)
+
+
+def _timed(pg_conn, label: str, count: int, function, inserts, updates) -> list[tuple]:
+    with pg_conn.cursor() as pg_cur:
+        pg_cur.execute("TRUNCATE bench_dimtime")
+    pg_conn.commit()
+    started = time.perf_counter()
+    function(pg_conn, inserts, updates)
+    pg_conn.commit()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<36} {elapsed:8.3f}s {count / elapsed:12.0f} statements/s")
+    with pg_conn.cursor() as pg_cur:
+        pg_cur.execute("SELECT * FROM bench_dimtime ORDER BY timekey")
+        return pg_cur.fetchall()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    inserts, updates = _rows(count)
+    count = len(inserts) + len(updates)
+    with connect_pg() as pg_conn:
+        with pg_conn.cursor() as pg_cur:
+            pg_cur.execute(BENCH_TABLE_SQL)
+        pg_conn.commit()
+
+        reference = _timed(pg_conn, "one statement at a time", count, _synchronous, inserts, updates)
+        results = [
+            _timed(pg_conn, "write_batch (pipelined, prepared)", count, _write_batch, inserts, updates),
+            _timed(pg_conn, "executemany", count, _executemany, inserts, updates),
+        ]
+
+    assert all(result == reference for result in results), "batched writes left different rows"
+    print("All write paths leave the same rows.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+from logging import getLogger
+import psycopg
+
+logger = getLogger(__name__)
+
+
+class BulkUpserter:
+    # Adds the members of a batch that a dimension does not have yet, in one round of
+    # COPY into a session temp table + one set-based INSERT, instead of a SELECT and a
+    # conditional INSERT per row.
+    # Rows are compared on every inserted column, with NULLs equal to each other (EXCEPT),
+    # duplicates within the batch are dropped, and the unique index on the natural key of
+    # the dimension (see warehouse_schema.sql) turns a concurrent insert of the same member
+    # into a no-op.
+
+    def __init__(self, table: str, columns: tuple[str, ...], key_column: str | None = None):
+        self.table = table
+        self.columns = columns
+        self.key_column = key_column
+        self.stage = f"stage_{table}"
+
+        column_list = ", ".join(columns)
+        self._stage_sql = f"CREATE TEMPORARY TABLE IF NOT EXISTS {self.stage} AS SELECT {column_list} FROM {table} WITH NO DATA"
+        self._copy_sql = f"COPY {self.stage} ({column_list}) FROM STDIN"
+        self._insert_sql = (
+            f"INSERT INTO {table} ({column_list}) "
+            f"SELECT {column_list} FROM {self.stage} EXCEPT SELECT {column_list} FROM {table} "
+            "ON CONFLICT DO NOTHING"
+        )
+        if key_column is not None:
+            self._insert_sql += f" RETURNING {column_list}, {key_column}"
+
+    def upsert(self, pg_cur: psycopg.Cursor, rows) -> dict:
+        # Returns {row: surrogate key} of the newly inserted members, if the dimension has a key column.
+        pg_cur.execute(self._stage_sql)
+        staged = 0
+        with pg_cur.copy(self._copy_sql) as copy:
+            for row in rows:
+                copy.write_row(row)
+                staged += 1
+
+        inserted = {}
+        if staged > 0:
+            pg_cur.execute(self._insert_sql)
+            if self.key_column is not None:
+                for row in pg_cur.fetchall():
+                    inserted[tuple(row[:-1])] = row[-1]
+            logger.info("Upserted %s rows into %s, %s new", staged, self.table, pg_cur.rowcount)
+
+        pg_cur.execute(f"TRUNCATE {self.stage}")
+        return inserted
+
+
+TIME_UPSERTER = BulkUpserter("dimtime", ("timekey", '"Day"', '"Month"', '"Year"'))
+GEOGRAPHIC_UPSERTER = BulkUpserter(
+    "dimgeographic",
+    ("cityname", "stateprovincename", "countryregionname", "territoryname"),
+    "geographickey",
+)
+DEMOGRAPHIC_UPSERTER = BulkUpserter(
+    "dimdemographic",
+    (
+        "maritalstatus",
+        "ageband",
+        "yearlyincomelevel",
+        "numbercarsowned",
+        "education",
+        "occupation",
+        "ishomeowner",
+    ),
+    "demographickey",
+)
+# Every change of a customer's attributes is a new version of the customer.
+CUSTOMER_UPSERTER = BulkUpserter(
+    "dimcustomer", ("customerid", "name", "gender", "emailpromotiontype"), "customerkey"
+)
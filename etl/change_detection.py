@@ -0,0 +1,155 @@
+import calendar
+import datetime
+from logging import getLogger
+import psycopg
+
+from connection import SourceCursor
+
+logger = getLogger(__name__)
+
+# The latest ModifiedDate of every source table the incremental loaders read, in one round-trip,
+# each over the rows its loader reads (individual customers, their home address, orders that are
+# not cancelled), so it is comparable with the watermark the loader keeps in etlmeta_tabletimestamp.
+# Also the range of the customers with an order changed since the fact watermark (%s twice),
+# cancelled or not as in TRANSACTION_SQL, which is all the fact load has to walk.
+SOURCE_WATERMARKS_SQL = """
+SELECT
+    orders.SalesOrderHeader,
+    persons.Person,
+    addresses.BusinessEntityAddress,
+    addresses.Address,
+    addresses.StateProvince,
+    addresses.SalesTerritory,
+    orders.FirstChangedCustomerID,
+    orders.LastChangedCustomerID
+FROM (
+    SELECT
+        SalesOrderHeader = MAX(CASE WHEN header.Status != 6 THEN header.ModifiedDate END),
+        FirstChangedCustomerID = MIN(CASE WHEN header.ModifiedDate > %s THEN header.CustomerID END),
+        LastChangedCustomerID = MAX(CASE WHEN header.ModifiedDate > %s THEN header.CustomerID END)
+    FROM Sales.SalesOrderHeader AS header
+        JOIN Sales.Customer AS c ON c.CustomerID = header.CustomerID
+        JOIN Person.Person AS p ON p.BusinessEntityID = c.PersonID
+    WHERE p.PersonType = 'IN'
+) AS orders
+CROSS JOIN (
+    SELECT Person = MAX(person.ModifiedDate)
+    FROM Person.Person AS person
+        JOIN Sales.Customer AS customer ON person.BusinessEntityID = customer.PersonID
+    WHERE person.PersonType = 'IN'
+) AS persons
+CROSS JOIN (
+    SELECT
+        BusinessEntityAddress = MAX(person_address.ModifiedDate),
+        Address = MAX(address_data.ModifiedDate),
+        StateProvince = MAX(state_data.ModifiedDate),
+        SalesTerritory = MAX(territory_data.ModifiedDate)
+    FROM Person.Person AS person
+        JOIN Person.BusinessEntityAddress AS person_address ON person.BusinessEntityID = person_address.BusinessEntityID
+        JOIN Person.Address AS address_data ON person_address.AddressID = address_data.AddressID
+        JOIN Person.StateProvince AS state_data ON state_data.StateProvinceID = address_data.StateProvinceID
+        JOIN Person.CountryRegion AS country_data ON state_data.CountryRegionCode = country_data.CountryRegionCode
+        JOIN Sales.SalesTerritory AS territory_data ON state_data.TerritoryID = territory_data.TerritoryID
+    WHERE person.BusinessEntityID IN (
+        SELECT p.BusinessEntityID
+        FROM Person.Person AS p
+            JOIN Sales.Customer AS c ON c.PersonID = p.BusinessEntityID
+        WHERE p.PersonType = 'IN'
+    ) AND person_address.AddressTypeID = 2
+) AS addresses"""
+SOURCE_TABLES = ("SalesOrderHeader", "Person", "BusinessEntityAddress", "Address", "StateProvince", "SalesTerritory")
+# Dimension stage -> the source tables whose ModifiedDate its incremental query filters on.
+# The fact stage goes by the changed customers instead.
+STAGE_TABLES = {
+    "time": ("SalesOrderHeader",),
+    "geographic": ("BusinessEntityAddress", "Address", "StateProvince", "SalesTerritory"),
+    "customer_demographic": ("Person",),
+}
+# Every source table the loaders read, and a version of each that moves with any change to it:
+# the latest ModifiedDate, and the row count for the deletes. Keys the extract cache.
+VERSIONED_TABLES = (
+    "Sales.SalesOrderHeader",
+    "Sales.Customer",
+    "Person.Person",
+    "Person.BusinessEntityAddress",
+    "Person.Address",
+    "Person.StateProvince",
+    "Person.CountryRegion",
+    "Sales.SalesTerritory",
+)
+SOURCE_VERSIONS_SQL = "SELECT\n" + ",\n".join(
+    f"    (SELECT MAX(ModifiedDate) FROM {table}), (SELECT COUNT_BIG(*) FROM {table})" for table in VERSIONED_TABLES
+)
+# An unfinished fact load must be resumed, and a new run month rolled forward to, orders changed or not.
+FACT_STATE_SQL = """
+SELECT
+    (SELECT batchid FROM etlmeta_factload) IS NOT NULL OR EXISTS (SELECT 1 FROM etlmeta_factloadrange),
+    (SELECT MAX(snapshotdatekey) FROM factcustomermonthlysnapshot)"""
+# Same default as load_fact's, the earliest SQL Server datetime.
+NO_WATERMARK = datetime.datetime(1753, 1, 1)
+
+
+class Changes:
+    # What an incremental run has to do, from the source watermarks and the warehouse's.
+
+    def __init__(self, changed_stages: set[str], customer_range: tuple[int, int] | None):
+        self.changed_stages = changed_stages
+        # (first, last) CustomerID with a changed order, None to walk every customer.
+        self.customer_range = customer_range
+
+    def changed(self, stage: str) -> bool:
+        return stage in self.changed_stages
+
+
+def detect_changes(
+    ms_cur: SourceCursor,
+    pg_cur: psycopg.Cursor,
+    table_keys: dict[str, int],
+    run_date: datetime.date,
+    roll_forward: bool,
+) -> Changes:
+    # Compare the source with the watermarks of etlmeta_tabletimestamp (table_keys: stage -> tablekey).
+    # A stage with no watermark yet counts as changed.
+    pg_cur.execute("SELECT tablekey, modifieddate FROM etlmeta_tabletimestamp")
+    stored = dict(pg_cur.fetchall())
+    watermarks = {stage: stored.get(key) for stage, key in table_keys.items()}
+    fact_watermark = watermarks.get("fact") or NO_WATERMARK
+
+    ms_cur.execute(SOURCE_WATERMARKS_SQL, (fact_watermark, fact_watermark))
+    row = ms_cur.fetchone()
+    latest = dict(zip(SOURCE_TABLES, row[: len(SOURCE_TABLES)]))
+    (first_changed, last_changed) = row[len(SOURCE_TABLES):]
+
+    changed_stages = set()
+    for stage, tables in STAGE_TABLES.items():
+        watermark = watermarks.get(stage)
+        if watermark is None or any(
+            latest[table] is not None and latest[table] > watermark for table in tables
+        ):
+            changed_stages.add(stage)
+
+    pg_cur.execute(FACT_STATE_SQL)
+    (unfinished, latest_snapshot) = pg_cur.fetchone()
+    run_month = run_date.year * 10000 + run_date.month * 100 + calendar.monthrange(run_date.year, run_date.month)[1]
+    if watermarks.get("fact") is None or unfinished:
+        # Nothing to narrow to, walk every customer as before.
+        changed_stages.add("fact")
+        customer_range = None
+    else:
+        # An empty range when only the roll-forward is left to do.
+        customer_range = (first_changed, last_changed) if first_changed is not None else (1, 0)
+        if first_changed is not None or (roll_forward and (latest_snapshot or 0) < run_month):
+            changed_stages.add("fact")
+
+    for stage in (*STAGE_TABLES, "fact"):
+        logger.info("%s: %s", stage, "changed" if stage in changed_stages else "unchanged, skipping")
+    if customer_range is not None and first_changed is not None:
+        logger.info("Orders changed for customers %s to %s", first_changed, last_changed)
+    return Changes(changed_stages, customer_range)
+
+
+def source_versions(ms_cur: SourceCursor) -> dict[str, tuple]:
+    # Table -> (latest ModifiedDate, rows), see SOURCE_VERSIONS_SQL.
+    ms_cur.execute(SOURCE_VERSIONS_SQL)
+    row = ms_cur.fetchone()
+    return {table: tuple(row[2 * number:2 * number + 2]) for number, table in enumerate(VERSIONED_TABLES)}
@@ -0,0 +1,85 @@
+from os import getenv
+from dotenv import load_dotenv
+
+# Configurations
+load_dotenv()
+MSSQL_SERVER = getenv("MSSQL_SERVER", "localhost")
+MSSQL_DB = getenv("MSSQL_DB", "CompanyX")
+MSSQL_APP_ACC = getenv("MSSQL_APP_ACC")
+MSSQL_APP_PASS = getenv("MSSQL_APP_PASS")
+POSTGRES_SERVER = "localhost"
+POSTGRES_DB = "companyxwarehouse"
+POSTGRES_APP_ACC = getenv("POSTGRES_APP_ACC")
+POSTGRES_APP_PASS = getenv("POSTGRES_APP_PASS")
+
+# Rows fetched from the source per round-trip when streaming a result set.
+ETL_FETCH_CHUNK_SIZE = int(getenv("ETL_FETCH_CHUNK_SIZE", "5000"))
+# Also trace the peak Python memory of every stage (slower).
+ETL_TRACE_MEMORY = getenv("ETL_TRACE_MEMORY", "0") == "1"
+
+# Number of chunks buffered between two pipeline stages before the upstream stage blocks.
+ETL_PIPELINE_QUEUE_SIZE = int(getenv("ETL_PIPELINE_QUEUE_SIZE", "4"))
+
+# Parsed Demographics documents kept in memory, by content hash.
+ETL_DEMOGRAPHIC_CACHE_SIZE = int(getenv("ETL_DEMOGRAPHIC_CACHE_SIZE", "200000"))
+# Processes used to parse large batches of Demographics documents. 0 parses them in the loader.
+ETL_DEMOGRAPHIC_PROCESSES = int(getenv("ETL_DEMOGRAPHIC_PROCESSES", "0"))
+# Smallest number of unparsed documents worth sending to the process pool.
+ETL_DEMOGRAPHIC_POOL_THRESHOLD = int(getenv("ETL_DEMOGRAPHIC_POOL_THRESHOLD", "2000"))
+
+# Number of dimensions loaded concurrently, each on its own connections.
+ETL_DIMENSION_WORKERS = int(getenv("ETL_DIMENSION_WORKERS", "3"))
+
+# Fact load parallelism. One worker keeps the original, serial fact load.
+ETL_FACT_WORKERS = int(getenv("ETL_FACT_WORKERS", "1"))
+# Number of customer ID ranges the fact load is split into, per worker.
+ETL_FACT_RANGES_PER_WORKER = int(getenv("ETL_FACT_RANGES_PER_WORKER", "4"))
+# Work queue mode: the ranges are claimed from etlmeta_factloadrange, so other machines can load
+# them too (python etl/main.py --fact-worker). A claim is leased for ETL_FACT_LEASE_SECONDS and
+# renewed by every batch, a range whose lease ran out is claimed again by another worker.
+ETL_FACT_QUEUE = getenv("ETL_FACT_QUEUE", "0") == "1"
+ETL_FACT_LEASE_SECONDS = int(getenv("ETL_FACT_LEASE_SECONDS", "600"))
+# How often a worker with nothing to claim checks the queue again, until every range is finished.
+ETL_FACT_QUEUE_POLL_SECONDS = float(getenv("ETL_FACT_QUEUE_POLL_SECONDS", "10"))
+# Customers per fact load batch (one commit each). The size starts at ETL_FACT_BATCH_SIZE and is
+# adjusted within [MIN, MAX] from the throughput and commit latency of the batches, see batch_size.py.
+# MIN = MAX fixes it.
+ETL_FACT_BATCH_SIZE = int(getenv("ETL_FACT_BATCH_SIZE", "500"))
+ETL_FACT_BATCH_SIZE_MIN = int(getenv("ETL_FACT_BATCH_SIZE_MIN", "100"))
+ETL_FACT_BATCH_SIZE_MAX = int(getenv("ETL_FACT_BATCH_SIZE_MAX", "5000"))
+# Commits slower than this, in seconds, halve the batch size.
+ETL_FACT_COMMIT_TARGET = float(getenv("ETL_FACT_COMMIT_TARGET", "1.0"))
+# Incremental fact loads carry the previous month's snapshot forward in one set-based pass, instead of
+# re-walking the history of every changed customer. 0 keeps the full walk.
+ETL_FACT_ROLL_FORWARD = getenv("ETL_FACT_ROLL_FORWARD", "1") == "1"
+# Incremental runs first compare the latest ModifiedDate of the source tables with the watermarks,
+# and skip the stages with nothing new. 0 runs every stage.
+ETL_CHANGE_DETECTION = getenv("ETL_CHANGE_DETECTION", "1") == "1"
+# Snapshot months recomputed concurrently by python etl/main.py --backfill, each on its own connections.
+ETL_BACKFILL_WORKERS = int(getenv("ETL_BACKFILL_WORKERS", "4"))
+# The initial fact load drops the fact table's secondary indexes and foreign keys, and rebuilds them
+# once the facts are loaded. 0 loads with them in place.
+ETL_INITIAL_DEFER_CONSTRAINTS = getenv("ETL_INITIAL_DEFER_CONSTRAINTS", "1") == "1"
+# Number of connections the deferred indexes are rebuilt on, side by side.
+ETL_INDEX_BUILD_WORKERS = int(getenv("ETL_INDEX_BUILD_WORKERS", "2"))
+# Where the RFM scores of the bulk fact load are computed: "sql" in TRANSACTION_SQL, "python" with
+# the same rules in the ETL (rfm.py), "quantile" with edges at the quantiles of every customer month.
+ETL_RFM_SCORING = getenv("ETL_RFM_SCORING", "sql")
+
+# Instrumentation. Every run is recorded in etlmeta_runhistory, and appended to this file if set.
+ETL_RUN_HISTORY_JSON = getenv("ETL_RUN_HISTORY_JSON", "")
+# Comma separated stage names to run under cProfile, or "all".
+ETL_PROFILE_STAGES = [stage for stage in getenv("ETL_PROFILE_STAGES", "").split(",") if stage]
+ETL_PROFILE_DIR = getenv("ETL_PROFILE_DIR", "profiles")
+
+# Local cache of source result sets, read back by resumed and repeated runs. Empty disables it.
+ETL_EXTRACT_CACHE_DIR = getenv("ETL_EXTRACT_CACHE_DIR", "")
+# Least recently used entries are evicted beyond this size.
+ETL_EXTRACT_CACHE_MAX_MB = int(getenv("ETL_EXTRACT_CACHE_MAX_MB", "2048"))
+# Smaller result sets are cheaper to query again than to keep.
+ETL_EXTRACT_CACHE_MIN_ROWS = int(getenv("ETL_EXTRACT_CACHE_MIN_ROWS", "100"))
+
+# Where the loaders read the source from: SQL Server (mssql), or a local SQLite extract of it (local)
+# at ETL_LOCAL_SOURCE_PATH, see etl/local_source.py.
+ETL_SOURCE = getenv("ETL_SOURCE", "mssql")
+ETL_LOCAL_SOURCE_PATH = getenv("ETL_LOCAL_SOURCE_PATH", "dataset/companyx.sqlite")
@@ -0,0 +1,133 @@
+from contextlib import contextmanager
+from logging import getLogger
+import queue
+import threading
+from typing import Protocol
+import psycopg
+import pymssql
+
+from config import (
+    MSSQL_APP_ACC,
+    MSSQL_APP_PASS,
+    MSSQL_DB,
+    MSSQL_SERVER,
+    ETL_LOCAL_SOURCE_PATH,
+    ETL_SOURCE,
+    POSTGRES_APP_ACC,
+    POSTGRES_APP_PASS,
+    POSTGRES_DB,
+    POSTGRES_SERVER,
+)
+
+logger = getLogger(__name__)
+
+
+class SourceCursor(Protocol):
+    # What the loaders use of a source cursor: the DB-API calls of pymssql, with its %s and
+    # %(name)s parameters, on the queries of the load_* modules. Implemented by pymssql, and by
+    # local_source.LocalCursor.
+
+    def execute(self, query: str, params=None): ...
+
+    def fetchone(self): ...
+
+    def fetchmany(self, size: int = 1) -> list: ...
+
+    def fetchall(self) -> list: ...
+
+
+def connect_source():
+    # A connection to the source of ETL_SOURCE, used as a context manager, with a cursor() of its own.
+    if ETL_SOURCE == "local":
+        # Imported here, local_source imports the loaders for their queries.
+        from local_source import connect_local
+
+        return connect_local(ETL_LOCAL_SOURCE_PATH)
+    if ETL_SOURCE != "mssql":
+        raise ValueError(f"Unknown ETL_SOURCE {ETL_SOURCE}, expected mssql or local")
+    return connect_mssql()
+
+
+def connect_mssql() -> pymssql.Connection:
+    return pymssql.connect(
+        server=MSSQL_SERVER,
+        user=MSSQL_APP_ACC,
+        password=MSSQL_APP_PASS,
+        database=MSSQL_DB,
+    )
+
+
+def connect_pg() -> psycopg.Connection:
+    return psycopg.connect(
+        f"host={POSTGRES_SERVER} port=5432 dbname={POSTGRES_DB} user={POSTGRES_APP_ACC} password={POSTGRES_APP_PASS}"
+    )
+
+
+class ConnectionPool:
+    # Pool of (source, warehouse) connection pairs, one pair per concurrent worker.
+    # Pairs are opened on demand, up to size, and reused afterwards.
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = []
+        self._lock = threading.Lock()
+        self._available = threading.Semaphore(size)
+
+    def _open(self):
+        mssql_conn = connect_source()
+        try:
+            pg_conn = connect_pg()
+        except BaseException:
+            mssql_conn.close()
+            raise
+        pair = (mssql_conn, pg_conn)
+        with self._lock:
+            self._opened.append(pair)
+        return pair
+
+    def _discard(self, pair):
+        with self._lock:
+            self._opened.remove(pair)
+        for conn in pair:
+            try:
+                conn.close()
+            except Exception:
+                logger.exception("Could not close a discarded pooled connection")
+
+    @contextmanager
+    def connection(self):
+        self._available.acquire()
+        try:
+            try:
+                pair = self._idle.get_nowait()
+            except queue.Empty:
+                pair = self._open()
+
+            reusable = True
+            try:
+                yield pair
+            except BaseException:
+                # Do not hand a failed transaction to the next worker. A connection that cannot
+                # even roll back is broken: drop the pair, and keep the worker's own error.
+                try:
+                    pair[1].rollback()
+                except Exception:
+                    logger.exception("Could not roll back a failed worker's transaction, discarding its connections")
+                    reusable = False
+                raise
+            finally:
+                if reusable:
+                    self._idle.put(pair)
+                else:
+                    self._discard(pair)
+        finally:
+            self._available.release()
+
+    def close(self):
+        with self._lock:
+            for mssql_conn, pg_conn in self._opened:
+                mssql_conn.close()
+                pg_conn.close()
+            logger.info("Closed %s pooled connection pairs", len(self._opened))
+            self._opened = []
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+import psycopg
+
+from connection import connect_pg
+
+logger = getLogger(__name__)
+
+FACT_TABLE = "factcustomermonthlysnapshot"
+# Secondary indexes of the fact table. The primary key stays, the snapshot upsert relies on it.
+SECONDARY_INDEXES_SQL = """
+SELECT c.relname, pg_get_indexdef(i.indexrelid)
+FROM pg_index AS i
+    JOIN pg_class AS c ON c.oid = i.indexrelid
+WHERE i.indrelid = %s::regclass AND NOT i.indisprimary AND NOT i.indisunique"""
+# Foreign keys declared on the fact table itself, not their copies on the partitions.
+FOREIGN_KEYS_SQL = """
+SELECT conname, pg_get_constraintdef(oid)
+FROM pg_constraint
+WHERE conrelid = %s::regclass AND contype = 'f' AND conparentid = 0"""
+
+
+def defer_fact_constraints(pg_cur: psycopg.Cursor):
+    # Drop the secondary indexes and foreign keys of the fact table for a bulk load, remembering
+    # their definitions in etlmeta_deferredconstraint. The caller commits, so both happen together.
+    # Running it again, e.g. when an interrupted initial load resumes, keeps what was remembered.
+    deferred = []
+    pg_cur.execute(SECONDARY_INDEXES_SQL, (FACT_TABLE,))
+    deferred += [(name, "index", definition) for name, definition in pg_cur.fetchall()]
+    pg_cur.execute(FOREIGN_KEYS_SQL, (FACT_TABLE,))
+    deferred += [(name, "foreign key", definition) for name, definition in pg_cur.fetchall()]
+
+    for name, kind, definition in deferred:
+        pg_cur.execute(
+            "INSERT INTO etlmeta_deferredconstraint (name, kind, definition) VALUES (%s, %s, %s) ON CONFLICT (name) DO NOTHING",
+            (name, kind, definition),
+        )
+        if kind == "index":
+            pg_cur.execute(f"DROP INDEX IF EXISTS {name}")
+        else:
+            pg_cur.execute(f"ALTER TABLE {FACT_TABLE} DROP CONSTRAINT IF EXISTS {name}")
+
+    logger.info("Deferred %s indexes and foreign keys of %s", len(deferred), FACT_TABLE)
+
+
+def _build_index(name: str, definition: str):
+    # On its own connection, so the indexes are built side by side. Each build may also use
+    # Postgres' own parallel workers (max_parallel_maintenance_workers).
+    with connect_pg() as pg_conn:
+        with pg_conn.cursor() as pg_cur:
+            pg_cur.execute(definition.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1))
+            pg_cur.execute("DELETE FROM etlmeta_deferredconstraint WHERE name = %s", (name,))
+        pg_conn.commit()
+    logger.info("Rebuilt index %s", name)
+
+
+def restore_fact_constraints(pg_conn: psycopg.Connection, workers: int):
+    # Rebuild what defer_fact_constraints dropped. Every object is committed on its own, with its
+    # row in etlmeta_deferredconstraint removed, so an interrupted restore picks up where it stopped.
+    with pg_conn.cursor() as pg_cur:
+        pg_cur.execute("SELECT name, kind, definition FROM etlmeta_deferredconstraint ORDER BY name")
+        deferred = pg_cur.fetchall()
+    if len(deferred) == 0:
+        return
+
+    indexes = [(name, definition) for name, kind, definition in deferred if kind == "index"]
+    logger.info("Rebuilding %s indexes of %s on %s connections", len(indexes), FACT_TABLE, workers)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(_build_index, name, definition) for name, definition in indexes]:
+            future.result()
+
+    # Adding a foreign key locks out the others, validate them one at a time. Each is checked
+    # with a single join over the table, instead of a trigger call per inserted row.
+    with pg_conn.cursor() as pg_cur:
+        for name, kind, definition in deferred:
+            if kind != "foreign key":
+                continue
+
+            pg_cur.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = %s::regclass AND conname = %s)",
+                (FACT_TABLE, name),
+            )
+            if not pg_cur.fetchone()[0]:
+                pg_cur.execute(f"ALTER TABLE {FACT_TABLE} ADD CONSTRAINT {name} {definition}")
+            pg_cur.execute("DELETE FROM etlmeta_deferredconstraint WHERE name = %s", (name,))
+            pg_conn.commit()
+            logger.info("Validated foreign key %s", name)
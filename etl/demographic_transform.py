@@ -0,0 +1,262 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import hashlib
+from logging import getLogger
+import multiprocessing
+import re
+import threading
+from xml.sax.saxutils import unescape
+import xml.etree.ElementTree as ET
+
+from config import (
+    ETL_DEMOGRAPHIC_CACHE_SIZE,
+    ETL_DEMOGRAPHIC_POOL_THRESHOLD,
+    ETL_DEMOGRAPHIC_PROCESSES,
+)
+
+logger = getLogger(__name__)
+
+DEMOGRAPHIC_FIELDS = (
+    "MaritalStatus",
+    "BirthDate",
+    "YearlyIncome",
+    "NumberCarsOwned",
+    "Education",
+    "Occupation",
+    "HomeOwnerFlag",
+)
+# Every field we need from the Demographics document is a leaf element directly under the root,
+# so a single regex pass finds all of them, with or without a namespace prefix.
+FIELD_MATCHER = re.compile(
+    r"<(?:[\w.-]+:)?(" + "|".join(DEMOGRAPHIC_FIELDS + ("Gender",)) + r")>([^<]*)</"
+)
+GENDER_MATCHER = re.compile(r"<(?:[\w.-]+:)?Gender>([^<]*)</")
+BIRTH_DATE_MATCHER = re.compile(r"<(?:[\w.-]+:)?BirthDate>([^<]*)</")
+# Ages at which the age band changes, see age_band.
+AGE_BAND_BOUNDARIES = (26, 61)
+NAMESPACE_MATCHER = re.compile(r"\{(.*)\}")
+
+
+def _is_leap_year(year: int) -> bool:
+    return (year % 4 == 0 and year % 100 != 0) or year % 400 == 0
+
+
+def age_band(birth_date: datetime.date, today: datetime.date) -> str:
+    # A 29/02 birthday is celebrated on 01/03 in a non-leap year.
+    birthday = (birth_date.month, birth_date.day)
+    if birthday == (2, 29) and not _is_leap_year(today.year):
+        birthday = (3, 1)
+
+    age = today.year - birth_date.year - (0 if (today.month, today.day) >= birthday else 1)
+    return "<26" if age < 26 else ">60" if age > 60 else "26-60"
+
+
+def _birthday(birth_date: datetime.date, age: int) -> datetime.date:
+    year = birth_date.year + age
+    if (birth_date.month, birth_date.day) == (2, 29) and not _is_leap_year(year):
+        return datetime.date(year, 3, 1)
+    return birth_date.replace(year=year)
+
+
+def next_band_change(birth_date: datetime.date, today: datetime.date) -> datetime.date | None:
+    # The first day after today with another age band, None once past the last boundary.
+    for age in AGE_BAND_BOUNDARIES:
+        birthday = _birthday(birth_date, age)
+        if birthday > today:
+            return birthday
+    return None
+
+
+def demographic_from_fields(fields: dict, today: datetime.date) -> tuple:
+    # Turn the raw field text into a DimDemographic row.
+    # BirthDate is stored as e.g. 1966-04-08Z
+    birth_date = datetime.date.fromisoformat(fields["BirthDate"][:-1])
+
+    # Ranging number_cars_owned
+    number_cars_owned = int(fields["NumberCarsOwned"])
+    number_cars_owned = (
+        "0" if number_cars_owned == 0 else "3+" if number_cars_owned >= 3 else "1-2"
+    )
+
+    return (
+        fields["MaritalStatus"],
+        age_band(birth_date, today),
+        fields["YearlyIncome"],
+        number_cars_owned,
+        fields["Education"],
+        fields["Occupation"],
+        # Booleanize is_home_owner
+        fields["HomeOwnerFlag"] == "1",
+    )
+
+
+def extract_fields(xml: str) -> dict:
+    fields = {}
+    for match in FIELD_MATCHER.finditer(xml):
+        value = match.group(2)
+        fields[match.group(1)] = unescape(value) if "&" in value else value
+
+    if all(field in fields for field in DEMOGRAPHIC_FIELDS):
+        return fields
+
+    # Unusual document (CDATA, comments...), let a real XML parser handle it.
+    root = ET.fromstring(xml)
+    match = NAMESPACE_MATCHER.match(root.tag)
+    namespace = match.group(1) if match is not None else ""
+    fields = {}
+    for field in DEMOGRAPHIC_FIELDS + ("Gender",):
+        element = root.find(f"{{{namespace}}}{field}")
+        if element is not None:
+            fields[field] = element.text
+    return fields
+
+
+def _parse_uncached(xml: str, today: datetime.date) -> tuple:
+    return demographic_from_fields(extract_fields(xml), today)
+
+
+class DemographicTransformer:
+    # Demographics XML -> DimDemographic row, memoized by content hash with LRU eviction.
+    # The same document is seen by the customer loader and again by the fact load, and most
+    # persons share their document with nobody but themselves, so the memo is keyed on the
+    # content rather than on the BusinessEntityID: an edited document is never served stale.
+    # Results are interned, the few distinct rows are shared by every entry.
+    # Large batches can be spread over a process pool, see parse_many.
+
+    def __init__(
+        self,
+        today: datetime.date | None = None,
+        max_entries: int = ETL_DEMOGRAPHIC_CACHE_SIZE,
+        processes: int = ETL_DEMOGRAPHIC_PROCESSES,
+        pool_threshold: int = ETL_DEMOGRAPHIC_POOL_THRESHOLD,
+    ):
+        # The age band depends on the day, pin it for the whole run.
+        self.today = today or datetime.date.today()
+        self.max_entries = max_entries
+        self.processes = processes
+        self.pool_threshold = pool_threshold
+        self.hits = 0
+        self.misses = 0
+        self._memo = OrderedDict()
+        self._interned = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    @staticmethod
+    def _key(xml: str) -> bytes:
+        return hashlib.blake2b(xml.encode(), digest_size=16).digest()
+
+    def _remember(self, key: bytes, demographic: tuple) -> tuple:
+        # Caller holds the lock.
+        demographic = self._interned.setdefault(demographic, demographic)
+        self._memo[key] = demographic
+        if len(self._memo) > self.max_entries:
+            self._memo.popitem(last=False)
+        return demographic
+
+    def _lookup(self, key: bytes):
+        # Caller holds the lock.
+        demographic = self._memo.get(key)
+        if demographic is not None:
+            self._memo.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return demographic
+
+    def parse(self, xml: str) -> tuple:
+        key = self._key(xml)
+        with self._lock:
+            demographic = self._lookup(key)
+        if demographic is not None:
+            return demographic
+
+        # Parse outside the lock, the other pipeline stages keep going meanwhile.
+        demographic = _parse_uncached(xml, self.today)
+        with self._lock:
+            return self._remember(key, demographic)
+
+    def parse_many(self, xmls) -> list[tuple]:
+        # Same as [parse(xml) for xml in xmls], the misses of a large batch go to the process pool.
+        xmls = list(xmls)
+        keys = [self._key(xml) for xml in xmls]
+        results = [None] * len(xmls)
+        missing = {}
+
+        with self._lock:
+            for index, key in enumerate(keys):
+                results[index] = self._lookup(key)
+                if results[index] is None:
+                    missing.setdefault(key, index)
+
+        if len(missing) == 0:
+            return results
+
+        indexes = list(missing.values())
+        documents = [xmls[index] for index in indexes]
+        if self.processes > 0 and len(documents) >= self.pool_threshold:
+            parsed = list(
+                self._get_pool().map(
+                    _parse_uncached,
+                    documents,
+                    [self.today] * len(documents),
+                    chunksize=max(1, len(documents) // (self.processes * 4)),
+                )
+            )
+        else:
+            parsed = [_parse_uncached(xml, self.today) for xml in documents]
+
+        with self._lock:
+            remembered = {
+                keys[index]: self._remember(keys[index], demographic)
+                for index, demographic in zip(indexes, parsed)
+            }
+        return [
+            result if result is not None else remembered[key]
+            for result, key in zip(results, keys)
+        ]
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # The ETL runs several threads, do not fork them.
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def log_stats(self):
+        logger.info(
+            "Demographic transform: %s hits, %s misses, %s cached documents, %s distinct demographics",
+            self.hits,
+            self.misses,
+            len(self._memo),
+            len(self._interned),
+        )
+
+
+def parse_gender(xml: str):
+    match = GENDER_MATCHER.search(xml)
+    if match is not None:
+        return match.group(1)
+    return extract_fields(xml).get("Gender")
+
+
+def parse_birth_date(xml: str) -> datetime.date | None:
+    # BirthDate alone, for the birth date index of age_bands.
+    match = BIRTH_DATE_MATCHER.search(xml)
+    birth_date = match.group(1) if match is not None else extract_fields(xml).get("BirthDate")
+    if birth_date is None:
+        return None
+    return datetime.date.fromisoformat(birth_date[:-1])
+
+
+# Shared by every loader of the run, so the fact load reuses what the customer loader parsed.
+demographic_transformer = DemographicTransformer()
@@ -0,0 +1,95 @@
+from logging import getLogger
+import psycopg
+
+logger = getLogger(__name__)
+
+
+class DimensionKeyCache:
+    # Natural key -> surrogate key map of one dimension table, loaded once per run.
+    # The map is loaded lazily on the first lookup, so a cache created before the initial
+    # dimension COPY still sees every row that was loaded by the time the facts need it.
+    # Members inserted afterwards are either registered through add(), or picked up by the
+    # read-through query on a miss.
+
+    def __init__(self, table: str, key_column: str, natural_columns: tuple[str, ...]):
+        self.table = table
+        self.key_column = key_column
+        self.natural_columns = natural_columns
+        self.hits = 0
+        self.misses = 0
+        self._keys = None
+
+        columns = ", ".join(natural_columns)
+        self._load_sql = f"SELECT {columns}, {key_column} FROM {table} ORDER BY {key_column}"
+        # NULL is a legitimate natural key value (e.g. customers without a gender), match it as such.
+        self._lookup_sql = (
+            f"SELECT {key_column} FROM {table} WHERE "
+            + " AND ".join(f"{column} IS NOT DISTINCT FROM %s" for column in natural_columns)
+            + f" ORDER BY {key_column} DESC LIMIT 1"
+        )
+
+    def load(self, pg_cur: psycopg.Cursor):
+        self._keys = {}
+        pg_cur.execute(self._load_sql)
+        # Ordered by surrogate key, so a natural key with several versions resolves to the latest one.
+        for row in pg_cur:
+            self._keys[tuple(row[:-1])] = row[-1]
+        logger.info("Cached %s keys of %s", len(self._keys), self.table)
+
+    def lookup(self, pg_cur: psycopg.Cursor, natural_key):
+        if self._keys is None:
+            self.load(pg_cur)
+
+        natural_key = tuple(natural_key)
+        key = self._keys.get(natural_key)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        result = pg_cur.execute(self._lookup_sql, natural_key).fetchone()
+        if result is None:
+            return None
+
+        self._keys[natural_key] = result[0]
+        return result[0]
+
+    def invalidate(self):
+        # Bulk loads bypass the cache, drop the map so it is reloaded on the next lookup.
+        self._keys = None
+
+    def add(self, natural_key, key):
+        if self._keys is not None:
+            self._keys[tuple(natural_key)] = key
+
+
+class DimensionCaches:
+    # The caches used to resolve the fact table's foreign keys, shared by the loaders of a run.
+
+    def __init__(self):
+        self.geographic = DimensionKeyCache(
+            "dimgeographic",
+            "geographickey",
+            ("cityname", "stateprovincename", "countryregionname", "territoryname"),
+        )
+        self.demographic = DimensionKeyCache(
+            "dimdemographic",
+            "demographickey",
+            (
+                "maritalstatus",
+                "ageband",
+                "yearlyincomelevel",
+                "numbercarsowned",
+                "education",
+                "occupation",
+                "ishomeowner",
+            ),
+        )
+        # The fact table refers to the customer by its source ID only.
+        self.customer = DimensionKeyCache("dimcustomer", "customerkey", ("customerid",))
+
+    def log_stats(self):
+        for cache in (self.geographic, self.demographic, self.customer):
+            logger.info(
+                "Key cache %s: %s hits, %s misses", cache.table, cache.hits, cache.misses
+            )
@@ -0,0 +1,374 @@
+from array import array
+import datetime
+from decimal import Decimal
+import hashlib
+import json
+from logging import getLogger
+import mmap
+import os
+import pickle
+import re
+import struct
+import sys
+import threading
+
+from change_detection import VERSIONED_TABLES, source_versions
+from config import (
+    ETL_EXTRACT_CACHE_DIR,
+    ETL_EXTRACT_CACHE_MAX_MB,
+    ETL_EXTRACT_CACHE_MIN_ROWS,
+    ETL_FETCH_CHUNK_SIZE,
+)
+
+logger = getLogger(__name__)
+
+# File layout: MAGIC, row groups, footer (JSON), footer length (8 bytes), MAGIC.
+# A row group holds up to ETL_FETCH_CHUNK_SIZE rows, stored column by column. Every column is a
+# set of 8-byte aligned segments, read straight from the memory map when the group is read:
+#   int, float, bool, datetime, date: one fixed width value per row (datetime as microseconds
+#       since the epoch, date as ordinal)
+#   str, decimal, object: row offsets into a blob (UTF-8 text, or pickled values for object)
+#   nulls, when the column has any: one byte per row
+MAGIC = b"ETLCOL1\n"
+EPOCH = datetime.datetime(1970, 1, 1)
+_TYPE_CODES = {"int": "q", "float": "d", "bool": "b", "datetime": "q", "date": "q"}
+
+
+def _kind(value) -> str:
+    # bool before int, datetime before date: both are subclasses.
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int" if -(2**63) <= value < 2**63 else "object"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "str"
+    if isinstance(value, Decimal):
+        return "decimal"
+    if isinstance(value, datetime.datetime):
+        return "object" if value.tzinfo is not None else "datetime"
+    if isinstance(value, datetime.date):
+        return "date"
+    return "object"
+
+
+def _column_kind(values) -> str:
+    kinds = {_kind(value) for value in values if value is not None}
+    if len(kinds) == 1:
+        return kinds.pop()
+    return "object" if kinds else "int"
+
+
+def _encode_column(values, kind: str) -> list[bytes]:
+    if kind in _TYPE_CODES:
+        if kind == "datetime":
+            values = [0 if v is None else (v - EPOCH) // datetime.timedelta(microseconds=1) for v in values]
+        elif kind == "date":
+            values = [0 if v is None else v.toordinal() for v in values]
+        else:
+            values = [0 if v is None else v for v in values]
+        return [array(_TYPE_CODES[kind], values).tobytes()]
+
+    if kind == "object":
+        encoded = [pickle.dumps(v) for v in values]
+    else:
+        encoded = [b"" if v is None else str(v).encode() for v in values]
+    offsets = array("q", [0])
+    for item in encoded:
+        offsets.append(offsets[-1] + len(item))
+    return [offsets.tobytes(), b"".join(encoded)]
+
+
+def _decode_column(segments: list[memoryview], kind: str, rows: int) -> list:
+    if kind in _TYPE_CODES:
+        values = segments[0].cast(_TYPE_CODES[kind]).tolist()
+        if kind == "datetime":
+            return [EPOCH + datetime.timedelta(microseconds=v) for v in values]
+        if kind == "date":
+            return [datetime.date.fromordinal(max(v, 1)) for v in values]
+        if kind == "bool":
+            return [v != 0 for v in values]
+        return values
+
+    offsets = segments[0].cast("q")
+    blob = segments[1]
+    items = [blob[offsets[i]:offsets[i + 1]] for i in range(rows)]
+    if kind == "object":
+        return [pickle.loads(item) for item in items]
+    if kind == "decimal":
+        return [Decimal(str(item, "utf-8")) if len(item) > 0 else None for item in items]
+    return [str(item, "utf-8") for item in items]
+
+
+def _pad(length: int) -> bytes:
+    return b"\0" * (-length % 8)
+
+
+class _EntryWriter:
+    # Writes a result set to <path>.tmp one row group at a time, renamed into place once complete.
+
+    def __init__(self, path: str, description: dict):
+        self.path = path
+        self.description = description
+        self._file = open(path + ".tmp", "wb")
+        self._file.write(MAGIC)
+        self._groups = []
+        self._pending = []
+        self.rows = 0
+
+    def add(self, rows):
+        self._pending.extend(rows)
+        self.rows += len(rows)
+        while len(self._pending) >= ETL_FETCH_CHUNK_SIZE:
+            self._write_group(self._pending[:ETL_FETCH_CHUNK_SIZE])
+            self._pending = self._pending[ETL_FETCH_CHUNK_SIZE:]
+
+    def _write_group(self, rows):
+        group = {"rows": len(rows), "columns": []}
+        for values in zip(*rows):
+            kind = _column_kind(values)
+            segments = _encode_column(values, kind)
+            if any(v is None for v in values):
+                segments.append(bytes(v is None for v in values))
+            column = {"kind": kind, "nullable": any(v is None for v in values), "segments": []}
+            for segment in segments:
+                column["segments"].append((self._file.tell(), len(segment)))
+                self._file.write(segment)
+                self._file.write(_pad(len(segment)))
+            group["columns"].append(column)
+        self._groups.append(group)
+
+    def close(self):
+        if self._pending:
+            self._write_group(self._pending)
+            self._pending = []
+        footer = json.dumps({**self.description, "rows": self.rows, "groups": self._groups}).encode()
+        self._file.write(footer)
+        self._file.write(struct.pack("<q", len(footer)))
+        self._file.write(MAGIC)
+        self._file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def discard(self):
+        self._file.close()
+        os.remove(self.path + ".tmp")
+
+
+def _decode_group(view: memoryview, group: dict) -> list[tuple]:
+    columns = []
+    for column in group["columns"]:
+        segments = [view[offset:offset + length] for offset, length in column["segments"]]
+        values = _decode_column(segments, column["kind"], group["rows"])
+        if column["nullable"]:
+            nulls = segments[-1]
+            values = [None if nulls[i] else value for i, value in enumerate(values)]
+        columns.append(values)
+    return list(zip(*columns))
+
+
+def read_entry(path: str):
+    # Yield the row groups of a cache file as lists of tuples, decoding one group at a time
+    # from the memory map, so only the pages of that group are read in.
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                (footer_length,) = struct.unpack("<q", view[-len(MAGIC) - 8:-len(MAGIC)])
+                footer = json.loads(bytes(view[-len(MAGIC) - 8 - footer_length:-len(MAGIC) - 8]))
+                for group in footer["groups"]:
+                    yield _decode_group(view, group)
+            finally:
+                view.release()
+
+
+class ExtractCache:
+    # Source result sets persisted on local disk, keyed by the query, its parameters and the
+    # versions of the source tables it reads (change_detection.source_versions), so an
+    # interrupted run (or a re-run for testing) reads them back instead of querying SQL Server
+    # again. Any change to one of those tables means a new key, whatever the load watermarks.
+    # The versions are read once per process, on the first query through the cache.
+    # Entries are written only once their result set has been read to the end. Files are
+    # evicted, least recently used first, to keep the cache under max_bytes.
+
+    def __init__(self, directory: str, max_bytes: int, min_rows: int = ETL_EXTRACT_CACHE_MIN_ROWS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_rows = min_rows
+        self.hits = 0
+        self.misses = 0
+        self._versions = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory != ""
+
+    @staticmethod
+    def _hash(value) -> str:
+        return hashlib.blake2b(repr(value).encode(), digest_size=10).hexdigest()
+
+    def versions(self, ms_cur, query: str) -> dict[str, tuple]:
+        # Versions of the tables query reads, of every table if it names none of them.
+        with self._lock:
+            if self._versions is None:
+                self._versions = source_versions(ms_cur)
+        tables = [table for table in VERSIONED_TABLES if re.search(rf"\b{re.escape(table)}\b", query)]
+        return {table: self._versions[table] for table in tables or VERSIONED_TABLES}
+
+    def path(self, query: str, params, versions: dict) -> str:
+        # Prefixed by the hash of the query alone, so invalidate() can drop every entry of a query.
+        return os.path.join(
+            self.directory, f"{self._hash(query)}-{self._hash((params, versions))}.etlc"
+        )
+
+    def cursor(self, ms_cur):
+        # Wrap a source cursor, or return it as is when the cache is disabled.
+        if not self.enabled:
+            return ms_cur
+        os.makedirs(self.directory, exist_ok=True)
+        return CachingCursor(ms_cur, self)
+
+    def lookup(self, path: str):
+        if os.path.exists(path):
+            # The access time is not reliable (noatime), mark the entry as used by its mtime.
+            os.utime(path)
+            with self._lock:
+                self.hits += 1
+            return read_entry(path)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def writer(self, path: str, query: str, params, versions: dict) -> _EntryWriter:
+        return _EntryWriter(path, {"query": query, "params": repr(params), "versions": repr(versions)})
+
+    def store(self, writer: _EntryWriter):
+        if writer.rows < self.min_rows:
+            writer.discard()
+            return
+        writer.close()
+        self.evict()
+
+    def entries(self) -> list[os.DirEntry]:
+        if not os.path.isdir(self.directory):
+            return []
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith(".etlc")]
+
+    def evict(self):
+        with self._lock:
+            entries = sorted(self.entries(), key=lambda entry: entry.stat().st_mtime)
+            total = sum(entry.stat().st_size for entry in entries)
+            for entry in entries:
+                if total <= self.max_bytes:
+                    break
+                total -= entry.stat().st_size
+                os.remove(entry.path)
+                logger.info("Evicted %s from the extract cache", entry.name)
+
+    def invalidate(self, query: str | None = None) -> int:
+        # Drop every entry, or every entry of one query whatever its parameters.
+        prefix = "" if query is None else self._hash(query) + "-"
+        removed = 0
+        with self._lock:
+            for entry in self.entries():
+                if entry.name.startswith(prefix):
+                    os.remove(entry.path)
+                    removed += 1
+        logger.info("Invalidated %s extract cache entries", removed)
+        return removed
+
+    def log_stats(self):
+        if self.enabled:
+            logger.info(
+                "Extract cache: %s hits, %s misses, %.1f MiB on disk",
+                self.hits,
+                self.misses,
+                sum(entry.stat().st_size for entry in self.entries()) / (1024 * 1024),
+            )
+
+
+class CachingCursor:
+    # Source cursor that serves result sets from the ExtractCache, and records the ones it has
+    # to run on the source. Only the calls the loaders make are supported.
+
+    def __init__(self, ms_cur, cache: ExtractCache):
+        self._cursor = ms_cur
+        self.cache = cache
+        self._cached = None
+        self._buffer = []
+        self._writer = None
+
+    def execute(self, query, params=None):
+        self._finish()
+        versions = self.cache.versions(self._cursor, query)
+        path = self.cache.path(query, params, versions)
+        self._cached = self.cache.lookup(path)
+        if self._cached is None:
+            self._cursor.execute(query, params)
+            self._writer = self.cache.writer(path, query, params, versions)
+
+    def _finish(self):
+        # A result set that was not read to the end is not stored.
+        if self._writer is not None:
+            self._writer.discard()
+            self._writer = None
+        if self._cached is not None:
+            self._cached.close()
+        self._cached = None
+        self._buffer = []
+
+    def _fetch(self, size: int | None) -> list:
+        if self._cached is not None:
+            while size is None or len(self._buffer) < size:
+                group = next(self._cached, None)
+                if group is None:
+                    break
+                self._buffer.extend(group)
+            if size is None:
+                (rows, self._buffer) = (self._buffer, [])
+            else:
+                (rows, self._buffer) = (self._buffer[:size], self._buffer[size:])
+            return rows
+
+        rows = self._cursor.fetchall() if size is None else self._cursor.fetchmany(size)
+        if self._writer is not None:
+            self._writer.add(rows)
+            if size is None or len(rows) == 0:
+                self.cache.store(self._writer)
+                self._writer = None
+        return rows
+
+    def fetchone(self):
+        rows = self._fetch(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size: int = 1):
+        return self._fetch(size)
+
+    def fetchall(self):
+        return self._fetch(None)
+
+    def __iter__(self):
+        while True:
+            rows = self._fetch(ETL_FETCH_CHUNK_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+# Shared by every loader of the run.
+extract_cache = ExtractCache(ETL_EXTRACT_CACHE_DIR, ETL_EXTRACT_CACHE_MAX_MB * 1024 * 1024)
+
+
+if __name__ == "__main__":
+    # python etl/extract_cache.py clear: drop every entry, e.g. after the source was restored.
+    if sys.argv[1:] == ["clear"]:
+        extract_cache.invalidate()
+    else:
+        extract_cache.log_stats()
+        print(f"{len(extract_cache.entries())} entries in {extract_cache.directory or '(disabled)'}")
@@ -0,0 +1,92 @@
+from logging import getLogger
+import psycopg
+
+from write_batch import write_batch
+
+logger = getLogger(__name__)
+
+STAGING_TABLE_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS stage_factcustomermonthlysnapshot (
+    customerkey BIGINT NOT NULL,
+    snapshotdatekey INTEGER NOT NULL,
+    demographickey BIGINT NULL,
+    geographickey BIGINT NULL,
+    segmentkey BIGINT NULL,
+    recency_score SMALLINT NOT NULL,
+    frequency_score SMALLINT NOT NULL,
+    monetary_score SMALLINT NOT NULL,
+    scored BOOLEAN NOT NULL,
+    insertable BOOLEAN NOT NULL
+)"""
+# Same outcome as inserting the default row ON CONFLICT DO NOTHING, then updating the scores:
+# - A month that already has a snapshot only has its scores updated, and only if it was scored.
+# - A new month is inserted with its scores, unless it only came from a transaction (no default row).
+# Either way the snapshot is left without a segment, for segments.assign_segments to (re)assign.
+MERGE_SQL = """
+INSERT INTO factcustomermonthlysnapshot (customerkey, snapshotdatekey, demographickey, geographickey, segmentkey, recency_score, frequency_score, monetary_score)
+SELECT s.customerkey, s.snapshotdatekey, s.demographickey, s.geographickey, s.segmentkey, s.recency_score, s.frequency_score, s.monetary_score
+FROM stage_factcustomermonthlysnapshot AS s
+WHERE CASE
+    WHEN EXISTS (
+        SELECT 1 FROM factcustomermonthlysnapshot AS f
+        WHERE f.customerkey = s.customerkey AND f.snapshotdatekey = s.snapshotdatekey
+    ) THEN s.scored
+    ELSE s.insertable
+END
+ON CONFLICT (customerkey, snapshotdatekey) DO UPDATE
+SET recency_score = EXCLUDED.recency_score,
+    frequency_score = EXCLUDED.frequency_score,
+    monetary_score = EXCLUDED.monetary_score,
+    segmentkey = NULL"""
+# The months of the batch need their rollups refreshed, see rollups.refresh_rollups.
+MARK_MONTHS_SQL = """
+INSERT INTO etlmeta_rollupmonth (snapshotdatekey)
+SELECT DISTINCT snapshotdatekey FROM stage_factcustomermonthlysnapshot
+ON CONFLICT DO NOTHING"""
+
+
+class SnapshotWriter:
+    # Collects the snapshot rows of one batch, then writes them with a COPY into a staging table
+    # and a single set-based upsert. Committing is left to the caller, together with the checkpoint.
+
+    def __init__(self, pg_cur: psycopg.Cursor):
+        self.pg_cur = pg_cur
+        # (customerkey, snapshotdatekey) -> [demographickey, geographickey, recency, frequency, monetary, scored, insertable]
+        self._rows = {}
+
+    def add_default(self, customer_fk, time_key: int, demographic_fk, geographic_fk):
+        row = self._rows.get((customer_fk, time_key))
+        if row is None:
+            self._rows[(customer_fk, time_key)] = [demographic_fk, geographic_fk, 1, 1, 1, False, True]
+        else:
+            row[0], row[1], row[6] = demographic_fk, geographic_fk, True
+
+    def add_scores(self, customer_fk, time_key: int, recency: int, frequency: int, monetary: int):
+        row = self._rows.get((customer_fk, time_key))
+        if row is None:
+            # Only counts if the month already has a snapshot, see MERGE_SQL.
+            self._rows[(customer_fk, time_key)] = [None, None, recency, frequency, monetary, True, False]
+        else:
+            row[2:6] = [recency, frequency, monetary, True]
+
+    def flush(self) -> int:
+        if len(self._rows) == 0:
+            return 0
+
+        self.pg_cur.execute(STAGING_TABLE_SQL)
+        with self.pg_cur.copy(
+            "COPY stage_factcustomermonthlysnapshot (customerkey, snapshotdatekey, demographickey, geographickey, segmentkey, recency_score, frequency_score, monetary_score, scored, insertable) FROM STDIN"
+        ) as copy:
+            for (customer_fk, time_key), row in self._rows.items():
+                copy.write_row((customer_fk, time_key, row[0], row[1], None, *row[2:]))
+
+        with write_batch(self.pg_cur, "snapshot merge") as batch:
+            merged = batch.execute(MERGE_SQL)
+            batch.execute(MARK_MONTHS_SQL)
+            # The staging table lives for the whole session, empty it for the next batch.
+            batch.execute("TRUNCATE stage_factcustomermonthlysnapshot")
+        written = merged.rowcount
+        logger.info("Staged %s snapshot rows, merged %s", len(self._rows), written)
+
+        self._rows = {}
+        return written
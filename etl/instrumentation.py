@@ -0,0 +1,277 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import json
+from logging import getLogger
+import os
+import threading
+import time
+import psycopg
+
+from config import ETL_PROFILE_DIR, ETL_PROFILE_STAGES, ETL_RUN_HISTORY_JSON
+from streaming import track_memory
+
+logger = getLogger(__name__)
+# One cProfile profiler can be active per process (Python 3.12+), held by one stage at a time.
+_profiler_lock = threading.Lock()
+
+# Statements that change warehouse rows, their rowcount is counted as rows written.
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+
+
+class StageMetrics:
+    # Counters of one stage, or of one batch within a stage. Updated from every thread of the
+    # stage (pipeline threads, parallel fact workers), hence the lock.
+
+    FIELDS = (
+        "rows_extracted",
+        "rows_written",
+        "source_queries",
+        "warehouse_queries",
+        "source_wait",
+        "warehouse_wait",
+    )
+
+    def __init__(self, stage: str, batch_id: int | None = None):
+        self.stage = stage
+        self.batch_id = batch_id
+        self.started_at = datetime.now()
+        self.wall = 0.0
+        self.peak_memory_mb = None
+        self.rows_extracted = 0
+        self.rows_written = 0
+        self.source_queries = 0
+        self.warehouse_queries = 0
+        self.source_wait = 0.0
+        self.warehouse_wait = 0.0
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {name: getattr(self, name) for name in self.FIELDS}
+
+    @contextmanager
+    def batch(self, batch_id: int):
+        # Record one batch as the difference of the stage counters around it. When the stage
+        # overlaps its extraction with its writes, the source figures of a batch include
+        # whatever the extraction thread did meanwhile.
+        before = self.snapshot()
+        started = time.perf_counter()
+        batch = StageMetrics(self.stage, batch_id)
+        try:
+            yield batch
+        finally:
+            after = self.snapshot()
+            for name in self.FIELDS:
+                setattr(batch, name, after[name] - before[name])
+            batch.wall = time.perf_counter() - started
+            with self._lock:
+                self.batches.append(batch)
+
+    def as_row(self, run_id: str) -> tuple:
+        return (
+            run_id,
+            self.stage,
+            self.batch_id,
+            self.started_at,
+            self.wall,
+            self.rows_extracted,
+            self.rows_written,
+            self.source_queries,
+            self.warehouse_queries,
+            self.source_wait,
+            self.warehouse_wait,
+            self.peak_memory_mb,
+        )
+
+    def as_dict(self) -> dict:
+        return {
+            "stage": self.stage,
+            "batch_id": self.batch_id,
+            "started_at": self.started_at.isoformat(),
+            "wall": self.wall,
+            "peak_memory_mb": self.peak_memory_mb,
+            **self.snapshot(),
+            "batches": [batch.as_dict() for batch in self.batches],
+        }
+
+    def source_cursor(self, cursor):
+        return InstrumentedCursor(cursor, self, "source")
+
+    def warehouse_cursor(self, cursor):
+        return InstrumentedCursor(cursor, self, "warehouse")
+
+
+class _InstrumentedCopy:
+    def __init__(self, copy):
+        self._copy = copy
+        self.rows = 0
+
+    def write_row(self, row):
+        self._copy.write_row(row)
+        self.rows += 1
+
+    def __getattr__(self, name):
+        return getattr(self._copy, name)
+
+
+class InstrumentedCursor:
+    # Wraps a source or psycopg cursor, counting the queries, the rows and the time spent
+    # waiting on the database into a StageMetrics. Everything else is passed through.
+
+    def __init__(self, cursor, metrics: StageMetrics, side: str):
+        self._cursor = cursor
+        self.metrics = metrics
+        self._side = side
+
+    def _record(self, started: float, queries: int = 0, rows: int = 0):
+        elapsed = time.perf_counter() - started
+        if self._side == "source":
+            self.metrics.add(source_queries=queries, source_wait=elapsed, rows_extracted=rows)
+        else:
+            self.metrics.add(warehouse_queries=queries, warehouse_wait=elapsed)
+
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(query, params)
+        finally:
+            self._record(started, queries=1)
+
+        if self._side == "warehouse" and query.lstrip().upper().startswith(WRITE_STATEMENTS):
+            self.metrics.add(rows_written=max(self._cursor.rowcount, 0))
+        # psycopg returns the cursor to chain fetches on, keep doing so through the wrapper.
+        return self
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._record(started, rows=0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size: int):
+        started = time.perf_counter()
+        rows = self._cursor.fetchmany(size)
+        self._record(started, rows=len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._record(started, rows=len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    @contextmanager
+    def copy(self, statement: str):
+        # COPY into a staging table is not a write yet, the set-based statement after it is.
+        counted = "COPY stage_" not in statement
+        started = time.perf_counter()
+        try:
+            with self._cursor.copy(statement) as copy:
+                instrumented = _InstrumentedCopy(copy)
+                yield instrumented
+        finally:
+            self._record(started, queries=1)
+        if counted:
+            self.metrics.add(rows_written=instrumented.rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class RunRecorder:
+    # Collects the StageMetrics of one ETL run and stores them in etlmeta_runhistory,
+    # and in ETL_RUN_HISTORY_JSON if set.
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.run_id = self.started_at.strftime("%Y%m%dT%H%M%S")
+        self.stages = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        metrics = StageMetrics(name)
+        with self._lock:
+            self.stages.append(metrics)
+
+        profiler = None
+        if name in ETL_PROFILE_STAGES or "all" in ETL_PROFILE_STAGES:
+            # On Python 3.12+ the profile covers every thread of the process while the stage runs, the stages
+            # running at the same time included. Those stages are not profiled on their own.
+            if _profiler_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError as error:
+                    # Another profiling tool is active, e.g. python -m cProfile.
+                    logger.warning("Not profiling stage %s: %s", name, error)
+                    profiler = None
+                    _profiler_lock.release()
+            else:
+                logger.warning("Not profiling stage %s, another stage is being profiled", name)
+
+        started = time.perf_counter()
+        try:
+            with track_memory(name) as usage:
+                yield metrics
+        finally:
+            metrics.wall = time.perf_counter() - started
+            metrics.peak_memory_mb = (
+                usage.peak_traced_mb if usage.peak_traced_mb is not None else usage.peak_rss_mb
+            )
+            if profiler is not None:
+                profiler.disable()
+                _profiler_lock.release()
+                os.makedirs(ETL_PROFILE_DIR, exist_ok=True)
+                path = os.path.join(ETL_PROFILE_DIR, f"{self.run_id}-{name}.prof")
+                profiler.dump_stats(path)
+                logger.info("Profile of stage %s written to %s", name, path)
+            logger.info(
+                "Stage %s: %.1fs, %s rows extracted, %s rows written, %s/%s source/warehouse queries, waited %.1fs/%.1fs on source/warehouse",
+                name,
+                metrics.wall,
+                metrics.rows_extracted,
+                metrics.rows_written,
+                metrics.source_queries,
+                metrics.warehouse_queries,
+                metrics.source_wait,
+                metrics.warehouse_wait,
+            )
+
+    def save(self, pg_conn: psycopg.Connection):
+        with pg_conn.cursor() as pg_cur:
+            with pg_cur.copy(
+                "COPY etlmeta_runhistory (runid, stage, batchid, startedat, wallseconds, rowsextracted, rowswritten, sourcequeries, warehousequeries, sourcewaitseconds, warehousewaitseconds, peakmemorymb) FROM STDIN"
+            ) as copy:
+                for metrics in self.stages:
+                    copy.write_row(metrics.as_row(self.run_id))
+                    for batch in metrics.batches:
+                        copy.write_row(batch.as_row(self.run_id))
+        pg_conn.commit()
+
+        if ETL_RUN_HISTORY_JSON:
+            with open(ETL_RUN_HISTORY_JSON, "a") as file:
+                file.write(
+                    json.dumps(
+                        {
+                            "run_id": self.run_id,
+                            "started_at": self.started_at.isoformat(),
+                            "stages": [metrics.as_dict() for metrics in self.stages],
+                        }
+                    )
+                    + "\n"
+                )
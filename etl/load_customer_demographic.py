@@ -1,9 +1,17 @@
+from array import array
 import datetime
 import re
 import psycopg
-import pymssql
 import xml.etree.ElementTree as ET
 
+from age_bands import record_birth_dates
+from bulk_upsert import CUSTOMER_UPSERTER, DEMOGRAPHIC_UPSERTER
+from connection import SourceCursor
+from demographic_transform import demographic_transformer, parse_birth_date, parse_gender
+from dimension_cache import DimensionCaches
+from pipeline import run_pipeline
+from streaming import stream_chunks
+
 CUSTOMER_DEMOGRAPHIC_SQL = """
 SELECT
     CustomerID = customer.CustomerID,
@@ -36,15 +44,12 @@ NAMESPACE_MATCHER = re.compile(r"\{(.*)\}")
 
 def parse_name_gender(row) -> tuple[str, str]:
     name = " ".join(filter(None, row[1:5]))
-    root = ET.fromstring(row[5])
-    match = NAMESPACE_MATCHER.match(root.tag)
-    namespace = match.group(1) if match is not None else ""
-    gender = root.find(f"{{{namespace}}}Gender")
-    gender = gender.text if gender is not None else None
+    gender = parse_gender(row[5])
 
     return (name, gender)
 
 def parse_demographic(xml) -> tuple:
+    # Reference parser, the loaders go through demographic_transform.demographic_transformer.
     root = ET.fromstring(xml)
     match = NAMESPACE_MATCHER.match(root.tag)
     namespace = match.group(1) if match is not None else ""
@@ -56,30 +61,17 @@ def parse_demographic(xml) -> tuple:
     education = root.find(f"{{{namespace}}}Education").text
     occupation = root.find(f"{{{namespace}}}Occupation").text
     is_home_owner = root.find(f"{{{namespace}}}HomeOwnerFlag").text
-    current_time = datetime.date.today()
-    is_leap_year = lambda a: (a % 4 == 0 and a % 100 != 0) or a % 400 == 0
-
-    # Calculate age band
+    # Calculate age band. Kept apart from demographic_transform.age_band, so the benchmark
+    # checks the transformer against a second implementation.
     birth_date = datetime.date.fromisoformat(birth_date[:-1])
-    # shift 29/02 up if it is not a leap year right now
-    if (
-        birth_date.day == 29
-        and birth_date.month == 2
-        and not is_leap_year(current_time.year)
-    ):
-        birth_date.day = 1
-        birth_date.month = 3
-
-    age = (
-        current_time.year - birth_date.year + 1
-        if current_time.month > birth_date.month
-        or (
-            current_time.month == birth_date.month
-            and current_time.day >= birth_date.day
-        )
-        else 0
-    )
-    age_band = "<26" if age < 26 else ">60" if age > 60 else "26-60"
+    today = datetime.date.today()
+    try:
+        birthday = birth_date.replace(year=today.year)
+    except ValueError:
+        # 29/02 in a non-leap year, celebrated on 01/03.
+        birthday = datetime.date(today.year, 3, 1)
+    age = today.year - birth_date.year - (1 if today < birthday else 0)
+    age_band_value = "<26" if age < 26 else ">60" if age > 60 else "26-60"
 
     # Booleanize is_home_owner
     is_home_owner = is_home_owner == "1"
@@ -92,7 +84,7 @@ def parse_demographic(xml) -> tuple:
 
     return (
         marital_status,
-        age_band,
+        age_band_value,
         yearly_income_level,
         number_cars_owned,
         education,
@@ -101,79 +93,108 @@ def parse_demographic(xml) -> tuple:
     )
 
 
-def _load_customer_initial(pg_cur: psycopg.Cursor, data: list[tuple[any, ...]]):
+def _transform_customers(rows):
+    # The CPU-bound part of the customer loaders, run as its own pipeline stage.
+    # (CustomerID, name, gender, EmailPromotion, ModifiedDate, parsed demographic, birth date)
+    demographics = demographic_transformer.parse_many([row[5] for row in rows])
+    return [
+        (row[0], *parse_name_gender(row), row[6], row[7], demographic, parse_birth_date(row[5]) if row[5] else None)
+        for row, demographic in zip(rows, demographics)
+    ]
+
+
+# Both customer loaders return the distinct demographics they have seen, parsed.
+# Their count is bounded by the (small) demographic dimension, so the XML documents themselves
+# never need to be held in memory, and the rows are only read once.
+
+def _load_customer_initial(pg_cur: psycopg.Cursor, chunks, caches: DimensionCaches):
     max_timestamp = datetime.datetime.min
+    demographics = set()
+    # Indexed once the COPY is done, kept compact meanwhile: 16 bytes per customer.
+    customer_ids = array("q")
+    birth_dates = array("q")
 
     with pg_cur.copy(
         "COPY dimcustomer (customerid, name, gender, emailpromotiontype) FROM STDIN"
     ) as copy:
-        for row in data:
-            max_timestamp = max(max_timestamp, row[7])
-            (name, gender) = parse_name_gender(row)
-            copy.write_row((row[0], name, gender, row[6]))
+        def load(customers):
+            nonlocal max_timestamp
+            for customer_id, name, gender, promotion, modified_date, demographic_data, birth_date in customers:
+                max_timestamp = max(max_timestamp, modified_date)
+                copy.write_row((customer_id, name, gender, promotion))
+                demographics.add(demographic_data)
+                if birth_date is not None:
+                    customer_ids.append(customer_id)
+                    birth_dates.append(birth_date.toordinal())
+
+        run_pipeline("customer", chunks, [("transform", _transform_customers)], load)
+
+    caches.customer.invalidate()
+    record_birth_dates(
+        pg_cur,
+        zip(customer_ids, map(datetime.date.fromordinal, birth_dates)),
+        demographic_transformer.today,
+    )
 
-    return max_timestamp
+    return (max_timestamp, demographics)
 
-def _load_customer_incremental(pg_cur: psycopg.Cursor, data: list[tuple[any, ...]]):
-    max_timestamp = datetime.datetime.min
+def _load_customer_incremental(pg_cur: psycopg.Cursor, chunks, caches: DimensionCaches, max_timestamp):
+    demographics = set()
 
-    for row in data:
-        max_timestamp = max(max_timestamp, row[7])
-        (name, gender) = parse_name_gender(row)
-        if (
-            pg_cur.execute(
-                "SELECT d.customerkey FROM dimcustomer AS d WHERE d.customerid = %s AND d.name = %s AND d.gender = %s AND d.emailpromotiontype = %s",
-                (row[0], name, gender, row[6]),
-            ).fetchone()
-            is None
-        ):
-            pg_cur.execute(
-                "INSERT INTO dimgeographic (cityname, stateprovincename, countryregionname, territoryname) VALUES (%s, %s, %s, %s)",
-                (row[0], name, gender, row[6]),
-            )
+    def load(customers):
+        nonlocal max_timestamp
+        for customer in customers:
+            max_timestamp = max(max_timestamp, customer[4])
+            demographics.add(customer[5])
 
-    return max_timestamp
+        inserted = CUSTOMER_UPSERTER.upsert(pg_cur, (customer[0:4] for customer in customers))
+        record_birth_dates(
+            pg_cur,
+            ((customer[0], customer[6]) for customer in customers if customer[6] is not None),
+            demographic_transformer.today,
+        )
+        # A new version of the customer, which becomes the one new snapshots refer to.
+        for (customer_id, *_), customer_key in inserted.items():
+            caches.customer.add((customer_id,), customer_key)
+
+    run_pipeline("customer", chunks, [("transform", _transform_customers)], load)
+
+    return (max_timestamp, demographics)
 
 
-def _load_demographic(pg_cur: psycopg.Cursor, data: list[tuple[any, ...]]):
-    # Demographic cannot be copied since the data is not guaranteed distinct
-    # Geographic can do since the SQL is SELECT DISTINCT
-    # Same goes for time, and customer is guaranteed distinct due to source key constraint
-    for row in data:
-        demographic_data = parse_demographic(row[5])
-        if (
-            pg_cur.execute(
-                "SELECT d.demographickey FROM dimdemographic AS d WHERE d.maritalstatus = %s AND d.ageband = %s AND d.yearlyincomelevel = %s AND d.numbercarsowned = %s AND d.education = %s AND d.occupation = %s AND d.ishomeowner = %s",
-                demographic_data,
-            ).fetchone()
-            is None
-        ):
-            pg_cur.execute(
-                "INSERT INTO dimdemographic (maritalstatus, ageband, yearlyincomelevel, numbercarsowned, education, occupation, ishomeowner) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                demographic_data,
-            )
-
-
-def load_customer_demographic_initial(ms_cur: pymssql.Cursor, pg_cur: psycopg.Cursor):
+def _load_demographic(pg_cur: psycopg.Cursor, demographics, caches: DimensionCaches):
+    # Demographic cannot be copied straight into the dimension since it may already hold them,
+    # go through the upserter.
+    inserted = DEMOGRAPHIC_UPSERTER.upsert(pg_cur, demographics)
+    for natural_key, key in inserted.items():
+        caches.demographic.add(natural_key, key)
+
+
+def load_customer_demographic_initial(
+    ms_cur: SourceCursor, pg_cur: psycopg.Cursor, caches: DimensionCaches | None = None
+):
     ms_cur.execute(CUSTOMER_DEMOGRAPHIC_SQL)
-    data = ms_cur.fetchall()
+    caches = caches or DimensionCaches()
 
-    max_timestamp = _load_customer_initial(pg_cur, data)
-    _load_demographic(pg_cur, data)
+    (max_timestamp, demographics) = _load_customer_initial(pg_cur, stream_chunks(ms_cur), caches)
+    _load_demographic(pg_cur, demographics, caches)
 
     return max_timestamp
 
 
 def load_customer_demographic_incremental(
-    ms_cur: pymssql.Cursor, pg_cur: psycopg.Cursor, timestamp: datetime.datetime
+    ms_cur: SourceCursor,
+    pg_cur: psycopg.Cursor,
+    timestamp: datetime.datetime,
+    caches: DimensionCaches | None = None,
 ):
     ms_cur.execute(CUSTOMER_DEMOGRAPHIC_INC_SQL, (timestamp,))
-    data = ms_cur.fetchall()
 
-    if len(data) == 0 or data is None:
-        return
-
-    max_timestamp = _load_customer_incremental(pg_cur, data)
-    _load_demographic(pg_cur, data)
+    caches = caches or DimensionCaches()
+    # Nothing changed keeps the previous timestamp.
+    (max_timestamp, demographics) = _load_customer_incremental(
+        pg_cur, stream_chunks(ms_cur), caches, timestamp
+    )
+    _load_demographic(pg_cur, demographics, caches)
 
     return max_timestamp
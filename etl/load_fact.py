@@ -1,20 +1,28 @@
 import calendar
-from datetime import datetime, date
-import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import datetime, date, timedelta
 from logging import getLogger
-import re
+import os
+import socket
+import threading
+import time
 import psycopg
-import pymssql
 
-from load_customer_demographic import parse_demographic
+from batch_size import AdaptiveBatchSize
+from config import ETL_FACT_LEASE_SECONDS, ETL_FACT_QUEUE_POLL_SECONDS
+from connection import ConnectionPool, SourceCursor
+from dimension_cache import DimensionCaches
+from fact_writer import SnapshotWriter
+from instrumentation import StageMetrics
+import partitions
+from demographic_transform import demographic_transformer
+from extract_cache import extract_cache
+from pipeline import run_pipeline
+from rfm import RFMScorer, create_scorer
+import rollups
+from write_batch import write_batch
 
-START_DATE_SQL = """
-SELECT DISTINCT
-    OrderYear = DATEPART(year, header.OrderDate),
-    OrderMonth = DATEPART(month, header.OrderDate)
-FROM Sales.SalesOrderHeader AS header
-WHERE header.ModifiedDate > %s AND header.Status != 6
-"""
 TRANSACTION_SQL = """
 WITH RawData AS (
     SELECT
@@ -26,7 +34,17 @@ WITH RawData AS (
         MAX(header.OrderDate) AS LatestOrderDate,
         MAX(header.ModifiedDate) AS LatestModifiedDate
     FROM Sales.SalesOrderHeader AS header
-    WHERE header.Status != 6 AND header.ModifiedDate > %s AND header.CustomerID = %s
+    -- Every order of a month that has a changed order, so the month is scored as a whole.
+    WHERE header.Status != 6
+        AND EXISTS (
+            SELECT 1
+            FROM Sales.SalesOrderHeader AS changed
+            WHERE changed.CustomerID = header.CustomerID
+                AND changed.ModifiedDate > %s
+                AND DATEPART(year, changed.OrderDate) = DATEPART(year, header.OrderDate)
+                AND DATEPART(month, changed.OrderDate) = DATEPART(month, header.OrderDate)
+        )
+        AND header.CustomerID = %s
     GROUP BY header.CustomerID,
         DATEPART(year, header.OrderDate),
         DATEPART(month, header.OrderDate)
@@ -78,17 +96,158 @@ SELECT DISTINCT TOP 1
 FROM Sales.SalesOrderHeader AS header
 WHERE header.Status != 6 AND header.CustomerID = %s
 ORDER BY header.OrderDate"""
+CUSTOMERS_SQL = """
+SELECT TOP (%s) c.CustomerID, p.BusinessEntityID
+FROM Person.Person AS p
+    JOIN Sales.Customer AS c ON p.BusinessEntityID = c.PersonID
+WHERE p.PersonType = 'IN' AND c.CustomerID > %s AND c.CustomerID <= %s
+ORDER BY c.CustomerID"""
+CUSTOMER_ID_BOUNDS_SQL = """
+SELECT MIN(c.CustomerID), MAX(c.CustomerID)
+FROM Person.Person AS p
+    JOIN Sales.Customer AS c ON p.BusinessEntityID = c.PersonID
+WHERE p.PersonType = 'IN' AND c.CustomerID > %s AND c.CustomerID <= %s"""
+# Carry every customer of the previous month's snapshot over to a new month, with default scores.
+# Dimension keys are kept from the previous month, the customer moves to its latest version.
+# The segment follows from the scores, it is assigned afterwards by segments.assign_segments.
+ROLL_FORWARD_SELECT_SQL = """
+SELECT latest.customerkey, %(month)s, previous.demographickey, previous.geographickey, NULL, 1, 1, 1
+FROM (
+    SELECT DISTINCT ON (c.customerid) c.customerid, f.demographickey, f.geographickey
+    FROM factcustomermonthlysnapshot AS f
+        JOIN dimcustomer AS c ON c.customerkey = f.customerkey
+    WHERE f.snapshotdatekey = %(previous_month)s
+    ORDER BY c.customerid, f.customerkey DESC
+) AS previous
+    CROSS JOIN LATERAL (
+        SELECT c.customerkey FROM dimcustomer AS c
+        WHERE c.customerid = previous.customerid
+        ORDER BY c.customerkey DESC LIMIT 1
+    ) AS latest"""
+ROLL_FORWARD_SQL = (
+    "INSERT INTO factcustomermonthlysnapshot (customerkey, snapshotdatekey, demographickey, geographickey, segmentkey, recency_score, frequency_score, monetary_score)"
+    + ROLL_FORWARD_SELECT_SQL
+    + "\nON CONFLICT (customerkey, snapshotdatekey) DO NOTHING"
+)
+FIRST_ORDER_DATE_SQL = """
+SELECT MIN(header.OrderDate)
+FROM Sales.SalesOrderHeader AS header
+WHERE header.Status != 6"""
+FIRST_SNAPSHOT_SQL = """
+SELECT c.customerid, MIN(f.snapshotdatekey)
+FROM factcustomermonthlysnapshot AS f
+    JOIN dimcustomer AS c ON c.customerkey = f.customerkey
+WHERE c.customerid = ANY(%s)
+GROUP BY c.customerid"""
+# Upper bound of Sales.Customer.CustomerID (INT), used when loading every customer.
+MAX_CUSTOMER_ID = 2**31 - 1
+# Queue mode: workers of any machine claim the next range nobody holds, skipping the ones another
+# worker is claiming at the same moment. A claim is a lease, renewed by every checkpoint of the
+# range; once it runs out (the worker died or hangs), the range is claimed again and resumes
+# from its last checkpoint. Returns the previous holder of the range too, None if it was new.
+CLAIM_RANGE_SQL = """
+WITH claimable AS (
+    SELECT rangeid, claimedby
+    FROM etlmeta_factloadrange
+    WHERE NOT finished AND (leaseexpires IS NULL OR leaseexpires < clock_timestamp())
+    ORDER BY rangeid
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE etlmeta_factloadrange AS r
+SET claimedby = %(owner)s, leaseexpires = clock_timestamp() + make_interval(secs => %(lease)s)
+FROM claimable
+WHERE r.rangeid = claimable.rangeid
+RETURNING r.rangeid, r.firstcustomerid, r.lastcustomerid, r.batchid, r.loadingtimestamp, claimable.claimedby"""
+# Only while the range is still ours, a worker whose range was claimed again must stop.
+LEASED_CHECKPOINT_SQL = """
+UPDATE etlmeta_factloadrange
+SET batchid = %(batch)s, loadingtimestamp = %(timestamp)s,
+    leaseexpires = clock_timestamp() + make_interval(secs => %(lease)s)
+WHERE rangeid = %(range)s AND claimedby = %(owner)s"""
+LEASED_FINISH_SQL = """
+UPDATE etlmeta_factloadrange
+SET finished = TRUE, loadingtimestamp = %(timestamp)s, leaseexpires = NULL
+WHERE rangeid = %(range)s AND claimedby = %(owner)s"""
+
+# Set-based variants of the queries above, covering a whole range of customers per round-trip.
+# The per-customer result is recovered by grouping on CustomerID in the ETL process.
+BULK_TRANSACTION_SQL = TRANSACTION_SQL.replace(
+    "header.CustomerID = %s", "header.CustomerID BETWEEN %s AND %s"
+).replace(
+    "ORDER BY OrderYear, OrderMonth, CustomerID", "ORDER BY CustomerID, OrderYear, OrderMonth"
+)
+# The month aggregates BULK_TRANSACTION_SQL scores, left for rfm.RFMScorer to score. Same filters, same order.
+BULK_ORDER_AGGREGATE_SQL = """
+SELECT
+    header.CustomerID,
+    OrderYear = DATEPART(year, header.OrderDate),
+    OrderMonth = DATEPART(month, header.OrderDate),
+    MonthCount = COUNT(header.SalesOrderID),
+    MonthTotal = ISNULL(SUM(header.SubTotal), 0),
+    LatestOrderDate = MAX(header.OrderDate),
+    LatestModifiedDate = MAX(header.ModifiedDate)
+FROM Sales.SalesOrderHeader AS header
+-- Every order of a month that has a changed order, so the month is scored as a whole.
+WHERE header.Status != 6
+    AND EXISTS (
+        SELECT 1
+        FROM Sales.SalesOrderHeader AS changed
+        WHERE changed.CustomerID = header.CustomerID
+            AND changed.ModifiedDate > %s
+            AND DATEPART(year, changed.OrderDate) = DATEPART(year, header.OrderDate)
+            AND DATEPART(month, changed.OrderDate) = DATEPART(month, header.OrderDate)
+    )
+    AND header.CustomerID BETWEEN %s AND %s
+GROUP BY header.CustomerID,
+    DATEPART(year, header.OrderDate),
+    DATEPART(month, header.OrderDate)
+ORDER BY header.CustomerID, OrderYear, OrderMonth"""
+BULK_GEOGRAPHIC_SQL = """
+SELECT
+    CustomerID = customer.CustomerID,
+    CityName = address_data.City,
+    StateName = state_data.Name,
+    CountryName = country_data.Name,
+    TerritoryName = territory_data.Name
+FROM Person.Person AS person
+    JOIN Sales.Customer AS customer ON person.BusinessEntityID = customer.PersonID
+    JOIN Person.BusinessEntityAddress AS person_address ON person.BusinessEntityID = person_address.BusinessEntityID
+    JOIN Person.Address AS address_data ON person_address.AddressID = address_data.AddressID
+    JOIN Person.StateProvince AS state_data ON state_data.StateProvinceID = address_data.StateProvinceID
+    JOIN Person.CountryRegion AS country_data ON state_data.CountryRegionCode = country_data.CountryRegionCode
+    JOIN Sales.SalesTerritory AS territory_data ON state_data.TerritoryID = territory_data.TerritoryID
+WHERE customer.CustomerID BETWEEN %s AND %s AND person_address.AddressTypeID = 2"""
+BULK_DEMOGRAPHIC_SQL = """
+SELECT
+    CustomerID = customer.CustomerID,
+    Demographics = person.Demographics
+FROM Person.Person AS person
+    JOIN Sales.Customer AS customer ON person.BusinessEntityID = customer.PersonID
+WHERE customer.CustomerID BETWEEN %s AND %s"""
+BULK_START_DATE_SQL = """
+SELECT
+    CustomerID = header.CustomerID,
+    OrderDate = MIN(header.OrderDate)
+FROM Sales.SalesOrderHeader AS header
+WHERE header.Status != 6 AND header.CustomerID BETWEEN %s AND %s
+GROUP BY header.CustomerID"""
 logger = getLogger(__name__)
 
+
+class LeaseLost(RuntimeError):
+    # The lease of a queue mode range ran out and another worker claimed it.
+    pass
+
+
 # Generate report for those month from scratch
-# TODO: Generate a connection pool for this task and attempt to multithread.
 
 def _month_iterator(start_date: date, end_date: date):
     start = [start_date.year, start_date.month]
     end = (end_date.year, end_date.month)
 
     # While we have not reached the end date
-    while start[0] < end[0] or start[1] <= end[1]:
+    while (start[0], start[1]) <= end:
         # yield the current year and month
         yield start
 
@@ -103,19 +262,272 @@ def _date_conversion(input_date: date):
         calendar.monthrange(input_date.year, input_date.month)[1],
     )
 
-def load_fact(
-    ms_cur: pymssql.Cursor,
+def _time_key(input_date: date) -> int:
+    return input_date.year * 10000 + input_date.month * 100 + input_date.day
+
+def _previous_month(time_key: int) -> date:
+    # Last day of the month before the one of time_key.
+    return date(time_key // 10000, time_key // 100 % 100, 1) - timedelta(days=1)
+
+def _extract_customer(ms_cur: SourceCursor, customerID: int, businessEntityID: int, last_updated_timestamp):
+    # Do we have any transaction?
+    ms_cur.execute(TRANSACTION_SQL, (last_updated_timestamp, customerID))
+    transactions = ms_cur.fetchall()
+
+    if len(transactions) == 0:
+        return None
+
+    ms_cur.execute(GEOGRAPHIC_SQL, (businessEntityID,))
+    geographic = ms_cur.fetchone()
+    ms_cur.execute(DEMOGRAPHIC_SQL, (businessEntityID,))
+    demographics = ms_cur.fetchone()[0]
+    ms_cur.execute(START_DATE_SQL, (customerID,))
+    start_date = ms_cur.fetchone()[0]
+
+    return (transactions, geographic, demographics, start_date)
+
+
+def _extract_batch(ms_cur: SourceCursor, customers_batch, last_updated_timestamp, scorer: RFMScorer | None = None):
+    # Pull everything the batch needs in four set-based queries over the batch's CustomerID range.
+    # Customers are ordered by CustomerID, so the range is bounded by the first and last one.
+    # The range may also cover customers we do not load (stores, other person types), those are dropped.
+    first_id = customers_batch[0][0]
+    last_id = customers_batch[-1][0]
+    wanted = {customerID for customerID, _ in customers_batch}
+
+    transactions = {}
+    if scorer is None:
+        ms_cur.execute(BULK_TRANSACTION_SQL, (last_updated_timestamp, first_id, last_id))
+        scored = ms_cur
+    else:
+        # Only aggregate on SQL Server, score the whole batch at once here.
+        ms_cur.execute(BULK_ORDER_AGGREGATE_SQL, (last_updated_timestamp, first_id, last_id))
+        scored = scorer.score_rows(ms_cur.fetchall())
+    for row in scored:
+        if row[0] in wanted:
+            transactions.setdefault(row[0], []).append(row)
+
+    # Only customers with transactions are loaded, so there is no need to keep the rest.
+    geographic = {}
+    ms_cur.execute(BULK_GEOGRAPHIC_SQL, (first_id, last_id))
+    for row in ms_cur:
+        # Keep the first address, same as fetchone() in the per-customer path.
+        if row[0] in transactions and row[0] not in geographic:
+            geographic[row[0]] = row[1:]
+
+    demographics = {}
+    ms_cur.execute(BULK_DEMOGRAPHIC_SQL, (first_id, last_id))
+    for row in ms_cur:
+        if row[0] in transactions:
+            demographics[row[0]] = row[1]
+
+    start_dates = {}
+    ms_cur.execute(BULK_START_DATE_SQL, (first_id, last_id))
+    for row in ms_cur:
+        if row[0] in transactions:
+            start_dates[row[0]] = row[1]
+
+    return {
+        customerID: (
+            transactions[customerID],
+            geographic.get(customerID),
+            demographics.get(customerID),
+            start_dates.get(customerID),
+        )
+        for customerID in transactions
+    }
+
+
+def _load_customer(
+    pg_cur: psycopg.Cursor,
+    writer: SnapshotWriter,
+    caches: DimensionCaches,
+    customerID: int,
+    extracted,
+    parsed_run_timestamp: date,
+    max_update_timestamp: datetime,
+    first_snapshot_key: int | None = None,
+) -> datetime:
+    (transactions, geographic, demographic, start_date) = extracted
+
+    # There are transaction, so let's prepare to add them.
+
+    # Get FKs for new snapshots, from the key caches
+    geographic_fk = caches.geographic.lookup(pg_cur, geographic)
+    demographic_fk = caches.demographic.lookup(pg_cur, demographic)
+    customer_fk = caches.customer.lookup(pg_cur, (customerID,))
+
+    # Generate snapshots for all month since their first purchase if it does not exist
+    start_date = _date_conversion(start_date.date())
+    end_date = parsed_run_timestamp
+    if first_snapshot_key is not None:
+        # The roll-forward already carried this customer up to the run month, only the months
+        # before its first snapshot (backdated orders) can be missing.
+        end_date = _previous_month(first_snapshot_key)
+
+    if start_date <= end_date:
+        for year, month in _month_iterator(start_date, end_date):
+            # Create the time key
+            time_key = year * 10000 + month * 100 + calendar.monthrange(year, month)[1]
+            # Stage default data, the writer will not overwrite an existing snapshot with it.
+            writer.add_default(customer_fk, time_key, demographic_fk, geographic_fk)
+
+    # Update months where the customer has updated header
+    # DO NOT TOUCH demographic, geographic key. Just search by customer and snapshot date key.
+
+    for entry in transactions:
+        time_key = entry[1] * 10000 + entry[2] * 100 + entry[3]
+        if first_snapshot_key is not None:
+            # A month of a changed order may still be missing, e.g. for a returning customer.
+            writer.add_default(customer_fk, time_key, demographic_fk, geographic_fk)
+        writer.add_scores(customer_fk, time_key, entry[4], entry[5], entry[6])
+
+        max_update_timestamp = max(max_update_timestamp, entry[-1])
+
+    return max_update_timestamp
+
+
+def _customer_batches(ms_cur: SourceCursor, previous_id: int, last_customer_id: int, batch_size: AdaptiveBatchSize):
+    # Page through the customers one batch at a time, keyed on CustomerID, instead of holding the
+    # whole list. Each page is read fully before it is handed out, so the cursor is free again
+    # for the batch's own queries. Every page takes the batch size of the moment.
+    while True:
+        ms_cur.execute(CUSTOMERS_SQL, (batch_size.size, previous_id, last_customer_id))
+        customers_batch = ms_cur.fetchall()
+        if len(customers_batch) == 0:
+            return
+
+        yield customers_batch
+        previous_id = customers_batch[-1][0]
+
+
+def _extract_batches(
+    ms_cur: SourceCursor,
+    previous_id: int,
+    last_customer_id: int,
+    last_updated_timestamp,
+    bulk_extract: bool,
+    batch_size: AdaptiveBatchSize,
+    scorer: RFMScorer | None = None,
+):
+    # Source of the fact pipeline: every batch of customers, with the source data of those that
+    # have transactions. This is the only place the source cursor is used during a fact load.
+    for customers_batch in _customer_batches(ms_cur, previous_id, last_customer_id, batch_size):
+        if bulk_extract:
+            extracted_batch = _extract_batch(ms_cur, customers_batch, last_updated_timestamp, scorer)
+        else:
+            extracted_batch = {}
+            for customerID, businessEntityID in customers_batch:
+                extracted = _extract_customer(ms_cur, customerID, businessEntityID, last_updated_timestamp)
+                if extracted is not None:
+                    extracted_batch[customerID] = extracted
+
+        yield (customers_batch, extracted_batch)
+
+
+def _transform_batch(batch):
+    # Parse the demographics XML of the batch, off the thread that writes to the warehouse.
+    (customers_batch, extracted_batch) = batch
+    demographics = demographic_transformer.parse_many(
+        [extracted[2] for extracted in extracted_batch.values()]
+    )
+    return (
+        customers_batch,
+        {
+            customerID: (transactions, geographic, demographic, start_date)
+            for (customerID, (transactions, geographic, _, start_date)), demographic in zip(
+                extracted_batch.items(), demographics
+            )
+        },
+    )
+
+
+def _load_customer_range(
+    ms_cur: SourceCursor,
     pg_cur: psycopg.Cursor,
     pg_conn: psycopg.Connection,
-    run_timestamp: date = date.today(),
-    last_updated_timestamp = date(1753, 1, 1)
+    caches: DimensionCaches,
+    parsed_run_timestamp: date,
+    last_updated_timestamp,
+    bulk_extract: bool,
+    previous_id: int,
+    last_customer_id: int,
+    max_update_timestamp: datetime,
+    save_checkpoint,
+    metrics: StageMetrics | None = None,
+    roll_forward: bool = False,
+    scorer: RFMScorer | None = None,
 ):
-    max_update_timestamp = datetime.min
-    previous_id = 0
+    # Load every customer in (previous_id, last_customer_id], committing a checkpoint after each batch.
+    # The checkpoint is the last CustomerID of the batch, so a load resumes whatever the batch sizes.
+    # Extraction, parsing and the warehouse writes of consecutive batches overlap.
+    # With roll_forward, the snapshot was already carried to the run month by _roll_forward, so
+    # customers that have a snapshot only get the months of their changed orders.
+
+    logger.info("Loading customers %s to %s...", previous_id + 1, last_customer_id)
+    current_batch_id = 0
+    loaded_customers = 0
+    writer = SnapshotWriter(pg_cur)
+    batch_size = AdaptiveBatchSize(f"customers {previous_id + 1} to {last_customer_id}")
 
+    def load(batch):
+        nonlocal max_update_timestamp, current_batch_id, loaded_customers
+        (customers_batch, extracted_batch) = batch
+        logger.info(
+            "Processing customers batch %s of %s customers, loaded %s customers so far",
+            current_batch_id,
+            len(customers_batch),
+            loaded_customers,
+        )
+        last_id = customers_batch[-1][0]
+
+        # Batches are recorded under their checkpoint, the last customer ID they cover.
+        with metrics.batch(last_id) if metrics is not None else nullcontext():
+            first_snapshots = {}
+            if roll_forward and len(extracted_batch) > 0:
+                pg_cur.execute(FIRST_SNAPSHOT_SQL, (list(extracted_batch),))
+                first_snapshots = dict(pg_cur.fetchall())
+
+            for customerID, _ in customers_batch:
+                extracted = extracted_batch.get(customerID)
+                if extracted is None:
+                    continue
+
+                max_update_timestamp = _load_customer(
+                    pg_cur,
+                    writer,
+                    caches,
+                    customerID,
+                    extracted,
+                    parsed_run_timestamp,
+                    max_update_timestamp,
+                    first_snapshots.get(customerID),
+                )
+
+            # Finished loading this batch, we write the snapshots, update the metadata and commit.
+            writer.flush()
+            save_checkpoint(pg_cur, last_id, max_update_timestamp)
+            started = time.perf_counter()
+            pg_conn.commit()
+            batch_size.record(len(customers_batch), time.perf_counter() - started)
+        current_batch_id += 1
+        loaded_customers += len(customers_batch)
+
+    run_pipeline(
+        "fact",
+        _extract_batches(ms_cur, previous_id, last_customer_id, last_updated_timestamp, bulk_extract, batch_size, scorer),
+        [("transform", _transform_batch)],
+        load,
+    )
+    batch_size.log_stats()
+
+    return max_update_timestamp
+
+
+def _insert_run_time(pg_cur: psycopg.Cursor, parsed_run_timestamp: date):
     # Insert the current run_timestamp into the fact table, if not exist
     # This is only relevant if the business make no new order on the run_timestamp...
-    parsed_run_timestamp = _date_conversion(run_timestamp)
+    # Also used for the months added by the roll-forward, for the same reason.
     pg_cur.execute(
         """
         INSERT INTO dimtime (timekey, "Day", "Month", "Year")
@@ -131,6 +543,92 @@ def load_fact(
         ),
     )
 
+
+def _roll_forward(pg_cur: psycopg.Cursor, parsed_run_timestamp: date):
+    # Add the months since the latest snapshot up to the run month, one set-based pass per month.
+    # The cost is one pass over the customers per new month, whatever the length of their history.
+    pg_cur.execute("SELECT MAX(snapshotdatekey) FROM factcustomermonthlysnapshot")
+    latest_key = pg_cur.fetchone()[0]
+    if latest_key is None:
+        return
+
+    previous_key = latest_key
+    next_month = _date_conversion(date(latest_key // 10000, latest_key // 100 % 100, 1) + timedelta(days=31))
+    if next_month > parsed_run_timestamp:
+        return
+
+    existing = partitions.existing_partitions(pg_cur) if partitions.is_partitioned(pg_cur) else None
+    # Every month reads the one before, the server runs the batch's statements in order.
+    rolled = []
+    with write_batch(pg_cur, "roll forward") as batch:
+        for year, month in _month_iterator(next_month, parsed_run_timestamp):
+            month_end = _date_conversion(date(year, month, 1))
+            _insert_run_time(batch, month_end)
+            month_key = _time_key(month_end)
+            parameters = {"month": month_key, "previous_month": previous_key}
+            if existing is not None and partitions.partition_name(month_end) not in existing:
+                # A month nobody wrote to yet: bulk-load it on its own, then attach it.
+                name = partitions.create_detached(batch, month_end)
+                inserted = batch.execute(
+                    f"INSERT INTO {name} (customerkey, snapshotdatekey, demographickey, geographickey, segmentkey, recency_score, frequency_score, monetary_score)"
+                    + ROLL_FORWARD_SELECT_SQL,
+                    parameters,
+                )
+                partitions.attach_partition(batch, month_end)
+            else:
+                inserted = batch.execute(ROLL_FORWARD_SQL, parameters)
+            rollups.mark_month(batch, month_key)
+            rolled.append((previous_key, month_key, inserted))
+            previous_key = month_key
+
+    for previous_key, month_key, inserted in rolled:
+        logger.info("Rolled %s snapshots forward from %s to %s", inserted.rowcount, previous_key, month_key)
+
+
+def _prepare_partitions(ms_cur: SourceCursor, pg_cur: psycopg.Cursor, parsed_run_timestamp: date):
+    # Create the partitions of every month the load may write to, ahead of the load.
+    # Months added by the roll-forward already have theirs.
+    if not partitions.is_partitioned(pg_cur):
+        return
+
+    ms_cur.execute(FIRST_ORDER_DATE_SQL)
+    first_order_date = ms_cur.fetchone()[0]
+    if first_order_date is not None:
+        partitions.ensure_partitions(pg_cur, first_order_date.date(), parsed_run_timestamp)
+
+
+def _save_checkpoint(pg_cur: psycopg.Cursor, last_id: int, max_update_timestamp: datetime):
+    pg_cur.execute("UPDATE etlmeta_factload SET batchid = %s, loadingtimestamp = %s", (last_id, max_update_timestamp))
+
+
+def load_fact(
+    ms_cur: SourceCursor,
+    pg_cur: psycopg.Cursor,
+    pg_conn: psycopg.Connection,
+    run_timestamp: date = date.today(),
+    last_updated_timestamp = date(1753, 1, 1),
+    bulk_extract: bool = True,
+    caches: DimensionCaches | None = None,
+    metrics: StageMetrics | None = None,
+    roll_forward: bool = False,
+    customer_range: tuple[int, int] | None = None,
+):
+    # customer_range: (first, last) CustomerID to load, every customer if None.
+    max_update_timestamp = datetime.min
+    caches = caches or DimensionCaches()
+    (first_customer_id, last_customer_id) = customer_range or (1, MAX_CUSTOMER_ID)
+    previous_id = first_customer_id - 1
+    # A resumed load reads the batches it already extracted back from the extract cache.
+    ms_cur = extract_cache.cursor(ms_cur)
+
+    parsed_run_timestamp = _date_conversion(run_timestamp)
+    _insert_run_time(pg_cur, parsed_run_timestamp)
+    if roll_forward:
+        # Idempotent, a resumed load finds nothing left to roll.
+        _roll_forward(pg_cur, parsed_run_timestamp)
+    _prepare_partitions(ms_cur, pg_cur, parsed_run_timestamp)
+    pg_conn.commit()
+
     # Do we have previous data?
     pg_cur.execute(
         """
@@ -142,99 +640,328 @@ def load_fact(
         # We do have data from previous run, that might have not finished.
         # Pick up from that point.
         logger.info("Detected an incomplete load. This load will pick up from that point instead of starting from scratch.")
-        previous_id = result[0]
+        previous_id = max(previous_id, result[0])
         max_update_timestamp = result[1]
 
-    # Get our list of customers.
-    ms_cur.execute(
-        """
-        SELECT c.CustomerID, p.BusinessEntityID
-        FROM Person.Person AS p
-            JOIN Sales.Customer AS c ON p.BusinessEntityID = c.PersonID
-        WHERE p.PersonType = 'IN' AND c.CustomerID > %s
-        ORDER BY c.CustomerID""",
-        (previous_id, )
+    # The per-customer path keeps scoring in TRANSACTION_SQL.
+    scorer = create_scorer(ms_cur) if bulk_extract else None
+
+    max_update_timestamp = _load_customer_range(
+        ms_cur,
+        pg_cur,
+        pg_conn,
+        caches,
+        parsed_run_timestamp,
+        last_updated_timestamp,
+        bulk_extract,
+        previous_id,
+        last_customer_id,
+        max_update_timestamp,
+        _save_checkpoint,
+        metrics,
+        roll_forward,
+        scorer,
     )
-    customers = ms_cur.fetchall()
 
-    logger.info("Loading customers...")
-    current_batch_id = 0
+    caches.log_stats()
 
-    # Batching into group of 500 customers
-    customers_batch_iter = itertools.batched(customers, 500)
+    return max_update_timestamp
 
-    for customers_batch in customers_batch_iter:
-        logger.info("Processing customers batch %s, loaded %s customers so far", current_batch_id, current_batch_id * 500)
-        last_id = 0
 
-        for customerID, businessEntityID in customers_batch:
-            last_id = customerID
+def _create_ranges(ms_cur: SourceCursor, pg_cur: psycopg.Cursor, previous_id: int, last_customer_id: int, range_count: int):
+    # Split the remaining customer IDs into ranges of equal width.
+    ms_cur.execute(CUSTOMER_ID_BOUNDS_SQL, (previous_id, last_customer_id))
+    (first_id, last_id) = ms_cur.fetchone()
+    if first_id is None:
+        return
 
-            # Do we have any transaction?
-            ms_cur.execute(TRANSACTION_SQL, (last_updated_timestamp, customerID))
-            transactions = ms_cur.fetchall()
+    width = max(1, -(-(last_id - first_id + 1) // range_count))
+    # Each range starts right after the previous one, resuming works as for the serial load.
+    with write_batch(pg_cur, "fact ranges") as batch:
+        batch.executemany(
+            "INSERT INTO etlmeta_factloadrange (rangeid, firstcustomerid, lastcustomerid, batchid, loadingtimestamp, finished) VALUES (%s, %s, %s, %s, %s, %s)",
+            [
+                (range_id, range_start, min(range_start + width - 1, last_id), None, None, False)
+                for range_id, range_start in enumerate(range(first_id, last_id + 1, width))
+            ],
+        )
 
-            if len(transactions) == 0:
-                continue
 
-            # There are transaction, so let's prepare to add them.
+def _load_range_worker(
+    pool: ConnectionPool,
+    range_row,
+    parsed_run_timestamp: date,
+    last_updated_timestamp,
+    bulk_extract: bool,
+    metrics: StageMetrics | None = None,
+    roll_forward: bool = False,
+    scorer: RFMScorer | None = None,
+    owner: str | None = None,
+):
+    # owner: the worker holding the range's lease in queue mode, None otherwise.
+    (range_id, first_id, last_id, batch_id, loading_timestamp) = range_row
 
-            # Get FKs for new snapshots
-            ms_cur.execute(GEOGRAPHIC_SQL, (businessEntityID,))
+    def save_checkpoint(pg_cur: psycopg.Cursor, last_id: int, max_update_timestamp: datetime):
+        if owner is None:
             pg_cur.execute(
-                "SELECT d.geographickey FROM dimgeographic AS d WHERE d.cityname = %s AND d.stateprovincename = %s AND d.countryregionname = %s AND d.territoryname = %s",
-                ms_cur.fetchone(),
+                "UPDATE etlmeta_factloadrange SET batchid = %s, loadingtimestamp = %s WHERE rangeid = %s",
+                (last_id, max_update_timestamp, range_id),
             )
-            geographic_fk = pg_cur.fetchone()[0]
+            return
+        pg_cur.execute(
+            LEASED_CHECKPOINT_SQL,
+            {"batch": last_id, "timestamp": max_update_timestamp, "lease": ETL_FACT_LEASE_SECONDS, "range": range_id, "owner": owner},
+        )
+        if pg_cur.rowcount == 0:
+            # Raised before the commit, the batch is rolled back and left to the new holder.
+            raise LeaseLost(f"Customer range {range_id} was claimed by another worker")
 
-            ms_cur.execute(DEMOGRAPHIC_SQL, (businessEntityID,))
-            pg_cur.execute(
-                "SELECT d.demographickey FROM dimdemographic AS d WHERE d.maritalstatus = %s AND d.ageband = %s AND d.yearlyincomelevel = %s AND d.numbercarsowned = %s AND d.education = %s AND d.occupation = %s AND d.ishomeowner = %s",
-                parse_demographic(ms_cur.fetchone()[0]),
+    with pool.connection() as (mssql_conn, pg_conn):
+        with mssql_conn.cursor() as ms_cur, pg_conn.cursor() as pg_cur:
+            if metrics is not None:
+                ms_cur = metrics.source_cursor(ms_cur)
+                pg_cur = metrics.warehouse_cursor(pg_cur)
+            ms_cur = extract_cache.cursor(ms_cur)
+            # Each worker resolves keys on its own connection, the dimensions are committed by now.
+            caches = DimensionCaches()
+            max_update_timestamp = _load_customer_range(
+                ms_cur,
+                pg_cur,
+                pg_conn,
+                caches,
+                parsed_run_timestamp,
+                last_updated_timestamp,
+                bulk_extract,
+                # Resume after the last committed batch of this range.
+                batch_id if batch_id is not None else first_id - 1,
+                last_id,
+                loading_timestamp or datetime.min,
+                save_checkpoint,
+                metrics,
+                roll_forward,
+                scorer,
             )
-            demographic_fk = pg_cur.fetchone()[0]
+            if owner is None:
+                pg_cur.execute(
+                    "UPDATE etlmeta_factloadrange SET finished = %s, loadingtimestamp = %s WHERE rangeid = %s",
+                    (True, max_update_timestamp, range_id),
+                )
+            else:
+                pg_cur.execute(
+                    LEASED_FINISH_SQL, {"timestamp": max_update_timestamp, "range": range_id, "owner": owner}
+                )
+                if pg_cur.rowcount == 0:
+                    raise LeaseLost(f"Customer range {range_id} was claimed by another worker")
+            pg_conn.commit()
+            caches.log_stats()
 
-            pg_cur.execute(
-                "SELECT d.customerkey FROM dimcustomer AS d WHERE d.customerid = %s",
-                (customerID,),
+    logger.info("Finished customer range %s (%s to %s)", range_id, first_id, last_id)
+    return max_update_timestamp
+
+
+def _queue_worker(
+    pool: ConnectionPool,
+    parsed_run_timestamp: date,
+    last_updated_timestamp,
+    bulk_extract: bool,
+    metrics: StageMetrics | None = None,
+    roll_forward: bool = False,
+    scorer: RFMScorer | None = None,
+) -> int:
+    # Claim and load ranges until none is left unfinished. Ranges held by live workers elsewhere
+    # are waited for, in case their lease runs out. Returns the number of ranges loaded here.
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    loaded = 0
+    while True:
+        with pool.connection() as (_, pg_conn):
+            with pg_conn.cursor() as pg_cur:
+                pg_cur.execute(CLAIM_RANGE_SQL, {"owner": owner, "lease": ETL_FACT_LEASE_SECONDS})
+                claimed = pg_cur.fetchone()
+                if claimed is None:
+                    pg_cur.execute("SELECT COUNT(*) FROM etlmeta_factloadrange WHERE NOT finished")
+                    unfinished = pg_cur.fetchone()[0]
+            # The claim holds no lock past here, the lease is what keeps it.
+            pg_conn.commit()
+
+        if claimed is None:
+            if unfinished == 0:
+                return loaded
+            time.sleep(ETL_FACT_QUEUE_POLL_SECONDS)
+            continue
+
+        (range_id, first_id, last_id, _, _, previous_owner) = claimed
+        if previous_owner is not None:
+            logger.warning("Re-leased customer range %s (%s to %s), the lease of %s ran out", range_id, first_id, last_id, previous_owner)
+        try:
+            _load_range_worker(
+                pool,
+                claimed[:5],
+                parsed_run_timestamp,
+                last_updated_timestamp,
+                bulk_extract,
+                metrics,
+                roll_forward,
+                scorer,
+                owner,
             )
-            customer_fk = pg_cur.fetchone()[0]
+        except LeaseLost as error:
+            logger.warning("%s, leaving it to them", error)
+            continue
+        loaded += 1
 
-            # Generate snapshots for all month since their first purchase if it does not exist
-            ms_cur.execute(START_DATE_SQL, (customerID,))
-            result = ms_cur.fetchone()
-            start_date = _date_conversion(result[0].date())
 
-            for year, month in _month_iterator(start_date, parsed_run_timestamp):
-                # Create the time key
-                time_key = year * 10000 + month * 100 + calendar.monthrange(year, month)[1]
-                # Attempt to insert default data, on conflict do nothing.
-                pg_cur.execute(
-                    """
-                    INSERT INTO factcustomermonthlysnapshot (customerkey, snapshotdatekey, demographickey, geographickey, segmentkey, recency_score, frequency_score, monetary_score)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (customerkey, snapshotdatekey) DO NOTHING""",
-                    (customer_fk, time_key, demographic_fk, geographic_fk, None, 1, 1, 1),
+def _drain_queue(
+    workers: int,
+    parsed_run_timestamp: date,
+    last_updated_timestamp,
+    bulk_extract: bool,
+    metrics: StageMetrics | None = None,
+    roll_forward: bool = False,
+    scorer: RFMScorer | None = None,
+) -> int:
+    pool = ConnectionPool(workers)
+    loaded = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _queue_worker,
+                    pool,
+                    parsed_run_timestamp,
+                    last_updated_timestamp,
+                    bulk_extract,
+                    metrics,
+                    roll_forward,
+                    scorer,
                 )
+                for _ in range(workers)
+            ]
+            # A failed range keeps its lease until it runs out, then any worker picks it up.
+            for future in as_completed(futures):
+                loaded += future.result()
+    finally:
+        pool.close()
+    logger.info("Fact queue drained, %s customer ranges loaded by this process", loaded)
+    return loaded
 
-            # Update months where the customer has updated header
-            # DO NOT TOUCH demographic, geographic key. Just search by customer and snapshot date key.
 
-            for entry in transactions:
-                time_key = entry[1] * 10000 + entry[2] * 100 + entry[3]
-                pg_cur.execute(
-                    """
-                    UPDATE factcustomermonthlysnapshot
-                    SET recency_score = %s, frequency_score = %s, monetary_score = %s
-                    WHERE customerkey = %s AND snapshotdatekey = %s""",
-                    (entry[4], entry[5], entry[6], customer_fk, time_key),
-                )
+def work_fact_queue(
+    ms_cur: SourceCursor,
+    workers: int,
+    run_timestamp: date = date.today(),
+    last_updated_timestamp = date(1753, 1, 1),
+    bulk_extract: bool = True,
+    metrics: StageMetrics | None = None,
+    roll_forward: bool = False,
+) -> int:
+    # Join a queue mode fact load started by another process (load_fact_parallel with queue):
+    # load its ranges on workers connections until the queue drains. The run that queued them
+    # finishes the load. The run parameters must be the ones of that run.
+    # Scored with edges fitted here, on the same source as the run that queued the ranges.
+    scorer = create_scorer(ms_cur) if bulk_extract else None
+    return _drain_queue(
+        workers,
+        _date_conversion(run_timestamp),
+        last_updated_timestamp,
+        bulk_extract,
+        metrics,
+        roll_forward,
+        scorer,
+    )
 
-                max_update_timestamp = max(max_update_timestamp, entry[-1])
 
-        # Finished loading this batch, we update the metadata and commit.
-        pg_cur.execute("UPDATE etlmeta_factload SET batchid = %s, loadingtimestamp = %s", (last_id, max_update_timestamp))
+def load_fact_parallel(
+    ms_cur: SourceCursor,
+    pg_cur: psycopg.Cursor,
+    pg_conn: psycopg.Connection,
+    workers: int,
+    ranges_per_worker: int,
+    run_timestamp: date = date.today(),
+    last_updated_timestamp = date(1753, 1, 1),
+    bulk_extract: bool = True,
+    metrics: StageMetrics | None = None,
+    roll_forward: bool = False,
+    customer_range: tuple[int, int] | None = None,
+    queue: bool = False,
+):
+    # Same result as load_fact, with the customer ID space split into ranges that are loaded
+    # concurrently. Every range keeps its own checkpoint in etlmeta_factloadrange, which is
+    # cleared by the caller together with etlmeta_factload once the whole load is finished.
+    # With queue, the ranges are claimed from the table (CLAIM_RANGE_SQL), by this process and
+    # by any other started with work_fact_queue, and this returns once every range is finished.
+    parsed_run_timestamp = _date_conversion(run_timestamp)
+    _insert_run_time(pg_cur, parsed_run_timestamp)
+    if roll_forward:
+        _roll_forward(pg_cur, parsed_run_timestamp)
+    _prepare_partitions(ms_cur, pg_cur, parsed_run_timestamp)
+
+    pg_cur.execute("SELECT COUNT(*) FROM etlmeta_factloadrange")
+    if pg_cur.fetchone()[0] == 0:
+        # Fresh load, or a serial load that was interrupted: pick up from its checkpoint.
+        pg_cur.execute("SELECT d.batchid, d.loadingtimestamp FROM etlmeta_factload AS d")
+        (previous_id, previous_timestamp) = pg_cur.fetchone()
+        (first_customer_id, last_customer_id) = customer_range or (1, MAX_CUSTOMER_ID)
+        previous_id = max(previous_id or 0, first_customer_id - 1)
+        _create_ranges(ms_cur, pg_cur, previous_id, last_customer_id, workers * ranges_per_worker)
+        # Carry the serial checkpoint's timestamp over, by storing it on the first range.
+        if previous_timestamp is not None:
+            pg_cur.execute(
+                "UPDATE etlmeta_factloadrange SET loadingtimestamp = %s WHERE rangeid = 0",
+                (previous_timestamp,),
+            )
+    else:
+        logger.info("Detected an incomplete parallel load. Unfinished ranges will pick up from their checkpoint.")
+
+    # Workers need the run month in dimtime and the ranges to be visible, commit them.
+    pg_conn.commit()
+
+    # Fitted once, every range is scored with the same edges.
+    scorer = create_scorer(ms_cur) if bulk_extract else None
+
+    if queue:
+        pg_cur.execute("SELECT COUNT(*) FROM etlmeta_factloadrange WHERE NOT finished")
+        logger.info(
+            "Queued %s customer ranges, other machines can join with python etl/main.py --fact-worker",
+            pg_cur.fetchone()[0],
+        )
         pg_conn.commit()
-        current_batch_id += 1
+        _drain_queue(workers, parsed_run_timestamp, last_updated_timestamp, bulk_extract, metrics, roll_forward, scorer)
+        return _fact_watermark(pg_cur)
 
-    return max_update_timestamp
+    pg_cur.execute(
+        "SELECT rangeid, firstcustomerid, lastcustomerid, batchid, loadingtimestamp FROM etlmeta_factloadrange WHERE NOT finished ORDER BY rangeid"
+    )
+    pending = pg_cur.fetchall()
+    logger.info("Loading %s customer ranges on %s workers", len(pending), workers)
+
+    pool = ConnectionPool(workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _load_range_worker,
+                    pool,
+                    range_row,
+                    parsed_run_timestamp,
+                    last_updated_timestamp,
+                    bulk_extract,
+                    metrics,
+                    roll_forward,
+                    scorer,
+                )
+                for range_row in pending
+            ]
+            # Surface the first failure. Finished ranges are committed, so a rerun resumes after them.
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        pool.close()
+
+    return _fact_watermark(pg_cur)
+
+
+def _fact_watermark(pg_cur: psycopg.Cursor) -> datetime:
+    # The load's watermark, over the watermarks of every range, whichever worker loaded them.
+    pg_cur.execute("SELECT MAX(loadingtimestamp) FROM etlmeta_factloadrange")
+    max_update_timestamp = pg_cur.fetchone()[0]
+    return max_update_timestamp if max_update_timestamp is not None else datetime.min
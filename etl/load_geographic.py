@@ -1,6 +1,11 @@
 import datetime
 import psycopg
-import pymssql
+
+from bulk_upsert import GEOGRAPHIC_UPSERTER
+from connection import SourceCursor
+from dimension_cache import DimensionCaches
+from pipeline import run_pipeline
+from streaming import stream_chunks
 
 LOAD_GEOGRAPHIC_SQL = """
 SELECT DISTINCT
@@ -51,48 +56,55 @@ WHERE person.BusinessEntityID IN (
 AND (person_address.ModifiedDate > %(time)s OR address_data.ModifiedDate > %(time)s OR state_data.ModifiedDate > %(time)s OR territory_data.ModifiedDate > %(time)s)
 """
 
-def load_geographic_initial(ms_cur: pymssql.Cursor, pg_cur: psycopg.Cursor):
+def load_geographic_initial(
+    ms_cur: SourceCursor, pg_cur: psycopg.Cursor, caches: DimensionCaches | None = None
+):
     ms_cur.execute(LOAD_GEOGRAPHIC_SQL)
-    results = ms_cur.fetchall()
 
     max_timestamp = datetime.datetime.min
 
     with pg_cur.copy(
         "COPY dimgeographic (cityname, stateprovincename, countryregionname, territoryname) FROM STDIN"
     ) as copy:
-        for row in results:
-            max_timestamp = max(max_timestamp, row[4], row[5], row[6], row[7])
-            copy.write_row(row[0:4])
+        def load(rows):
+            nonlocal max_timestamp
+            for row in rows:
+                max_timestamp = max(max_timestamp, row[4], row[5], row[6], row[7])
+                copy.write_row(row[0:4])
+
+        # Nothing to transform, the extraction still overlaps with the COPY.
+        run_pipeline("geographic", stream_chunks(ms_cur), [], load)
+
+    if caches is not None:
+        caches.geographic.invalidate()
 
     return max_timestamp
 
 
 def load_geographic_incremental(
-    ms_cur: pymssql.Cursor, pg_cur: psycopg.Cursor, timestamp: datetime.datetime
+    ms_cur: SourceCursor,
+    pg_cur: psycopg.Cursor,
+    timestamp: datetime.datetime,
+    caches: DimensionCaches | None = None,
 ) -> datetime:
     ms_cur.execute(LOAD_GEOGRAPHIC_SQL_INC, {"time": timestamp})
-    results = ms_cur.fetchall()
 
-    if len(results) == 0 or results is None:
-        return
+    # Nothing changed keeps the previous timestamp.
+    max_timestamp = timestamp
+    caches = caches or DimensionCaches()
 
-    max_timestamp = datetime.datetime.min
+    # Cannot COPY straight into the dimension since the column may be duplicated, go through the upserter.
+    # The key cache remembers the key of whatever we insert.
+    def load(rows):
+        nonlocal max_timestamp
+        for row in rows:
+            max_timestamp = max(max_timestamp, row[4], row[5], row[6], row[7])
 
-    # Cannot use copy in incremental loading due to the fact that the column may be duplicated.
-    for row in results:
-        max_timestamp = max(max_timestamp, row[4], row[5], row[6], row[7])
+        inserted = GEOGRAPHIC_UPSERTER.upsert(pg_cur, (row[0:4] for row in rows))
+        for natural_key, key in inserted.items():
+            caches.geographic.add(natural_key, key)
 
-        if (
-            pg_cur.execute(
-                "SELECT d.geographickey FROM dimgeographic AS d WHERE d.cityname = %s AND d.stateprovincename = %s AND d.countryregionname = %s AND d.territoryname = %s",
-                row,
-            ).fetchone()
-            is None
-        ):
-            pg_cur.execute(
-                "INSERT INTO dimgeographic (cityname, stateprovincename, countryregionname, territoryname) VALUES (%s, %s, %s, %s)",
-                row,
-            )
+    run_pipeline("geographic", stream_chunks(ms_cur), [], load)
 
     # Return the largest timestamp of this dimension
     return max_timestamp
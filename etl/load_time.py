@@ -1,7 +1,11 @@
 import calendar
 import datetime
 import psycopg
-import pymssql
+
+from bulk_upsert import TIME_UPSERTER
+from connection import SourceCursor
+from pipeline import run_pipeline
+from streaming import stream_chunks
 
 LOAD_TIME_SQL = """
 SELECT
@@ -33,43 +37,52 @@ AND header.ModifiedDate > %s
 GROUP BY DATEPART(year, header.OrderDate), DATEPART(month, header.OrderDate)
 """
 
-def load_time_initial(ms_cur: pymssql.Cursor, pg_cur: psycopg.Cursor):
+def _transform_months(rows):
+    # (TimeKey, Day, Month, Year, ModifiedDate) of each month
+    months = []
+    for row in rows:
+        day = calendar.monthrange(row[1], row[0])[1]
+        key = row[1] * 10000 + row[0] * 100 + day
+        months.append((key, day, row[0], row[1], row[2]))
+    return months
+
+
+def load_time_initial(ms_cur: SourceCursor, pg_cur: psycopg.Cursor):
     ms_cur.execute(LOAD_TIME_SQL)
-    results = ms_cur.fetchall()
 
     max_modified_date = datetime.datetime.min
 
     with pg_cur.copy(
         "COPY dimtime (timekey, \"Day\", \"Month\", \"Year\") FROM STDIN"
     ) as copy:
-        for row in results:
-            max_modified_date = max(max_modified_date, row[2])
+        def load(months):
+            nonlocal max_modified_date
+            for month in months:
+                max_modified_date = max(max_modified_date, month[4])
+                copy.write_row(month[0:4])
 
-            day = calendar.monthrange(row[1], row[0])[1]
-            key = row[1] * 10000 + row[0] * 100 + day
-            copy.write_row((key, day, row[0], row[1]))
+        run_pipeline("time", stream_chunks(ms_cur), [("transform", _transform_months)], load)
+
+    return max_modified_date
 
 
 def load_time_incremental(
-    ms_cur: pymssql.Cursor, pg_cur: psycopg.Cursor, timestamp: datetime.datetime
+    ms_cur: SourceCursor, pg_cur: psycopg.Cursor, timestamp: datetime.datetime
 ) -> datetime:
     ms_cur.execute(LOAD_TIME_INC_SQL, (timestamp, ))
-    results = ms_cur.fetchall()
 
-    if len(results) == 0 or results is None:
-        return
-    
-    max_modified_date = datetime.datetime.min
+    # Nothing changed keeps the previous timestamp.
+    max_modified_date = timestamp
 
-    # Cannot use copy in incremental loading due to the fact that the column may be duplicated.
-    for row in results:
-        day = calendar.monthrange(row[1], row[0])[1]
-        key = row[1] * 10000 + row[0] * 100 + day
+    # Cannot COPY straight into the dimension since the month may already exist, go through the upserter.
+    def load(months):
+        nonlocal max_modified_date
+        for month in months:
+            max_modified_date = max(max_modified_date, month[4])
 
-        max_modified_date = max(max_modified_date, row[2])
+        TIME_UPSERTER.upsert(pg_cur, (month[0:4] for month in months))
 
-        if pg_cur.execute("SELECT * FROM dimtime AS d WHERE d.timekey = %s", key).fetchone() is None:
-            pg_cur.execute("INSERT INTO dimtime (timekey, \"Day\", \"Month\", \"Year\") VALUES (%s, %s, %s, %s)", (key, day, row[0], row[1]))
+    run_pipeline("time", stream_chunks(ms_cur), [("transform", _transform_months)], load)
 
     # Return the largest timestamp found for this dimension
     return max_modified_date
\ No newline at end of file
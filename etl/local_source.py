@@ -0,0 +1,461 @@
+import datetime
+from decimal import Decimal
+from logging import getLogger
+import logging
+import os
+import sqlite3
+import sys
+
+from connection import connect_mssql
+from streaming import stream_chunks
+import backfill
+import change_detection
+import load_customer_demographic
+import load_fact
+import load_geographic
+import load_time
+import rfm
+
+logger = getLogger(__name__)
+
+# A local stand-in for the SQL Server source: the AdventureWorks columns the loaders read, in a
+# SQLite file, each Schema.Table as Schema_Table. Every source query of the loaders has an
+# equivalent over it in LOCAL_QUERIES, returning the same columns with the same types, so the
+# pipeline can run, be profiled and be load-tested without a restored SQL Server.
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS Person_Person (
+    BusinessEntityID INTEGER PRIMARY KEY,
+    PersonType TEXT NOT NULL,
+    FirstName TEXT,
+    MiddleName TEXT,
+    LastName TEXT,
+    Suffix TEXT,
+    EmailPromotion INTEGER,
+    Demographics TEXT,
+    ModifiedDate TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS Sales_Customer (
+    CustomerID INTEGER PRIMARY KEY,
+    PersonID INTEGER
+);
+CREATE TABLE IF NOT EXISTS Sales_SalesOrderHeader (
+    SalesOrderID INTEGER PRIMARY KEY,
+    CustomerID INTEGER NOT NULL,
+    OrderDate TEXT NOT NULL,
+    Status INTEGER NOT NULL,
+    SubTotal REAL NOT NULL,
+    ModifiedDate TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS Person_BusinessEntityAddress (
+    BusinessEntityID INTEGER NOT NULL,
+    AddressID INTEGER NOT NULL,
+    AddressTypeID INTEGER NOT NULL,
+    ModifiedDate TEXT NOT NULL,
+    PRIMARY KEY (BusinessEntityID, AddressID, AddressTypeID)
+);
+CREATE TABLE IF NOT EXISTS Person_Address (
+    AddressID INTEGER PRIMARY KEY,
+    City TEXT NOT NULL,
+    StateProvinceID INTEGER NOT NULL,
+    ModifiedDate TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS Person_StateProvince (
+    StateProvinceID INTEGER PRIMARY KEY,
+    Name TEXT NOT NULL,
+    CountryRegionCode TEXT NOT NULL,
+    TerritoryID INTEGER NOT NULL,
+    ModifiedDate TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS Person_CountryRegion (
+    CountryRegionCode TEXT PRIMARY KEY,
+    Name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS Sales_SalesTerritory (
+    TerritoryID INTEGER PRIMARY KEY,
+    Name TEXT NOT NULL,
+    ModifiedDate TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS IX_Customer_Person ON Sales_Customer (PersonID);
+CREATE INDEX IF NOT EXISTS IX_Header_Customer ON Sales_SalesOrderHeader (CustomerID, OrderDate);
+CREATE INDEX IF NOT EXISTS IX_Header_Modified ON Sales_SalesOrderHeader (ModifiedDate);
+"""
+# Table -> the columns copied from SQL Server by export(), in the order of SCHEMA_SQL.
+TABLES = {
+    "Person.Person": ("BusinessEntityID", "PersonType", "FirstName", "MiddleName", "LastName", "Suffix", "EmailPromotion", "Demographics", "ModifiedDate"),
+    "Sales.Customer": ("CustomerID", "PersonID"),
+    "Sales.SalesOrderHeader": ("SalesOrderID", "CustomerID", "OrderDate", "Status", "SubTotal", "ModifiedDate"),
+    "Person.BusinessEntityAddress": ("BusinessEntityID", "AddressID", "AddressTypeID", "ModifiedDate"),
+    "Person.Address": ("AddressID", "City", "StateProvinceID", "ModifiedDate"),
+    "Person.StateProvince": ("StateProvinceID", "Name", "CountryRegionCode", "TerritoryID", "ModifiedDate"),
+    "Person.CountryRegion": ("CountryRegionCode", "Name"),
+    "Sales.SalesTerritory": ("TerritoryID", "Name", "ModifiedDate"),
+}
+
+# Dates are stored as ISO text, which compares in date order. Result columns named
+# "Name [etl_datetime]" or "Name [etl_money]" come back as pymssql returns them.
+sqlite3.register_converter("etl_datetime", lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("etl_money", lambda value: Decimal(value.decode()).quantize(Decimal("0.0001")))
+
+
+def _year(column: str) -> str:
+    return f"CAST(strftime('%Y', {column}) AS INTEGER)"
+
+
+def _month(column: str) -> str:
+    return f"CAST(strftime('%m', {column}) AS INTEGER)"
+
+
+_INDIVIDUAL_CUSTOMERS = """
+    SELECT p.BusinessEntityID
+    FROM Person_Person AS p
+        JOIN Sales_Customer AS c ON c.PersonID = p.BusinessEntityID
+    WHERE p.PersonType = 'IN'"""
+_GEOGRAPHIC_JOINS = """
+    JOIN Person_BusinessEntityAddress AS person_address ON person.BusinessEntityID = person_address.BusinessEntityID
+    JOIN Person_Address AS address_data ON person_address.AddressID = address_data.AddressID
+    JOIN Person_StateProvince AS state_data ON state_data.StateProvinceID = address_data.StateProvinceID
+    JOIN Person_CountryRegion AS country_data ON state_data.CountryRegionCode = country_data.CountryRegionCode
+    JOIN Sales_SalesTerritory AS territory_data ON state_data.TerritoryID = territory_data.TerritoryID"""
+_CUSTOMER_DEMOGRAPHIC = """
+SELECT customer.CustomerID, person.FirstName, person.MiddleName, person.LastName, person.Suffix,
+    person.Demographics, person.EmailPromotion, person.ModifiedDate AS "ModifiedDate [etl_datetime]"
+FROM Person_Person AS person
+    JOIN Sales_Customer AS customer ON person.BusinessEntityID = customer.PersonID
+WHERE person.PersonType = 'IN'"""
+_TIME = f"""
+SELECT {_month("header.OrderDate")} AS OrderMonth, {_year("header.OrderDate")} AS OrderYear,
+    MAX(header.ModifiedDate) AS "ModifiedDate [etl_datetime]"
+FROM Sales_SalesOrderHeader AS header
+WHERE header.Status != 6 AND header.CustomerID IN (
+    SELECT c.CustomerID
+    FROM Person_Person AS p
+        JOIN Sales_Customer AS c ON c.PersonID = p.BusinessEntityID
+    WHERE p.PersonType = 'IN'
+){{}}
+GROUP BY OrderYear, OrderMonth"""
+# The month aggregates of TRANSACTION_SQL, for the orders of the months with a changed order.
+_MONTH_AGGREGATES = f"""
+SELECT
+    header.CustomerID,
+    {_year("header.OrderDate")} AS OrderYear,
+    {_month("header.OrderDate")} AS OrderMonth,
+    COUNT(header.SalesOrderID) AS MonthCount,
+    IFNULL(SUM(header.SubTotal), 0) AS MonthTotal,
+    MAX(header.OrderDate) AS LatestOrderDate,
+    MAX(header.ModifiedDate) AS LatestModifiedDate
+FROM Sales_SalesOrderHeader AS header
+WHERE header.Status != 6
+    AND EXISTS (
+        SELECT 1
+        FROM Sales_SalesOrderHeader AS changed
+        WHERE changed.CustomerID = header.CustomerID
+            AND changed.ModifiedDate > ?1
+            AND strftime('%Y-%m', changed.OrderDate) = strftime('%Y-%m', header.OrderDate)
+    )
+    AND {{}}
+GROUP BY header.CustomerID, OrderYear, OrderMonth"""
+# The CASE expressions of TRANSACTION_SQL. money / int keeps four decimals, CAST(money AS INT) rounds.
+_TRANSACTION = f"""
+WITH RawData AS ({_MONTH_AGGREGATES}
+), Measures AS (
+    SELECT rd.*,
+        CAST(strftime('%d', date(printf('%04d-%02d-01', rd.OrderYear, rd.OrderMonth), '+1 month', '-1 day')) AS INTEGER) AS MonthDays,
+        ROUND(rd.MonthTotal * 1.0 / rd.MonthCount, 4) AS Average
+    FROM RawData AS rd
+)
+SELECT
+    CustomerID,
+    OrderYear,
+    OrderMonth,
+    MonthDays AS OrderDay,
+    5 - MAX((MonthDays - CAST(strftime('%d', LatestOrderDate) AS INTEGER) - 1) / 7, 0) AS Recency,
+    CASE WHEN MonthCount >= 5 THEN 5 ELSE MIN(4, MonthCount + 1) END AS Frequency,
+    CASE WHEN Average < 300 THEN 1 ELSE MIN(2 + CAST(ROUND(Average) AS INTEGER) / 1000, 5) END AS Monetary,
+    LatestModifiedDate AS "ModifiedDate [etl_datetime]"
+FROM Measures
+ORDER BY {{}}"""
+
+LOCAL_QUERIES = {
+    backfill.MONTH_CUSTOMERS_SQL: """
+SELECT c.CustomerID
+FROM Person_Person AS p
+    JOIN Sales_Customer AS c ON p.BusinessEntityID = c.PersonID
+WHERE p.PersonType = 'IN' AND EXISTS (
+    SELECT 1
+    FROM Sales_SalesOrderHeader AS header
+    WHERE header.CustomerID = c.CustomerID AND header.Status != 6 AND header.OrderDate < ?
+)""",
+    backfill.MONTH_ORDER_AGGREGATE_SQL: f"""
+SELECT
+    header.CustomerID,
+    {_year("header.OrderDate")} AS OrderYear,
+    {_month("header.OrderDate")} AS OrderMonth,
+    COUNT(header.SalesOrderID) AS MonthCount,
+    IFNULL(SUM(header.SubTotal), 0) AS "MonthTotal [etl_money]",
+    MAX(header.OrderDate) AS "LatestOrderDate [etl_datetime]",
+    MAX(header.ModifiedDate) AS "LatestModifiedDate [etl_datetime]"
+FROM Sales_SalesOrderHeader AS header
+WHERE header.Status != 6 AND header.OrderDate >= ? AND header.OrderDate < ?
+GROUP BY header.CustomerID, OrderYear, OrderMonth""",
+    change_detection.SOURCE_WATERMARKS_SQL: f"""
+SELECT
+    orders.SalesOrderHeader AS "SalesOrderHeader [etl_datetime]",
+    persons.Person AS "Person [etl_datetime]",
+    addresses.BusinessEntityAddress AS "BusinessEntityAddress [etl_datetime]",
+    addresses.Address AS "Address [etl_datetime]",
+    addresses.StateProvince AS "StateProvince [etl_datetime]",
+    addresses.SalesTerritory AS "SalesTerritory [etl_datetime]",
+    orders.FirstChangedCustomerID,
+    orders.LastChangedCustomerID
+FROM (
+    SELECT
+        MAX(CASE WHEN header.Status != 6 THEN header.ModifiedDate END) AS SalesOrderHeader,
+        MIN(CASE WHEN header.ModifiedDate > ?1 THEN header.CustomerID END) AS FirstChangedCustomerID,
+        MAX(CASE WHEN header.ModifiedDate > ?2 THEN header.CustomerID END) AS LastChangedCustomerID
+    FROM Sales_SalesOrderHeader AS header
+        JOIN Sales_Customer AS c ON c.CustomerID = header.CustomerID
+        JOIN Person_Person AS p ON p.BusinessEntityID = c.PersonID
+    WHERE p.PersonType = 'IN'
+) AS orders
+CROSS JOIN (
+    SELECT MAX(person.ModifiedDate) AS Person
+    FROM Person_Person AS person
+        JOIN Sales_Customer AS customer ON person.BusinessEntityID = customer.PersonID
+    WHERE person.PersonType = 'IN'
+) AS persons
+CROSS JOIN (
+    SELECT
+        MAX(person_address.ModifiedDate) AS BusinessEntityAddress,
+        MAX(address_data.ModifiedDate) AS Address,
+        MAX(state_data.ModifiedDate) AS StateProvince,
+        MAX(territory_data.ModifiedDate) AS SalesTerritory
+    FROM Person_Person AS person{_GEOGRAPHIC_JOINS}
+    WHERE person.BusinessEntityID IN ({_INDIVIDUAL_CUSTOMERS}
+    ) AND person_address.AddressTypeID = 2
+) AS addresses""",
+    # Sales_Customer and Person_CountryRegion have no ModifiedDate here, their row count versions them.
+    change_detection.SOURCE_VERSIONS_SQL: "SELECT\n" + ",\n".join(
+        f"    (SELECT {'NULL' if table in ('Sales.Customer', 'Person.CountryRegion') else 'MAX(ModifiedDate)'} FROM {table.replace('.', '_')}),"
+        f" (SELECT COUNT(*) FROM {table.replace('.', '_')})"
+        for table in change_detection.VERSIONED_TABLES
+    ),
+    load_customer_demographic.CUSTOMER_DEMOGRAPHIC_SQL: _CUSTOMER_DEMOGRAPHIC,
+    load_customer_demographic.CUSTOMER_DEMOGRAPHIC_INC_SQL: _CUSTOMER_DEMOGRAPHIC + " AND person.ModifiedDate > ?",
+    load_geographic.LOAD_GEOGRAPHIC_SQL: f"""
+SELECT address_data.City, state_data.Name, country_data.Name, territory_data.Name,
+    MAX(person_address.ModifiedDate) AS "paModifiedDate [etl_datetime]",
+    MAX(address_data.ModifiedDate) AS "adModifiedDate [etl_datetime]",
+    MAX(state_data.ModifiedDate) AS "sdModifiedDate [etl_datetime]",
+    MAX(territory_data.ModifiedDate) AS "tdModifiedDate [etl_datetime]"
+FROM Person_Person AS person{_GEOGRAPHIC_JOINS}
+WHERE person.BusinessEntityID IN ({_INDIVIDUAL_CUSTOMERS}
+) AND person_address.AddressTypeID = 2
+GROUP BY address_data.City, state_data.Name, country_data.Name, territory_data.Name""",
+    load_geographic.LOAD_GEOGRAPHIC_SQL_INC: f"""
+SELECT DISTINCT address_data.City, state_data.Name, country_data.Name, territory_data.Name,
+    person_address.ModifiedDate AS "paModifiedDate [etl_datetime]",
+    address_data.ModifiedDate AS "adModifiedDate [etl_datetime]",
+    state_data.ModifiedDate AS "sdModifiedDate [etl_datetime]",
+    territory_data.ModifiedDate AS "tdModifiedDate [etl_datetime]"
+FROM Person_Person AS person{_GEOGRAPHIC_JOINS}
+WHERE person.BusinessEntityID IN ({_INDIVIDUAL_CUSTOMERS}
+) AND person_address.AddressTypeID = 2
+AND (person_address.ModifiedDate > :time OR address_data.ModifiedDate > :time OR state_data.ModifiedDate > :time OR territory_data.ModifiedDate > :time)""",
+    load_time.LOAD_TIME_SQL: _TIME.format(""),
+    load_time.LOAD_TIME_INC_SQL: _TIME.format("\nAND header.ModifiedDate > ?"),
+    load_fact.TRANSACTION_SQL: _TRANSACTION.format(
+        "header.CustomerID = ?2", "OrderYear, OrderMonth, CustomerID"
+    ),
+    load_fact.BULK_TRANSACTION_SQL: _TRANSACTION.format(
+        "header.CustomerID BETWEEN ?2 AND ?3", "CustomerID, OrderYear, OrderMonth"
+    ),
+    load_fact.BULK_ORDER_AGGREGATE_SQL: f"""
+SELECT CustomerID, OrderYear, OrderMonth, MonthCount, MonthTotal AS "MonthTotal [etl_money]",
+    LatestOrderDate AS "LatestOrderDate [etl_datetime]", LatestModifiedDate AS "LatestModifiedDate [etl_datetime]"
+FROM ({_MONTH_AGGREGATES.format("header.CustomerID BETWEEN ?2 AND ?3")})
+ORDER BY CustomerID, OrderYear, OrderMonth""",
+    load_fact.GEOGRAPHIC_SQL: f"""
+SELECT address_data.City, state_data.Name, country_data.Name, territory_data.Name
+FROM Person_Person AS person{_GEOGRAPHIC_JOINS}
+WHERE person.BusinessEntityID = ? AND person_address.AddressTypeID = 2""",
+    load_fact.BULK_GEOGRAPHIC_SQL: f"""
+SELECT customer.CustomerID, address_data.City, state_data.Name, country_data.Name, territory_data.Name
+FROM Person_Person AS person
+    JOIN Sales_Customer AS customer ON person.BusinessEntityID = customer.PersonID{_GEOGRAPHIC_JOINS}
+WHERE customer.CustomerID BETWEEN ? AND ? AND person_address.AddressTypeID = 2""",
+    load_fact.DEMOGRAPHIC_SQL: "SELECT person.Demographics FROM Person_Person AS person WHERE person.BusinessEntityID = ?",
+    load_fact.BULK_DEMOGRAPHIC_SQL: """
+SELECT customer.CustomerID, person.Demographics
+FROM Person_Person AS person
+    JOIN Sales_Customer AS customer ON person.BusinessEntityID = customer.PersonID
+WHERE customer.CustomerID BETWEEN ? AND ?""",
+    load_fact.START_DATE_SQL: """
+SELECT header.OrderDate AS "OrderDate [etl_datetime]"
+FROM Sales_SalesOrderHeader AS header
+WHERE header.Status != 6 AND header.CustomerID = ?
+ORDER BY header.OrderDate
+LIMIT 1""",
+    load_fact.BULK_START_DATE_SQL: """
+SELECT header.CustomerID, MIN(header.OrderDate) AS "OrderDate [etl_datetime]"
+FROM Sales_SalesOrderHeader AS header
+WHERE header.Status != 6 AND header.CustomerID BETWEEN ? AND ?
+GROUP BY header.CustomerID""",
+    load_fact.CUSTOMERS_SQL: """
+SELECT c.CustomerID, p.BusinessEntityID
+FROM Person_Person AS p
+    JOIN Sales_Customer AS c ON p.BusinessEntityID = c.PersonID
+WHERE p.PersonType = 'IN' AND c.CustomerID > ?2 AND c.CustomerID <= ?3
+ORDER BY c.CustomerID
+LIMIT ?1""",
+    load_fact.CUSTOMER_ID_BOUNDS_SQL: """
+SELECT MIN(c.CustomerID), MAX(c.CustomerID)
+FROM Person_Person AS p
+    JOIN Sales_Customer AS c ON p.BusinessEntityID = c.PersonID
+WHERE p.PersonType = 'IN' AND c.CustomerID > ? AND c.CustomerID <= ?""",
+    load_fact.FIRST_ORDER_DATE_SQL: """
+SELECT MIN(header.OrderDate) AS "OrderDate [etl_datetime]"
+FROM Sales_SalesOrderHeader AS header
+WHERE header.Status != 6""",
+    rfm.POPULATION_SQL: f"""
+SELECT {_year("header.OrderDate")} AS OrderYear, {_month("header.OrderDate")} AS OrderMonth,
+    COUNT(header.SalesOrderID) AS MonthCount,
+    IFNULL(SUM(header.SubTotal), 0) AS "MonthTotal [etl_money]",
+    MAX(header.OrderDate) AS "LatestOrderDate [etl_datetime]"
+FROM Sales_SalesOrderHeader AS header
+WHERE header.Status != 6
+GROUP BY header.CustomerID, OrderYear, OrderMonth""",
+}
+
+
+def _parameter(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+class LocalCursor:
+    # A source cursor over the SQLite extract: runs the local equivalent of each loader query.
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self._cursor = cursor
+
+    def execute(self, query: str, params=None):
+        local_query = LOCAL_QUERIES.get(query)
+        if local_query is None:
+            raise NotImplementedError(f"No local equivalent of the source query:\n{query}")
+
+        if params is None:
+            params = ()
+        elif isinstance(params, dict):
+            params = {name: _parameter(value) for name, value in params.items()}
+        else:
+            params = tuple(_parameter(value) for value in params)
+        self._cursor.execute(local_query, params)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size: int = 1) -> list:
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self) -> list:
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalConnection:
+    # Read-only connection to the extract, closed on leaving the with block like pymssql's.
+
+    def __init__(self, path: str):
+        # Cursors are handed from thread to thread by run_pipeline, never used concurrently.
+        self._connection = sqlite3.connect(
+            f"file:{path}?mode=ro",
+            uri=True,
+            detect_types=sqlite3.PARSE_COLNAMES,
+            check_same_thread=False,
+        )
+
+    def cursor(self) -> LocalCursor:
+        return LocalCursor(self._connection.cursor())
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def connect_local(path: str) -> LocalConnection:
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No local source at {path}, export one with python etl/local_source.py export")
+    return LocalConnection(path)
+
+
+def create_local(path: str) -> sqlite3.Connection:
+    # An empty extract, for export() or a data generator to fill.
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA_SQL)
+    return connection
+
+
+def _stored(value):
+    # Values as stored in the extract, the inverse of the converters above.
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def export(path: str):
+    # Copy the source tables the loaders read from SQL Server into a new extract at path.
+    if os.path.exists(path):
+        os.remove(path)
+    with create_local(path) as local_conn, connect_mssql() as mssql_conn:
+        with mssql_conn.cursor() as ms_cur:
+            for table, columns in TABLES.items():
+                ms_cur.execute(f"SELECT {', '.join(columns)} FROM {table}")
+                insert = f"INSERT INTO {table.replace('.', '_')} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+                exported = 0
+                for rows in stream_chunks(ms_cur):
+                    local_conn.executemany(insert, ([_stored(value) for value in row] for row in rows))
+                    exported += len(rows)
+                logger.info("Exported %s rows of %s", exported, table)
+    local_conn.close()
+
+
+if __name__ == "__main__":
+    # python etl/local_source.py export [path]: extract the source for ETL_SOURCE=local.
+    from config import ETL_LOCAL_SOURCE_PATH
+
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:2] == ["export"]:
+        export(sys.argv[2] if len(sys.argv) > 2 else ETL_LOCAL_SOURCE_PATH)
+    else:
+        print("Usage: python etl/local_source.py export [path]")
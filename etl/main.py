@@ -1,197 +1,382 @@
-from datetime import date
+import argparse
+from datetime import date, datetime
+from functools import partial
 from logging import getLogger
 import logging
-from os import getenv
-from dotenv import load_dotenv
 import psycopg
-import pymssql
 
-from load_fact import load_fact
+from age_bands import rekey_age_bands
+from backfill import backfill
+from change_detection import Changes, detect_changes
+from config import (
+    ETL_CHANGE_DETECTION,
+    ETL_DIMENSION_WORKERS,
+    ETL_FACT_QUEUE,
+    ETL_FACT_RANGES_PER_WORKER,
+    ETL_FACT_ROLL_FORWARD,
+    ETL_FACT_WORKERS,
+    ETL_INDEX_BUILD_WORKERS,
+    ETL_INITIAL_DEFER_CONSTRAINTS,
+)
+from connection import SourceCursor, connect_pg, connect_source
+from deferred_constraints import defer_fact_constraints, restore_fact_constraints
+from demographic_transform import demographic_transformer
+from extract_cache import extract_cache
+from dimension_cache import DimensionCaches
+from load_fact import load_fact, load_fact_parallel, work_fact_queue
 from load_customer_demographic import load_customer_demographic_incremental, load_customer_demographic_initial
 from load_geographic import load_geographic_incremental, load_geographic_initial
 from load_time import load_time_incremental, load_time_initial
+from instrumentation import RunRecorder, StageMetrics
+from scheduler import Stage, run_stages
+from rollups import refresh_rollups
+from segments import assign_segments
+from write_batch import write_batch
 
-# Configurations
-load_dotenv()
-MSSQL_SERVER = "localhost"
-MSSQL_DB = "CompanyX"
-MSSQL_APP_ACC = getenv("MSSQL_APP_ACC")
-MSSQL_APP_PASS = getenv("MSSQL_APP_PASS")
-POSTGRES_SERVER = "localhost"
-POSTGRES_DB = "companyxwarehouse"
-POSTGRES_APP_ACC = getenv("POSTGRES_APP_ACC")
-POSTGRES_APP_PASS = getenv("POSTGRES_APP_PASS")
 TABLE_KEYS = {"time": 0, "geographic": 1, "customer_demographic": 2, "fact": 3}
+DIMENSION_KEYS = ("time", "geographic", "customer_demographic")
+# Snapshot month of every run, pinned to the end of the CompanyX data.
+RUN_DATE = date(2014, 7, 25)
 logger = getLogger(__name__)
 # Frankly speaking we do not emit anything but INFO, so.
 logging.basicConfig(level=logging.INFO)
 
 
-def _helper_initial_load_dimension(
-    mssql_cur: pymssql.Cursor,
+def _load_fact(
+    mssql_cur: SourceCursor,
     pg_cur: psycopg.Cursor,
     pg_conn: psycopg.Connection,
-    key_function_iterator,
+    caches: DimensionCaches,
+    metrics: StageMetrics,
+    **kwargs,
 ):
-    for key, function in key_function_iterator:
-        logger.info("Attempting to load %s dimension", key)
-        # Check if the dimension exists
-        pg_cur.execute(
-            "SELECT * FROM etlmeta_tabletimestamp AS t WHERE t.tablekey = %s",
-            (TABLE_KEYS[key],),
+    if ETL_FACT_WORKERS > 1 or ETL_FACT_QUEUE:
+        return load_fact_parallel(
+            ms_cur=mssql_cur,
+            pg_cur=pg_cur,
+            pg_conn=pg_conn,
+            workers=ETL_FACT_WORKERS,
+            ranges_per_worker=ETL_FACT_RANGES_PER_WORKER,
+            metrics=metrics,
+            queue=ETL_FACT_QUEUE,
+            **kwargs,
         )
-        result = pg_cur.fetchone()
 
-        if result is None:
-            # The dimension did not exist, so create it.
-            logger.info("Dimension %s does not exist, loading.", key)
-            timestamp = function(mssql_cur, pg_cur)
-            pg_cur.execute(
-                "INSERT INTO etlmeta_tabletimestamp (tablekey, modifieddate) VALUES (%s, %s)",
-                (TABLE_KEYS[key], timestamp),
-            )
-            # Commit changes
-            pg_conn.commit()
-            logger.info("Finished loading dimension %s", key)
-        else:
-            logger.info("Dimension %s exists, skipping.", key)
+    return load_fact(
+        ms_cur=mssql_cur, pg_cur=pg_cur, pg_conn=pg_conn, caches=caches, metrics=metrics, **kwargs
+    )
 
 
-def _initial_load(pg_conn: psycopg.Connection):
-    with pymssql.connect(
-        server="localhost",
-        user=MSSQL_APP_ACC,
-        password=MSSQL_APP_PASS,
-        database="CompanyX",
-    ) as mssql_conn:
-        with mssql_conn.cursor() as mssql_cur:
-            with pg_conn.cursor() as pg_cur:
-                _helper_initial_load_dimension(
-                    mssql_cur,
-                    pg_cur,
-                    pg_conn,
-                    # Pair the key with the corresponding load function
-                    zip(
-                        ["time", "geographic", "customer_demographic"],
-                        [
-                            load_time_initial,
-                            load_geographic_initial,
-                            load_customer_demographic_initial,
-                        ],
-                    ),
-                )
-
-                logger.info("Finished loading dimensions. Loading facts.")
+def _helper_initial_load_dimension(recorder: RunRecorder, key: str, function):
+    # Load one dimension on its own connections, so dimensions can load concurrently.
+    with connect_source() as mssql_conn, connect_pg() as pg_conn:
+        with mssql_conn.cursor() as mssql_cur, pg_conn.cursor() as pg_cur, recorder.stage(key) as metrics:
+            # Result sets read back from the extract cache are not counted as source traffic.
+            mssql_cur = extract_cache.cursor(metrics.source_cursor(mssql_cur))
+            pg_cur = metrics.warehouse_cursor(pg_cur)
+            logger.info("Attempting to load %s dimension", key)
+            # Check if the dimension exists
+            pg_cur.execute(
+                "SELECT * FROM etlmeta_tabletimestamp AS t WHERE t.tablekey = %s",
+                (TABLE_KEYS[key],),
+            )
+            result = pg_cur.fetchone()
 
-                # Dimension are loaded. Now we load the facts
-                timestamp = load_fact(
-                    ms_cur=mssql_cur,
-                    pg_cur=pg_cur,
-                    run_timestamp=date(2014, 7, 25),
-                    pg_conn=pg_conn,
-                )
-                # log timestamp
+            if result is None:
+                # The dimension did not exist, so create it.
+                logger.info("Dimension %s does not exist, loading.", key)
+                timestamp = function(mssql_cur, pg_cur)
                 pg_cur.execute(
                     "INSERT INTO etlmeta_tabletimestamp (tablekey, modifieddate) VALUES (%s, %s)",
-                    (TABLE_KEYS["fact"], timestamp),
-                )
-                # Mark initial load as finished
-                pg_cur.execute(
-                    "UPDATE etlmeta_factload SET loadfinished = %s, batchid = %s, loadingtimestamp = %s",
-                    (True, None, None),
+                    (TABLE_KEYS[key], timestamp),
                 )
+                # Commit changes
                 pg_conn.commit()
+                logger.info("Finished loading dimension %s", key)
+            else:
+                logger.info("Dimension %s exists, skipping.", key)
 
-                # done!
-                logger.info("Finished loading facts.")
 
+def _segment_stage(recorder: RunRecorder):
+    # Once the scores are in, give every new or re-scored snapshot its segment.
+    # Snapshots left without one by an interrupted run are picked up by the next.
+    with connect_pg() as pg_conn, recorder.stage("segment"):
+        assign_segments(pg_conn)
 
-def _helper_incremental_load_dimension(
-    mssql_cur: pymssql.Cursor,
-    pg_cur: psycopg.Cursor,
-    pg_conn: psycopg.Connection,
-    key_function_iterator,
-):
-    for key, function in key_function_iterator:
-        logger.info("Attempting to incrementally load %s dimension", key)
 
-        # Check for the update timestamp
-        pg_cur.execute(
-            "SELECT * FROM etlmeta_tabletimestamp AS t WHERE t.tablekey = %s",
-            (TABLE_KEYS[key],),
-        )
-        timestamp = pg_cur.fetchone()[1]
-        # Load the dimension
-        timestamp = function(mssql_cur, pg_cur, timestamp)
-        # Update timestamp and commit.
-        pg_cur.execute(
-            "UPDATE etlmeta_tabletimestamp SET modifieddate = %s WHERE tablekey = %s",
-            (timestamp, TABLE_KEYS[key]),
-        )
-        pg_conn.commit()
+def _age_band_stage(recorder: RunRecorder):
+    # Customers who changed age band since the last run, their Demographics unchanged.
+    with connect_pg() as pg_conn, recorder.stage("age_band"):
+        rekey_age_bands(pg_conn, RUN_DATE)
 
-        logger.info("Finished loading %s dimension", key)
 
+def _rollup_stage(recorder: RunRecorder):
+    # Last, refresh the rollups of the months this run (or an interrupted one) wrote to.
+    with connect_pg() as pg_conn, recorder.stage("rollup"):
+        refresh_rollups(pg_conn)
 
-def _incremental_load(pg_conn: psycopg.Connection):
-    with pymssql.connect(
-        server="localhost",
-        user=MSSQL_APP_ACC,
-        password=MSSQL_APP_PASS,
-        database="CompanyX",
-    ) as mssql_conn:
-        with mssql_conn.cursor() as mssql_cur:
-            with pg_conn.cursor() as pg_cur:
-                _helper_incremental_load_dimension(
-                    mssql_cur,
-                    pg_cur,
-                    pg_conn,
-                    # Pair the key with the corresponding load function
-                    zip(
-                        ["time", "geographic", "customer_demographic"],
-                        [
-                            load_time_incremental,
-                            load_geographic_incremental,
-                            load_customer_demographic_incremental,
-                        ],
-                    ),
-                )
 
-                logger.info("Incrementally loading the facts.")
+def _initial_load(pg_conn: psycopg.Connection, recorder: RunRecorder):
+    # Surrogate key lookups are shared by every loader of this run
+    caches = DimensionCaches()
 
-                pg_cur.execute(
-                    "SELECT * FROM etlmeta_tabletimestamp AS t WHERE t.tablekey = %s",
-                    (TABLE_KEYS["fact"], ),
-                )
-                timestamp = pg_cur.fetchone()[1]
-
-                timestamp = load_fact(
-                    ms_cur=mssql_cur,
-                    pg_cur=pg_cur,
-                    pg_conn=pg_conn,
-                    run_timestamp=date(2014, 7, 25),
-                    last_updated_timestamp=timestamp,
-                )
-                # Log timestamp
-                pg_cur.execute(
-                    "UPDATE etlmeta_tabletimestamp SET modifieddate = %s WHERE tablekey = %s",
-                    (timestamp, TABLE_KEYS["fact"]),
-                )
-                # Mark initial load as finished
-                pg_cur.execute(
-                    "UPDATE etlmeta_factload SET loadfinished = %s, batchid = %s, loadingtimestamp = %s",
-                    (True, None, None),
-                )
-                pg_conn.commit()
+    def fact_stage():
+        with connect_source() as mssql_conn, recorder.stage("fact") as metrics:
+            with mssql_conn.cursor() as mssql_cur:
+                with pg_conn.cursor() as pg_cur:
+                    mssql_cur = metrics.source_cursor(mssql_cur)
+                    pg_cur = metrics.warehouse_cursor(pg_cur)
+                    logger.info("Finished loading dimensions. Loading facts.")
+
+                    if ETL_INITIAL_DEFER_CONSTRAINTS:
+                        # Also when resuming: whatever was dropped before is still remembered.
+                        defer_fact_constraints(pg_cur)
+                        pg_conn.commit()
+
+                    # Dimension are loaded. Now we load the facts
+                    timestamp = _load_fact(
+                        mssql_cur,
+                        pg_cur,
+                        pg_conn,
+                        caches,
+                        metrics,
+                        run_timestamp=RUN_DATE,
+                    )
+                    # Rebuild the indexes and validate the foreign keys before the load counts as finished,
+                    # an interrupted rebuild is then resumed with the rest of the initial load.
+                    restore_fact_constraints(pg_conn, ETL_INDEX_BUILD_WORKERS)
+                    with write_batch(pg_cur, "fact bookkeeping") as batch:
+                        # log timestamp
+                        batch.execute(
+                            "INSERT INTO etlmeta_tabletimestamp (tablekey, modifieddate) VALUES (%s, %s)",
+                            (TABLE_KEYS["fact"], timestamp),
+                        )
+                        # Mark initial load as finished
+                        batch.execute(
+                            "UPDATE etlmeta_factload SET loadfinished = %s, batchid = %s, loadingtimestamp = %s",
+                            (True, None, None),
+                        )
+                        batch.execute("DELETE FROM etlmeta_factloadrange")
+                    pg_conn.commit()
+
+                    # done!
+                    logger.info("Finished loading facts.")
+
+    # The dimensions are independent of each other, the facts need all of them.
+    run_stages(
+        [
+            Stage("time", partial(_helper_initial_load_dimension, recorder, "time", load_time_initial)),
+            Stage(
+                "geographic",
+                partial(
+                    _helper_initial_load_dimension,
+                    recorder,
+                    "geographic",
+                    partial(load_geographic_initial, caches=caches),
+                ),
+            ),
+            Stage(
+                "customer_demographic",
+                partial(
+                    _helper_initial_load_dimension,
+                    recorder,
+                    "customer_demographic",
+                    partial(load_customer_demographic_initial, caches=caches),
+                ),
+            ),
+            Stage("fact", fact_stage, depends_on=DIMENSION_KEYS),
+            Stage("segment", partial(_segment_stage, recorder), depends_on=("fact",)),
+            Stage("rollup", partial(_rollup_stage, recorder), depends_on=("segment",)),
+        ],
+        ETL_DIMENSION_WORKERS,
+    )
+
+
+def _helper_incremental_load_dimension(recorder: RunRecorder, key: str, function):
+    # Load one dimension on its own connections, so dimensions can load concurrently.
+    with connect_source() as mssql_conn, connect_pg() as pg_conn:
+        with mssql_conn.cursor() as mssql_cur, pg_conn.cursor() as pg_cur, recorder.stage(key) as metrics:
+            mssql_cur = metrics.source_cursor(mssql_cur)
+            pg_cur = metrics.warehouse_cursor(pg_cur)
+            logger.info("Attempting to incrementally load %s dimension", key)
 
-                logger.info("Facts incremental load finished.")
+            # Check for the update timestamp
+            pg_cur.execute(
+                "SELECT * FROM etlmeta_tabletimestamp AS t WHERE t.tablekey = %s",
+                (TABLE_KEYS[key],),
+            )
+            timestamp = pg_cur.fetchone()[1]
+            # Load the dimension
+            timestamp = function(extract_cache.cursor(mssql_cur), pg_cur, timestamp)
+            # Update timestamp and commit.
+            pg_cur.execute(
+                "UPDATE etlmeta_tabletimestamp SET modifieddate = %s WHERE tablekey = %s",
+                (timestamp, TABLE_KEYS[key]),
+            )
+            pg_conn.commit()
+
+            logger.info("Finished loading %s dimension", key)
+
+
+def _change_detection_stage(recorder: RunRecorder) -> Changes:
+    # One query to the source for its latest changes, before any stage starts.
+    with connect_source() as mssql_conn, connect_pg() as pg_conn:
+        with mssql_conn.cursor() as mssql_cur, pg_conn.cursor() as pg_cur, recorder.stage("change_detection") as metrics:
+            return detect_changes(
+                metrics.source_cursor(mssql_cur),
+                metrics.warehouse_cursor(pg_cur),
+                TABLE_KEYS,
+                RUN_DATE,
+                ETL_FACT_ROLL_FORWARD,
+            )
 
-def main():
+
+def _incremental_load(pg_conn: psycopg.Connection, recorder: RunRecorder):
+    # Surrogate key lookups are shared by every loader of this run
+    caches = DimensionCaches()
+    changes = _change_detection_stage(recorder) if ETL_CHANGE_DETECTION else None
+
+    def dimension_stage(key: str, function):
+        if changes is not None and not changes.changed(key):
+            # Keeps its watermark, the next run compares with the same one.
+            return partial(logger.info, "Nothing changed for the %s dimension, skipping.", key)
+        return partial(_helper_incremental_load_dimension, recorder, key, function)
+
+    def fact_stage():
+        with connect_source() as mssql_conn, recorder.stage("fact") as metrics:
+            with mssql_conn.cursor() as mssql_cur:
+                with pg_conn.cursor() as pg_cur:
+                    mssql_cur = metrics.source_cursor(mssql_cur)
+                    pg_cur = metrics.warehouse_cursor(pg_cur)
+                    logger.info("Incrementally loading the facts.")
+                    # Left over by an initial load that was finished without them, e.g. by hand.
+                    restore_fact_constraints(pg_conn, ETL_INDEX_BUILD_WORKERS)
+                    if changes is not None and not changes.changed("fact"):
+                        logger.info("No order changed and no month to roll forward to, skipping the facts.")
+                        return
+
+                    pg_cur.execute(
+                        "SELECT * FROM etlmeta_tabletimestamp AS t WHERE t.tablekey = %s",
+                        (TABLE_KEYS["fact"], ),
+                    )
+                    previous_timestamp = pg_cur.fetchone()[1]
+
+                    timestamp = _load_fact(
+                        mssql_cur,
+                        pg_cur,
+                        pg_conn,
+                        caches,
+                        metrics,
+                        run_timestamp=RUN_DATE,
+                        last_updated_timestamp=previous_timestamp,
+                        roll_forward=ETL_FACT_ROLL_FORWARD,
+                        customer_range=changes.customer_range if changes is not None else None,
+                    )
+                    # A load that only rolled forward found no order, keep the previous timestamp.
+                    if previous_timestamp is not None:
+                        timestamp = max(timestamp, previous_timestamp)
+                    with write_batch(pg_cur, "fact bookkeeping") as batch:
+                        # Log timestamp
+                        batch.execute(
+                            "UPDATE etlmeta_tabletimestamp SET modifieddate = %s WHERE tablekey = %s",
+                            (timestamp, TABLE_KEYS["fact"]),
+                        )
+                        # Mark initial load as finished
+                        batch.execute(
+                            "UPDATE etlmeta_factload SET loadfinished = %s, batchid = %s, loadingtimestamp = %s",
+                            (True, None, None),
+                        )
+                        batch.execute("DELETE FROM etlmeta_factloadrange")
+                    pg_conn.commit()
+
+                    logger.info("Facts incremental load finished.")
+
+    # The dimensions are independent of each other, the facts need all of them.
+    run_stages(
+        [
+            Stage("time", dimension_stage("time", load_time_incremental)),
+            Stage("geographic", dimension_stage("geographic", partial(load_geographic_incremental, caches=caches))),
+            Stage(
+                "customer_demographic",
+                dimension_stage("customer_demographic", partial(load_customer_demographic_incremental, caches=caches)),
+            ),
+            Stage("fact", fact_stage, depends_on=DIMENSION_KEYS),
+            Stage("segment", partial(_segment_stage, recorder), depends_on=("fact",)),
+            # After the segments, both update the run month's snapshots.
+            Stage("age_band", partial(_age_band_stage, recorder), depends_on=("segment",)),
+            Stage("rollup", partial(_rollup_stage, recorder), depends_on=("age_band",)),
+        ],
+        ETL_DIMENSION_WORKERS,
+    )
+
+def _backfill(recorder: RunRecorder, first_month: date, last_month: date):
+    # Recompute the snapshot months of the range, then their rollups. The dimensions and the
+    # customers' snapshots come from the loads, so this needs a finished initial load.
+    with connect_pg() as pg_conn:
+        with pg_conn.cursor() as pg_cur:
+            pg_cur.execute("SELECT loadfinished FROM etlmeta_factload")
+            result = pg_cur.fetchone()
+    if result is None or not result[0]:
+        logger.error("No finished initial load to backfill, run the ETL without --backfill first.")
+        return
+
+    with recorder.stage("backfill") as metrics:
+        backfill(first_month, last_month, RUN_DATE, metrics=metrics)
+    _rollup_stage(recorder)
+
+
+def _fact_worker(recorder: RunRecorder):
+    # Another machine's share of a queue mode fact load (ETL_FACT_QUEUE=1): load the queued
+    # ranges alongside the run that queued them, with the same parameters, until none is left.
+    # That run finishes the load, the segments and the rollups.
+    with connect_pg() as pg_conn:
+        with pg_conn.cursor() as pg_cur:
+            pg_cur.execute("SELECT loadfinished FROM etlmeta_factload")
+            result = pg_cur.fetchone()
+            pg_cur.execute("SELECT COUNT(*) FROM etlmeta_factloadrange WHERE NOT finished")
+            unfinished = pg_cur.fetchone()[0]
+            pg_cur.execute(
+                "SELECT modifieddate FROM etlmeta_tabletimestamp WHERE tablekey = %s",
+                (TABLE_KEYS["fact"],),
+            )
+            watermark = pg_cur.fetchone()
+    if result is None or unfinished == 0:
+        logger.info("No fact range queued, start the ETL with ETL_FACT_QUEUE=1 first.")
+        return
+
+    # Same as the fact stage of the running load, initial or incremental.
+    incremental = result[0]
+    kwargs = {"run_timestamp": RUN_DATE}
+    if incremental:
+        kwargs.update(last_updated_timestamp=watermark[0], roll_forward=ETL_FACT_ROLL_FORWARD)
+    with connect_source() as mssql_conn, recorder.stage("fact") as metrics:
+        with mssql_conn.cursor() as mssql_cur:
+            work_fact_queue(metrics.source_cursor(mssql_cur), ETL_FACT_WORKERS, metrics=metrics, **kwargs)
+
+
+def main(backfill_months: tuple[date, date] | None = None, fact_worker: bool = False):
     # Check with the warehouse to see if we are doing initial load or incremental load.
     logger.info("Starting the ETL pipeline.")
-    with psycopg.connect(
-        f"host={POSTGRES_SERVER} port=5432 dbname={POSTGRES_DB} user={POSTGRES_APP_ACC} password={POSTGRES_APP_PASS}"
-    ) as pg_conn:
+    recorder = RunRecorder()
+    try:
+        if backfill_months is not None:
+            _backfill(recorder, *backfill_months)
+        elif fact_worker:
+            _fact_worker(recorder)
+        else:
+            _run(recorder)
+    finally:
+        # On a fresh connection, the run's own may be unusable if it failed. A failure to save
+        # is only logged, so it does not replace the run's own error.
+        try:
+            with connect_pg() as pg_conn:
+                recorder.save(pg_conn)
+        except Exception:
+            logger.exception("Could not save the run history")
+
+
+def _run(recorder: RunRecorder):
+    with connect_pg() as pg_conn:
         with pg_conn.cursor() as pg_cur:
             pg_cur.execute("SELECT * FROM etlmeta_factload")
             result = pg_cur.fetchone()
@@ -206,7 +391,7 @@ def main():
                     "INSERT INTO etlmeta_factload (id, loadfinished, batchid, loadingtimestamp) VALUES (%s, %s, %s, %s)",
                     (1, False, None, None),
                 )
-                _initial_load(pg_conn)
+                _initial_load(pg_conn, recorder)
                 logger.info("Initial load finished. Exiting.")
                 return
 
@@ -215,7 +400,7 @@ def main():
                 logger.info(
                     "Detected incomplete initial load attempt, resuming from that point."
                 )
-                _initial_load(pg_conn)
+                _initial_load(pg_conn, recorder)
                 logger.info("Initial load finished. Exiting.")
                 return
 
@@ -223,9 +408,32 @@ def main():
             logger.info(
                 "Detected a successful initial load attempt, running incremental load."
             )
-            _incremental_load(pg_conn)
+            _incremental_load(pg_conn, recorder)
             logger.info("Incremental load finished. Exiting.")
 
 
+def _month(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m").date()
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Load CompanyX into the warehouse, initial or incremental.")
+    parser.add_argument(
+        "--backfill",
+        nargs=2,
+        type=_month,
+        metavar=("FIRST_MONTH", "LAST_MONTH"),
+        help="Instead of a load, recompute the snapshot months from FIRST_MONTH to LAST_MONTH (YYYY-MM)",
+    )
+    parser.add_argument(
+        "--fact-worker",
+        action="store_true",
+        help="Instead of a load, help the running one with its fact ranges (ETL_FACT_QUEUE=1)",
+    )
+    arguments = parser.parse_args()
+    try:
+        main(tuple(arguments.backfill) if arguments.backfill else None, arguments.fact_worker)
+    finally:
+        demographic_transformer.log_stats()
+        demographic_transformer.close()
+        extract_cache.log_stats()
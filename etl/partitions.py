@@ -0,0 +1,118 @@
+from datetime import date, timedelta
+from logging import getLogger
+import psycopg
+
+logger = getLogger(__name__)
+
+FACT_TABLE = "factcustomermonthlysnapshot"
+# Names of the partitions of the fact table.
+PARTITIONS_SQL = """
+SELECT child.relname
+FROM pg_inherits AS i
+    JOIN pg_class AS child ON child.oid = i.inhrelid
+WHERE i.inhparent = %s::regclass"""
+IS_PARTITIONED_SQL = """
+SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass)"""
+
+
+def month_start(input_date: date) -> date:
+    return date(input_date.year, input_date.month, 1)
+
+
+def next_month(input_date: date) -> date:
+    return month_start(month_start(input_date) + timedelta(days=31))
+
+
+def partition_name(month: date) -> str:
+    return f"{FACT_TABLE}_y{month.year}m{month.month:02d}"
+
+
+def partition_bounds(month: date) -> tuple[int, int]:
+    # SnapshotDateKey is the yyyymmdd of the last day of the month, any day of the month is in range.
+    start = month_start(month)
+    end = next_month(month)
+    return (
+        start.year * 10000 + start.month * 100 + start.day,
+        end.year * 10000 + end.month * 100 + end.day,
+    )
+
+
+def _months(first_month: date, last_month: date):
+    month = month_start(first_month)
+    while month <= last_month:
+        yield month
+        month = next_month(month)
+
+
+def is_partitioned(pg_cur: psycopg.Cursor) -> bool:
+    # Warehouses created before the fact table was partitioned keep loading into the single table.
+    return pg_cur.execute(IS_PARTITIONED_SQL, (FACT_TABLE,)).fetchone()[0]
+
+
+def existing_partitions(pg_cur: psycopg.Cursor) -> set[str]:
+    pg_cur.execute(PARTITIONS_SQL, (FACT_TABLE,))
+    return {row[0] for row in pg_cur.fetchall()}
+
+
+def has_partition(pg_cur: psycopg.Cursor, month: date) -> bool:
+    return partition_name(month) in existing_partitions(pg_cur)
+
+
+def ensure_partitions(pg_cur: psycopg.Cursor, first_month: date, last_month: date) -> int:
+    # Create the (empty, attached) partitions of every month in the range that does not have one.
+    existing = existing_partitions(pg_cur)
+    created = 0
+    for month in _months(first_month, last_month):
+        name = partition_name(month)
+        if name in existing:
+            continue
+
+        (lower, upper) = partition_bounds(month)
+        pg_cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {FACT_TABLE} FOR VALUES FROM ({lower}) TO ({upper})"
+        )
+        created += 1
+
+    if created > 0:
+        logger.info("Created %s partitions of %s", created, FACT_TABLE)
+    return created
+
+
+def create_detached(pg_cur: psycopg.Cursor, month: date, name: str | None = None) -> str:
+    # A stand-alone table shaped like the fact table, to bulk-load one month into without
+    # maintaining the fact table's indexes row by row. Attach it with attach_partition().
+    name = name or partition_name(month)
+    (lower, upper) = partition_bounds(month)
+    pg_cur.execute(f"DROP TABLE IF EXISTS {name}")
+    pg_cur.execute(f"CREATE TABLE {name} (LIKE {FACT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    # Matches the partition bound, so attaching does not need to scan the table to check it.
+    pg_cur.execute(
+        f"ALTER TABLE {name} ADD CONSTRAINT {name}_bound CHECK (snapshotdatekey >= {lower} AND snapshotdatekey < {upper})"
+    )
+    return name
+
+
+def attach_partition(pg_cur: psycopg.Cursor, month: date, name: str | None = None):
+    # Build the indexes of a loaded detached table in one pass each and attach it.
+    # The indexes of the fact table that are missing on it are built by the ATTACH.
+    name = name or partition_name(month)
+    (lower, upper) = partition_bounds(month)
+    pg_cur.execute(f"ALTER TABLE {name} ADD PRIMARY KEY (customerkey, snapshotdatekey)")
+    pg_cur.execute(
+        f"ALTER TABLE {FACT_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ({lower}) TO ({upper})"
+    )
+    pg_cur.execute(f"ALTER TABLE {name} DROP CONSTRAINT {name}_bound")
+    logger.info("Attached %s to %s", name, FACT_TABLE)
+
+
+def replace_partition(pg_cur: psycopg.Cursor, month: date, name: str):
+    # Swap the partition of a month for a reloaded detached table, leaving the other months alone.
+    # Runs in the caller's transaction, readers see either the old or the new month.
+    current = partition_name(month)
+    if current in existing_partitions(pg_cur):
+        pg_cur.execute(f"ALTER TABLE {FACT_TABLE} DETACH PARTITION {current}")
+        pg_cur.execute(f"DROP TABLE {current}")
+
+    attach_partition(pg_cur, month, name)
+    if name != current:
+        pg_cur.execute(f"ALTER TABLE {name} RENAME TO {current}")
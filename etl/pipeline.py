@@ -0,0 +1,195 @@
+from logging import getLogger
+import queue
+import threading
+import time
+
+from config import ETL_PIPELINE_QUEUE_SIZE
+
+logger = getLogger(__name__)
+
+# Marks the end of the stream on a queue.
+_DONE = object()
+
+
+class _Failed:
+    # Carries an upstream exception down the pipeline, so the caller can raise it.
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        # Time spent working on items, and time spent blocked on the neighbouring queues.
+        self.busy = 0.0
+        self.waiting_input = 0.0
+        self.waiting_output = 0.0
+
+    def log(self, pipeline: str):
+        logger.info(
+            "Pipeline %s, stage %s: %s items, busy %.2fs (%.1f items/s), waited %.2fs for input, %.2fs for output",
+            pipeline,
+            self.name,
+            self.items,
+            self.busy,
+            self.items / self.busy if self.busy > 0 else 0,
+            self.waiting_input,
+            self.waiting_output,
+        )
+
+
+class _MeasuredQueue(queue.Queue):
+    # Bounded queue between two stages, sampling its depth on every put.
+
+    def __init__(self, name: str, maxsize: int):
+        super().__init__(maxsize)
+        self.name = name
+        self.puts = 0
+        self.depth_total = 0
+        self.depth_max = 0
+
+    def put_until(self, item, stop: threading.Event) -> bool:
+        # Blocks while the queue is full (backpressure), unless the pipeline is being torn down.
+        while not stop.is_set():
+            try:
+                self.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+
+            depth = self.qsize()
+            self.puts += 1
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+            return True
+        return False
+
+    def get_until(self, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                return self.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def log(self, pipeline: str):
+        logger.info(
+            "Pipeline %s, queue %s: average depth %.1f, max depth %s of %s",
+            pipeline,
+            self.name,
+            self.depth_total / self.puts if self.puts > 0 else 0,
+            self.depth_max,
+            self.maxsize,
+        )
+
+
+def _run_source(source, output: _MeasuredQueue, stats: StageStats, stop: threading.Event):
+    try:
+        iterator = iter(source)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            stats.busy += time.perf_counter() - started
+            stats.items += 1
+
+            started = time.perf_counter()
+            if not output.put_until(item, stop):
+                return
+            stats.waiting_output += time.perf_counter() - started
+        output.put_until(_DONE, stop)
+    except BaseException as error:
+        output.put_until(_Failed(error), stop)
+
+
+def _run_stage(function, input: _MeasuredQueue, output: _MeasuredQueue, stats: StageStats, stop: threading.Event):
+    try:
+        while True:
+            started = time.perf_counter()
+            item = input.get_until(stop)
+            stats.waiting_input += time.perf_counter() - started
+            if item is _DONE or isinstance(item, _Failed):
+                output.put_until(item, stop)
+                return
+
+            started = time.perf_counter()
+            item = function(item)
+            stats.busy += time.perf_counter() - started
+            stats.items += 1
+
+            started = time.perf_counter()
+            if not output.put_until(item, stop):
+                return
+            stats.waiting_output += time.perf_counter() - started
+    except BaseException as error:
+        output.put_until(_Failed(error), stop)
+
+
+def run_pipeline(name: str, source, stages, sink, queue_size: int = ETL_PIPELINE_QUEUE_SIZE):
+    # Run source -> stages -> sink concurrently, connected by bounded queues.
+    # The source and every stage run on their own thread, the sink runs on the calling thread,
+    # so it can keep using the caller's warehouse connection. Items are usually chunks of rows.
+    # Both pymssql and psycopg release the GIL while waiting on the network, so the source
+    # extraction and the warehouse writes overlap.
+    # stages is a list of (name, function) pairs, each function maps one item to the next.
+    stop = threading.Event()
+    source_stats = StageStats("extract")
+    stats = [source_stats]
+    queues = [_MeasuredQueue("extract", queue_size)]
+    threads = [
+        threading.Thread(
+            target=_run_source,
+            args=(source, queues[0], source_stats, stop),
+            name=f"{name}-extract",
+            daemon=True,
+        )
+    ]
+
+    for stage_name, function in stages:
+        stage_stats = StageStats(stage_name)
+        output = _MeasuredQueue(stage_name, queue_size)
+        threads.append(
+            threading.Thread(
+                target=_run_stage,
+                args=(function, queues[-1], output, stage_stats, stop),
+                name=f"{name}-{stage_name}",
+                daemon=True,
+            )
+        )
+        stats.append(stage_stats)
+        queues.append(output)
+
+    sink_stats = StageStats("load")
+    stats.append(sink_stats)
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            started = time.perf_counter()
+            item = queues[-1].get()
+            sink_stats.waiting_input += time.perf_counter() - started
+            if item is _DONE:
+                break
+            if isinstance(item, _Failed):
+                raise item.error
+
+            started = time.perf_counter()
+            sink(item)
+            sink_stats.busy += time.perf_counter() - started
+            sink_stats.items += 1
+    finally:
+        # Unblock the upstream threads if we are leaving early.
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        for stage_stats in stats:
+            stage_stats.log(name)
+        for stage_queue in queues:
+            stage_queue.log(name)
+        bottleneck = max(stats, key=lambda s: s.busy)
+        logger.info("Pipeline %s is bound by stage %s", name, bottleneck.name)
@@ -0,0 +1,131 @@
+from logging import getLogger
+import numpy as np
+
+from config import ETL_RFM_SCORING
+from streaming import stream_chunks
+
+logger = getLogger(__name__)
+
+# Scores are 1 + the number of edges a measure reaches (value >= edge), 5 at most. The default
+# edges reproduce the CASE expressions of TRANSACTION_SQL:
+# - Recency, from the days between the month's latest order and the end of the month:
+#   5 - GREATEST((days - 1) / 7, 0), counted down instead of up, the most recent scores 5.
+# - Frequency, from the number of orders of the month: LEAST(4, count + 1), 5 from 5 orders.
+# - Monetary, from the average order value of the month: 1 under 300, then 2 + CAST(avg AS INT) / 1000.
+#   CAST(money AS INT) rounds, hence the .5 edges.
+RECENCY_EDGES = (8, 15, 22, 29)
+FREQUENCY_EDGES = (1, 2, 3, 5)
+MONETARY_EDGES = (300, 999.5, 1999.5, 2999.5)
+QUANTILES = (0.2, 0.4, 0.6, 0.8)
+
+# Every month of every customer, the population the quantile edges are computed over.
+POPULATION_SQL = """
+SELECT
+    OrderYear = DATEPART(year, header.OrderDate),
+    OrderMonth = DATEPART(month, header.OrderDate),
+    MonthCount = COUNT(header.SalesOrderID),
+    MonthTotal = ISNULL(SUM(header.SubTotal), 0),
+    LatestOrderDate = MAX(header.OrderDate)
+FROM Sales.SalesOrderHeader AS header
+WHERE header.Status != 6
+GROUP BY header.CustomerID,
+    DATEPART(year, header.OrderDate),
+    DATEPART(month, header.OrderDate)"""
+
+
+def _measures(years, months, counts, totals, latest_dates):
+    # Month aggregates -> (days in the month, days from the latest order to the end of the month,
+    # order count, average order value), as arrays.
+    month = (np.asarray(years, dtype=np.int64) - 1970) * 12 + np.asarray(months, dtype=np.int64) - 1
+    month = month.astype("datetime64[M]")
+    month_days = ((month + 1).astype("datetime64[D]") - month.astype("datetime64[D]")).astype(np.int64)
+    # Only the day of the latest order matters, much cheaper to extract than converting datetimes.
+    latest_days = np.fromiter((latest.day for latest in latest_dates), np.int64, len(latest_dates))
+    counts = np.asarray(counts, dtype=np.int64)
+    # SubTotal is money, four decimals, and so is the money / int division.
+    averages = np.round(np.fromiter(map(float, totals), np.float64, len(totals)) / counts, 4)
+    return (month_days, month_days - latest_days, counts, averages)
+
+
+class RFMScorer:
+    # Scores whole batches of month aggregates at once, with NumPy.
+
+    def __init__(
+        self,
+        recency_edges=RECENCY_EDGES,
+        frequency_edges=FREQUENCY_EDGES,
+        monetary_edges=MONETARY_EDGES,
+    ):
+        self.recency_edges = np.asarray(recency_edges, dtype=np.float64)
+        self.frequency_edges = np.asarray(frequency_edges, dtype=np.float64)
+        self.monetary_edges = np.asarray(monetary_edges, dtype=np.float64)
+
+    @classmethod
+    def from_population(cls, days, counts, averages, quantiles=QUANTILES):
+        # Edges at the quantiles of the population instead, each score covering a share of it.
+        return cls(
+            np.quantile(days, quantiles),
+            np.quantile(counts, quantiles),
+            np.quantile(averages, quantiles),
+        )
+
+    @classmethod
+    def fit(cls, ms_cur, quantiles=QUANTILES):
+        # Quantile edges over every month of every customer in the source.
+        ms_cur.execute(POPULATION_SQL)
+        parts = []
+        for rows in stream_chunks(ms_cur):
+            (_, days, counts, averages) = _measures(*zip(*rows))
+            parts.append((days, counts, averages))
+        if len(parts) == 0:
+            return cls()
+
+        scorer = cls.from_population(*(np.concatenate(part) for part in zip(*parts)), quantiles)
+        logger.info(
+            "RFM quantile edges: recency %s, frequency %s, monetary %s",
+            scorer.recency_edges.tolist(),
+            scorer.frequency_edges.tolist(),
+            scorer.monetary_edges.tolist(),
+        )
+        return scorer
+
+    @staticmethod
+    def _reached(edges, values):
+        return np.searchsorted(edges, values, side="right")
+
+    def score(self, days, counts, averages):
+        recency = len(self.recency_edges) + 1 - self._reached(self.recency_edges, days)
+        frequency = 1 + self._reached(self.frequency_edges, counts)
+        monetary = 1 + self._reached(self.monetary_edges, averages)
+        return (recency, frequency, monetary)
+
+    def score_rows(self, rows) -> list[tuple]:
+        # Rows of BULK_ORDER_AGGREGATE_SQL -> rows shaped like those of TRANSACTION_SQL:
+        # (CustomerID, OrderYear, OrderMonth, OrderDay, Recency, Frequency, Monetary, ModifiedDate)
+        if len(rows) == 0:
+            return []
+
+        (customers, years, months, counts, totals, latest_dates, modified) = zip(*rows)
+        (month_days, days, counts, averages) = _measures(years, months, counts, totals, latest_dates)
+        (recency, frequency, monetary) = self.score(days, counts, averages)
+        return list(
+            zip(
+                customers,
+                years,
+                months,
+                month_days.tolist(),
+                recency.tolist(),
+                frequency.tolist(),
+                monetary.tolist(),
+                modified,
+            )
+        )
+
+
+def create_scorer(ms_cur):
+    # The scorer for this run's ETL_RFM_SCORING, None to keep scoring in TRANSACTION_SQL.
+    if ETL_RFM_SCORING == "python":
+        return RFMScorer()
+    if ETL_RFM_SCORING == "quantile":
+        return RFMScorer.fit(ms_cur)
+    return None
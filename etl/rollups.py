@@ -0,0 +1,138 @@
+from logging import getLogger
+import logging
+import psycopg
+
+from write_batch import WriteBatch, write_batch
+
+logger = getLogger(__name__)
+
+
+class Rollup:
+    # A summary table of the snapshot by month and some dimension attributes.
+    # Refreshing a month replaces its rows with a GROUP BY over that month of the fact table.
+
+    def __init__(self, table: str, columns: dict[str, str], joins: str):
+        # columns: rollup column -> expression over the joined dimensions
+        self.table = table
+        self.columns = tuple(columns)
+        column_list = ", ".join(self.columns)
+        expressions = ", ".join(columns.values())
+        self._delete_sql = f"DELETE FROM {table} WHERE snapshotdatekey = %s"
+        self._insert_sql = f"""
+INSERT INTO {table} (snapshotdatekey, {column_list}, customers, recencysum, frequencysum, monetarysum)
+SELECT f.snapshotdatekey, {expressions}, COUNT(*), SUM(f.recency_score), SUM(f.frequency_score), SUM(f.monetary_score)
+FROM factcustomermonthlysnapshot AS f
+    {joins}
+    LEFT JOIN dimsegment AS s ON s.segmentkey = f.segmentkey
+WHERE f.snapshotdatekey = %s
+GROUP BY f.snapshotdatekey, {expressions}"""
+
+    def refresh(self, pg_cur: psycopg.Cursor | WriteBatch, month: int):
+        pg_cur.execute(self._delete_sql, (month,))
+        pg_cur.execute(self._insert_sql, (month,))
+
+    def read(
+        self,
+        pg_cur: psycopg.Cursor,
+        first_month: int | None = None,
+        last_month: int | None = None,
+        group_by: tuple[str, ...] | None = None,
+        **filters,
+    ) -> list[dict]:
+        # Rows of the rollup between two SnapshotDateKeys (inclusive), optionally filtered on
+        # its columns (e.g. territoryname="Northwest") and summed up to fewer of them.
+        group_by = self.columns if group_by is None else tuple(group_by)
+        for column in (*group_by, *filters):
+            if column not in self.columns:
+                raise ValueError(f"{self.table} has no column {column}")
+
+        conditions = ["snapshotdatekey >= %s", "snapshotdatekey <= %s"]
+        params = [first_month or 0, last_month or 99991231]
+        for column, value in filters.items():
+            conditions.append(f"{column} IS NOT DISTINCT FROM %s")
+            params.append(value)
+
+        selected = ", ".join(("snapshotdatekey", *group_by))
+        pg_cur.execute(
+            f"""
+SELECT {selected}, SUM(customers),
+    SUM(recencysum)::float / SUM(customers),
+    SUM(frequencysum)::float / SUM(customers),
+    SUM(monetarysum)::float / SUM(customers)
+FROM {self.table}
+WHERE {" AND ".join(conditions)}
+GROUP BY {selected}
+ORDER BY {selected}""",
+            params,
+        )
+        names = ("snapshotdatekey", *group_by, "customers", "recency", "frequency", "monetary")
+        return [dict(zip(names, row)) for row in pg_cur.fetchall()]
+
+
+ROLLUPS = {
+    "territory_segment": Rollup(
+        "rollup_territorysegment",
+        {
+            "countryregionname": "g.countryregionname",
+            "territoryname": "g.territoryname",
+            "segmentname": "s.segmentname",
+        },
+        "LEFT JOIN dimgeographic AS g ON g.geographickey = f.geographickey",
+    ),
+    "demographic_segment": Rollup(
+        "rollup_demographicsegment",
+        {
+            "ageband": "d.ageband",
+            "yearlyincomelevel": "d.yearlyincomelevel",
+            "segmentname": "s.segmentname",
+        },
+        "LEFT JOIN dimdemographic AS d ON d.demographickey = f.demographickey",
+    ),
+}
+
+# Record the months a statement wrote to, in the same transaction, for refresh_rollups.
+MARK_MONTH_SQL = "INSERT INTO etlmeta_rollupmonth (snapshotdatekey) VALUES (%s) ON CONFLICT DO NOTHING"
+
+
+def mark_month(pg_cur: psycopg.Cursor | WriteBatch, month: int):
+    pg_cur.execute(MARK_MONTH_SQL, (month,))
+
+
+def refresh_rollups(pg_conn: psycopg.Connection, everything: bool = False) -> int:
+    # Refresh every rollup for the months written since the last refresh, or for every month.
+    # The months are sent as one write batch and committed together with their rows of
+    # etlmeta_rollupmonth removed, so an interrupted refresh starts over from the same months.
+    with pg_conn.cursor() as pg_cur:
+        if everything:
+            pg_cur.execute(
+                "INSERT INTO etlmeta_rollupmonth (snapshotdatekey) SELECT DISTINCT snapshotdatekey FROM factcustomermonthlysnapshot ON CONFLICT DO NOTHING"
+            )
+            pg_conn.commit()
+
+        pg_cur.execute("SELECT snapshotdatekey FROM etlmeta_rollupmonth ORDER BY snapshotdatekey")
+        months = [row[0] for row in pg_cur.fetchall()]
+        with write_batch(pg_cur, "rollup refresh") as batch:
+            for month in months:
+                for rollup in ROLLUPS.values():
+                    rollup.refresh(batch, month)
+                batch.execute("DELETE FROM etlmeta_rollupmonth WHERE snapshotdatekey = %s", (month,))
+        pg_conn.commit()
+
+    logger.info("Refreshed %s rollups for %s months", len(ROLLUPS), len(months))
+    return len(months)
+
+
+def read_rollup(pg_cur: psycopg.Cursor, name: str, *args, **kwargs) -> list[dict]:
+    # Query API for reporting code, e.g.
+    #   read_rollup(pg_cur, "territory_segment", 20140101, 20141231, group_by=("territoryname",))
+    # Each row holds the month, the grouped columns, the number of customers and their average scores.
+    return ROLLUPS[name].read(pg_cur, *args, **kwargs)
+
+
+if __name__ == "__main__":
+    # python etl/rollups.py: rebuild every month, e.g. after adding a rollup.
+    from connection import connect_pg
+
+    logging.basicConfig(level=logging.INFO)
+    with connect_pg() as pg_conn:
+        refresh_rollups(pg_conn, everything=True)
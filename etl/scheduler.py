@@ -0,0 +1,55 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from logging import getLogger
+import time
+
+logger = getLogger(__name__)
+
+
+class Stage:
+    # One unit of the ETL run, started once every stage it depends on has finished.
+    def __init__(self, name: str, function, depends_on: tuple[str, ...] = ()):
+        self.name = name
+        self.function = function
+        self.depends_on = depends_on
+
+
+def run_stages(stages: list[Stage], workers: int):
+    # Run the stages on up to `workers` threads, each as soon as its dependencies are done.
+    # If a stage fails, nothing new is started, the running stages are left to finish (they
+    # commit their own work), then the first failure is raised.
+    pending = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = [name for name in stage.depends_on if name not in pending]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages {missing}")
+
+    done = set()
+    running = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while running or (pending and failure is None):
+            if failure is None:
+                for stage in [s for s in pending.values() if done.issuperset(s.depends_on)]:
+                    logger.info("Starting stage %s", stage.name)
+                    running[executor.submit(stage.function)] = (stage, time.perf_counter())
+                    del pending[stage.name]
+
+            if not running:
+                raise ValueError(f"Stages {list(pending)} have circular dependencies")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                (stage, started) = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as error:
+                    logger.error("Stage %s failed", stage.name)
+                    failure = failure or error
+                    continue
+
+                logger.info("Stage %s finished in %.1fs", stage.name, time.perf_counter() - started)
+                done.add(stage.name)
+
+    if failure is not None:
+        raise failure
@@ -0,0 +1,122 @@
+from logging import getLogger
+import logging
+import numpy as np
+import psycopg
+
+import rollups
+from write_batch import write_batch
+
+logger = getLogger(__name__)
+
+SEGMENT_MAP_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS stage_segmentmap (
+    recency_score SMALLINT NOT NULL,
+    frequency_score SMALLINT NOT NULL,
+    monetary_score SMALLINT NOT NULL,
+    segmentkey BIGINT NOT NULL
+)"""
+# One statement per month, which touches a single partition of the fact table.
+ASSIGN_SQL = """
+UPDATE factcustomermonthlysnapshot AS f
+SET segmentkey = s.segmentkey
+FROM stage_segmentmap AS s
+WHERE f.snapshotdatekey = %s
+    AND f.recency_score = s.recency_score
+    AND f.frequency_score = s.frequency_score
+    AND f.monetary_score = s.monetary_score
+    AND f.segmentkey IS DISTINCT FROM s.segmentkey"""
+# Snapshots are inserted, and have their scores updated, with no segment.
+UNASSIGNED_MONTHS_SQL = """
+SELECT DISTINCT snapshotdatekey FROM factcustomermonthlysnapshot
+WHERE segmentkey IS NULL ORDER BY snapshotdatekey"""
+ALL_MONTHS_SQL = "SELECT DISTINCT snapshotdatekey FROM factcustomermonthlysnapshot ORDER BY snapshotdatekey"
+
+DEFAULT_SEGMENT = "Hibernating"
+
+
+def segment_rules(recency, frequency, monetary):
+    # (segment, condition) pairs over arrays of scores, the first matching segment wins.
+    # A month without orders keeps the default scores (1, 1, 1).
+    return [
+        ("Champions", (recency >= 4) & (frequency >= 4) & (monetary >= 4)),
+        ("Loyal Customers", (recency >= 3) & (frequency >= 4)),
+        ("Can't Lose Them", (recency <= 2) & (frequency >= 4) & (monetary >= 4)),
+        ("At Risk", (recency <= 2) & (frequency >= 3)),
+        ("Potential Loyalists", (recency >= 4) & (frequency >= 3)),
+        ("New Customers", (recency >= 4) & (frequency == 2)),
+        ("Need Attention", (recency == 3) & (frequency == 3)),
+        ("Promising", (recency == 3) & (frequency <= 2) & (monetary >= 3)),
+        ("About To Sleep", (recency == 3) & (frequency <= 2)),
+        ("Lost", (recency == 1) & (frequency == 1) & (monetary == 1)),
+    ]
+
+
+def classify(recency, frequency, monetary) -> np.ndarray:
+    # Segment name of every score triple, as an array.
+    rules = segment_rules(np.asarray(recency), np.asarray(frequency), np.asarray(monetary))
+    return np.select(
+        [condition for _, condition in rules],
+        [name for name, _ in rules],
+        default=DEFAULT_SEGMENT,
+    )
+
+
+def segment_names() -> list[str]:
+    scores = np.ones(1, dtype=np.int64)
+    return [name for name, _ in segment_rules(scores, scores, scores)] + [DEFAULT_SEGMENT]
+
+
+def load_segment_map(pg_cur: psycopg.Cursor) -> int:
+    # Seed DimSegment, then stage the segment key of all 125 score triples.
+    pg_cur.execute(
+        "INSERT INTO dimsegment (segmentname) SELECT unnest(%s::varchar[]) ON CONFLICT (segmentname) DO NOTHING",
+        (segment_names(),),
+    )
+    pg_cur.execute("SELECT segmentname, segmentkey FROM dimsegment")
+    keys = dict(pg_cur.fetchall())
+
+    (recency, frequency, monetary) = (scores.ravel() for scores in np.indices((5, 5, 5)) + 1)
+    names = classify(recency, frequency, monetary)
+
+    pg_cur.execute(SEGMENT_MAP_SQL)
+    pg_cur.execute("TRUNCATE stage_segmentmap")
+    with pg_cur.copy(
+        "COPY stage_segmentmap (recency_score, frequency_score, monetary_score, segmentkey) FROM STDIN"
+    ) as copy:
+        for row in zip(recency.tolist(), frequency.tolist(), monetary.tolist(), names.tolist()):
+            copy.write_row((*row[:3], keys[row[3]]))
+    return len(names)
+
+
+def assign_segments(pg_conn: psycopg.Connection, resegment: bool = False) -> int:
+    # Set the SegmentKey of the snapshots without one, or of every snapshot whose segment
+    # differs from the current rules with resegment (after changing segment_rules).
+    # Every month is sent in one write batch and committed together, an interrupted run starts over.
+    updated = 0
+    with pg_conn.cursor() as pg_cur:
+        load_segment_map(pg_cur)
+        pg_conn.commit()
+
+        pg_cur.execute(ALL_MONTHS_SQL if resegment else UNASSIGNED_MONTHS_SQL)
+        months = [row[0] for row in pg_cur.fetchall()]
+        with write_batch(pg_cur, "segment assignment") as batch:
+            assigned = {month: batch.execute(ASSIGN_SQL, (month,)) for month in months}
+        # Rowcounts are only known once the batch is synced.
+        with write_batch(pg_cur, "segment months") as batch:
+            for month, cursor in assigned.items():
+                if cursor.rowcount > 0:
+                    rollups.mark_month(batch, month)
+                updated += cursor.rowcount
+        pg_conn.commit()
+
+    logger.info("Assigned the segment of %s snapshots over %s months", updated, len(months))
+    return updated
+
+
+if __name__ == "__main__":
+    # python etl/segments.py: re-segment the whole history, e.g. after changing segment_rules.
+    from connection import connect_pg
+
+    logging.basicConfig(level=logging.INFO)
+    with connect_pg() as pg_conn:
+        assign_segments(pg_conn, resegment=True)
@@ -0,0 +1,71 @@
+from contextlib import contextmanager
+from logging import getLogger
+import resource
+import time
+import tracemalloc
+
+from config import ETL_FETCH_CHUNK_SIZE, ETL_TRACE_MEMORY
+from connection import SourceCursor
+
+logger = getLogger(__name__)
+
+
+def stream_chunks(ms_cur: SourceCursor, chunk_size: int = ETL_FETCH_CHUNK_SIZE):
+    # Iterate over the current result set chunk_size rows at a time.
+    # The cursor must not be used for anything else until the iterator is exhausted.
+    while True:
+        rows = ms_cur.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def stream_rows(ms_cur: SourceCursor, chunk_size: int = ETL_FETCH_CHUNK_SIZE):
+    # Same as stream_chunks, one row at a time.
+    for rows in stream_chunks(ms_cur, chunk_size):
+        yield from rows
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MemoryUsage:
+    # Filled in when the tracked stage ends. peak_traced_mb is None unless tracing.
+    def __init__(self):
+        self.peak_traced_mb = None
+        self.peak_rss_mb = None
+
+
+@contextmanager
+def track_memory(stage: str):
+    # Report the memory used by a stage. The process RSS high-water mark is always reported,
+    # the peak of Python allocations within the stage only when ETL_TRACE_MEMORY is set,
+    # since tracemalloc slows the stage down noticeably. Stages running concurrently share
+    # the same process, so their figures overlap.
+    tracing = ETL_TRACE_MEMORY and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    elif tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    usage = MemoryUsage()
+
+    try:
+        yield usage
+    finally:
+        usage.peak_rss_mb = _max_rss_mb()
+        if tracemalloc.is_tracing():
+            usage.peak_traced_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            logger.info(
+                "Stage %s took %.1fs, peak traced memory %.1f MiB, process peak RSS %.1f MiB",
+                stage, time.perf_counter() - started, usage.peak_traced_mb, usage.peak_rss_mb,
+            )
+        else:
+            logger.info(
+                "Stage %s took %.1fs, process peak RSS %.1f MiB",
+                stage, time.perf_counter() - started, usage.peak_rss_mb,
+            )
+        if tracing:
+            tracemalloc.stop()
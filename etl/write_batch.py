@@ -0,0 +1,74 @@
+from contextlib import contextmanager
+from logging import getLogger
+import time
+import psycopg
+
+from instrumentation import WRITE_STATEMENTS, InstrumentedCursor
+
+logger = getLogger(__name__)
+
+
+class WriteBatch:
+    # Warehouse statements sent in psycopg's pipeline mode: each one goes out without waiting for
+    # the result of the previous one, and the batch waits for all of them once, on sync().
+    # Statements are prepared on the server, so one repeated within a batch (and every row of
+    # executemany) is parsed and planned once.
+    #
+    # Results only arrive on sync(): execute() returns the statement's own cursor, to read its
+    # rowcount or rows from afterwards. The server stops at the first failing statement and skips
+    # the rest of the batch, the error is raised from sync() (or leaving write_batch) and logged
+    # with the batch's name. Batches synced before are not affected.
+
+    def __init__(self, pg_cur, name: str):
+        # pg_cur: a cursor of the connection, its StageMetrics is kept up to date if instrumented.
+        self.name = name
+        self.metrics = pg_cur.metrics if isinstance(pg_cur, InstrumentedCursor) else None
+        self.pg_conn = pg_cur.connection
+        self.statements = 0
+        self._pending = []
+        self._pipeline = None
+
+    def execute(self, query, params=None) -> psycopg.Cursor:
+        cursor = self.pg_conn.cursor()
+        # Only the row writes are prepared, DDL and TRUNCATE are only pipelined.
+        cursor.execute(query, params, prepare=query.lstrip().upper().startswith(WRITE_STATEMENTS))
+        self._pending.append((query, cursor))
+        return cursor
+
+    def executemany(self, query, params_seq) -> psycopg.Cursor:
+        cursor = self.pg_conn.cursor()
+        cursor.executemany(query, params_seq)
+        self._pending.append((query, cursor))
+        return cursor
+
+    def sync(self):
+        # Wait for every statement sent so far.
+        started = time.perf_counter()
+        try:
+            self._pipeline.sync()
+        except psycopg.Error as error:
+            logger.error("Write batch %s failed, %s statements not applied: %s", self.name, len(self._pending), error)
+            raise
+        finally:
+            self._record(time.perf_counter() - started)
+
+    def _record(self, elapsed: float):
+        written = 0
+        for query, cursor in self._pending:
+            if query.lstrip().upper().startswith(WRITE_STATEMENTS):
+                written += max(cursor.rowcount, 0)
+        self.statements += len(self._pending)
+        if self.metrics is not None:
+            self.metrics.add(warehouse_queries=len(self._pending), warehouse_wait=elapsed, rows_written=written)
+        self._pending = []
+
+
+@contextmanager
+def write_batch(pg_cur, name: str):
+    # with write_batch(pg_cur, "rollups") as batch: batch.execute(...)
+    # Synced when leaving the block, committing is left to the caller.
+    batch = WriteBatch(pg_cur, name)
+    with batch.pg_conn.pipeline() as pipeline:
+        batch._pipeline = pipeline
+        yield batch
+        batch.sync()
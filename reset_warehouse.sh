@@ -10,3 +10,8 @@ sudo sudo -u postgres psql -d companyxwarehouse -c "\
     ALTER DEFAULT PRIVILEGES IN SCHEMA public
         GRANT SELECT, INSERT, UPDATE, DELETE ON TABLES TO $POSTGRES_APP_ACC;"
 sudo sudo -u postgres psql -d companyxwarehouse --file=warehouse_schema.sql
+# The ETL manages the fact table's partitions and indexes, so it owns that table.
+sudo sudo -u postgres psql -d companyxwarehouse -c "\
+    GRANT CREATE ON SCHEMA public TO $POSTGRES_APP_ACC;
+    GRANT REFERENCES ON ALL TABLES IN SCHEMA public TO $POSTGRES_APP_ACC;
+    ALTER TABLE FactCustomerMonthlySnapshot OWNER TO $POSTGRES_APP_ACC;"
@@ -74,6 +74,11 @@ sudo sudo -u postgres psql -d companyxwarehouse -c "\
     ALTER DEFAULT PRIVILEGES IN SCHEMA public
         GRANT SELECT, INSERT, UPDATE, DELETE ON TABLES TO $POSTGRES_APP_ACC;"
 sudo sudo -u postgres psql -d companyxwarehouse --file=warehouse_schema.sql
+# The ETL manages the fact table's partitions and indexes, so it owns that table.
+sudo sudo -u postgres psql -d companyxwarehouse -c "\
+    GRANT CREATE ON SCHEMA public TO $POSTGRES_APP_ACC;
+    GRANT REFERENCES ON ALL TABLES IN SCHEMA public TO $POSTGRES_APP_ACC;
+    ALTER TABLE FactCustomerMonthlySnapshot OWNER TO $POSTGRES_APP_ACC;"
 
 
 # --- Finish Preparing PostgreSQL ---
@@ -82,7 +87,7 @@ sudo sudo -u postgres psql -d companyxwarehouse --file=warehouse_schema.sql
 
 python -m venv .venv/etl
 source .venv/etl/bin/activate
-pip install python-dotenv pymssql psycopg[binary] --no-input
+pip install python-dotenv pymssql psycopg[binary] numpy --no-input
 deactivate
 
 # --- Finish Python ETL
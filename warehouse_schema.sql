@@ -50,6 +50,53 @@ CREATE TABLE IF NOT EXISTS ETLMeta_FactLoad (
   LoadingTimestamp TIMESTAMP NULL -- Current largest fact timestamp
 );
 
+CREATE TABLE IF NOT EXISTS ETLMeta_FactLoadRange (
+  RangeID INT PRIMARY KEY, -- One row per customer ID range of a parallel fact load
+  FirstCustomerID INT NOT NULL,
+  LastCustomerID INT NOT NULL,
+
+  BatchID INT NULL, -- which customerID has this range reached?
+  LoadingTimestamp TIMESTAMP NULL, -- Current largest fact timestamp of this range
+  Finished BOOLEAN NOT NULL,
+
+  ClaimedBy VARCHAR(200) NULL, -- Worker (host:pid:thread) holding the range in queue mode
+  LeaseExpires TIMESTAMPTZ NULL -- Claimable again after this, renewed by every batch of the range
+);
+
+CREATE TABLE IF NOT EXISTS ETLMeta_DeferredConstraint (
+  Name VARCHAR(100) PRIMARY KEY, -- Index or foreign key of the fact table dropped for the initial load
+  Kind VARCHAR(20) NOT NULL, -- 'index' or 'foreign key'
+  Definition TEXT NOT NULL -- As returned by pg_get_indexdef / pg_get_constraintdef, to rebuild it
+);
+
+CREATE TABLE IF NOT EXISTS ETLMeta_RollupMonth (
+  SnapshotDateKey INTEGER PRIMARY KEY -- A snapshot month written since its rollups were last refreshed
+);
+
+CREATE TABLE IF NOT EXISTS ETLMeta_BirthDate (
+  CustomerID INTEGER PRIMARY KEY, -- NK of DimCustomer
+  BirthDate DATE NOT NULL,
+  NextBandChange DATE NULL -- Next day the customer's age band changes, NULL past the last one
+);
+CREATE INDEX IF NOT EXISTS IX_BirthDate_NextBandChange
+  ON ETLMeta_BirthDate (NextBandChange);
+
+CREATE TABLE IF NOT EXISTS ETLMeta_RunHistory (
+  RunID VARCHAR(20) NOT NULL, -- Start of the run, e.g. 20250101T000000
+  Stage VARCHAR(40) NOT NULL,
+  BatchID INT NULL, -- NULL for the whole stage
+
+  StartedAt TIMESTAMP NOT NULL,
+  WallSeconds DOUBLE PRECISION NOT NULL,
+  RowsExtracted BIGINT NOT NULL,
+  RowsWritten BIGINT NOT NULL,
+  SourceQueries BIGINT NOT NULL,
+  WarehouseQueries BIGINT NOT NULL,
+  SourceWaitSeconds DOUBLE PRECISION NOT NULL, -- Time spent waiting on SQL Server
+  WarehouseWaitSeconds DOUBLE PRECISION NOT NULL, -- Time spent waiting on PostgreSQL
+  PeakMemoryMB DOUBLE PRECISION NULL
+);
+
 CREATE TABLE IF NOT EXISTS FactCustomerMonthlySnapshot (
   CustomerKey       BIGINT  NOT NULL,
   SnapshotDateKey   INTEGER NOT NULL,
@@ -88,7 +135,19 @@ CREATE TABLE IF NOT EXISTS FactCustomerMonthlySnapshot (
     FOREIGN KEY (SegmentKey)
     REFERENCES DimSegment(SegmentKey)
     ON UPDATE RESTRICT ON DELETE SET NULL
-);
+) PARTITION BY RANGE (SnapshotDateKey);
+-- One partition per month, e.g. FactCustomerMonthlySnapshot_Y2014M07 for [20140701, 20140801).
+-- Partitions are created by the ETL ahead of each load, see etl/partitions.py.
+
+-- Natural keys of the dimensions, used by the incremental loads to only insert new members
+CREATE UNIQUE INDEX IF NOT EXISTS UX_DimGeographic_NaturalKey
+  ON DimGeographic (CityName, StateProvinceName, CountryRegionName, TerritoryName);
+CREATE UNIQUE INDEX IF NOT EXISTS UX_DimDemographic_NaturalKey
+  ON DimDemographic (MaritalStatus, AgeBand, YearlyIncomeLevel, NumberCarsOwned, Education, Occupation, IsHomeOwner);
+-- One row per version of a customer. Also serves the CustomerID lookups of the fact load.
+-- Gender and the other versioned columns can be NULL, which must count as equal (PostgreSQL 15+).
+CREATE UNIQUE INDEX IF NOT EXISTS UX_DimCustomer_Version
+  ON DimCustomer (CustomerID, Name, Gender, EmailPromotionType) NULLS NOT DISTINCT;
 
 -- Helpful indexes for analytics
 CREATE INDEX IF NOT EXISTS IX_Fact_SnapshotDate
@@ -98,4 +157,34 @@ CREATE INDEX IF NOT EXISTS IX_Fact_Segment
 CREATE INDEX IF NOT EXISTS IX_Fact_Demographic
   ON FactCustomerMonthlySnapshot (DemographicKey);
 CREATE INDEX IF NOT EXISTS IX_Fact_Geographic
-  ON FactCustomerMonthlySnapshot (GeographicKey);
\ No newline at end of file
+  ON FactCustomerMonthlySnapshot (GeographicKey);
+
+-- Rollups of the snapshot for the dashboards, maintained by the ETL one month at a time (etl/rollups.py).
+-- Scores are kept as sums, so averages can be taken over any set of rows.
+CREATE TABLE IF NOT EXISTS Rollup_TerritorySegment (
+  SnapshotDateKey INTEGER NOT NULL,
+  CountryRegionName VARCHAR(60) NULL,
+  TerritoryName VARCHAR(60) NULL,
+  SegmentName VARCHAR(40) NULL,
+
+  Customers BIGINT NOT NULL,
+  RecencySum BIGINT NOT NULL,
+  FrequencySum BIGINT NOT NULL,
+  MonetarySum BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS IX_Rollup_TerritorySegment_Month
+  ON Rollup_TerritorySegment (SnapshotDateKey);
+
+CREATE TABLE IF NOT EXISTS Rollup_DemographicSegment (
+  SnapshotDateKey INTEGER NOT NULL,
+  AgeBand VARCHAR(20) NULL,
+  YearlyIncomeLevel VARCHAR(30) NULL,
+  SegmentName VARCHAR(40) NULL,
+
+  Customers BIGINT NOT NULL,
+  RecencySum BIGINT NOT NULL,
+  FrequencySum BIGINT NOT NULL,
+  MonetarySum BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS IX_Rollup_DemographicSegment_Month
+  ON Rollup_DemographicSegment (SnapshotDateKey);
\ No newline at end of file